@@ -1,15 +1,39 @@
 import os
+import sys
+import io
 import json
-from flask import Flask, request, jsonify, send_from_directory
+import re
+import math
+import random
+import fnmatch
+import bisect
+import mmap
+from array import array
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import tempfile
-import subprocess
 import difflib
 import webbrowser
 import time
 import threading
-from werkzeug.serving import run_simple
+import heapq
+import itertools
+import atexit
+import signal
+import hashlib
+import zlib
+import gzip
+import mimetypes
+import sqlite3
+import queue
+import importlib.util
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import run_simple, make_server
 import logging
 
 # 設定日誌
@@ -27,94 +51,3203 @@ logger.info(f"使用臨時目錄: {TEMP_DIR}")
 # 目前的工作目錄
 current_workspace = None
 
+# 目前工作目錄的檔案索引
+workspace_index = None
+
 # LLM 模型配置 - 根據公司需求修改
+# context_window 為模型可接受的 token 數上限，用於限制附加的檔案內容
 LLM_MODELS = [
-    {"id": "gpt-3.5-turbo", "name": "GPT-3.5 Turbo"},
-    {"id": "gpt-4", "name": "GPT-4"},
-    {"id": "llama-2", "name": "Llama 2"},
+    {"id": "gpt-3.5-turbo", "name": "GPT-3.5 Turbo", "context_window": 16385},
+    {"id": "gpt-4", "name": "GPT-4", "context_window": 8192},
+    {"id": "llama-2", "name": "Llama 2", "context_window": 4096},
     # 添加其他公司內部模型
 ]
 
-# 添加一個獨立的LLM應用程序API端點
-LLM_APP_ENDPOINT = "http://localhost:8001/process"  # 這裡需要替換為實際的LLM應用程序端點
+# 未知模型的 context 大小、保留給回應的 token 數、檔案過大時切塊的行數
+DEFAULT_CONTEXT_WINDOW = 4096
+LLM_RESPONSE_TOKEN_RESERVE = 1024
+CONTEXT_CHUNK_LINES = 60
+
+LLM_SYSTEM_PROMPT = '你是一個幫助分析和改進代碼的助手。請以git風格提出修改建議。'
+
+# LLM API 端點（OpenAI chat completions 相容格式），未設定時使用模擬回應
+LLM_API_URL = os.environ.get('LLM_API_URL')
+LLM_API_KEY = os.environ.get('LLM_API_KEY', '')
+
+# 添加一個獨立的LLM應用程序API端點（例如 http://localhost:8001/process），未設定時使用模擬回應
+LLM_APP_ENDPOINT = os.environ.get('LLM_APP_ENDPOINT')
+
+# 上游 HTTP 連線設定：每個主機的連線數上限、連線/讀取逾時（秒）、重試次數與退避時間
+UPSTREAM_POOL_SIZE = int(os.environ.get('VIBE_UPSTREAM_POOL_SIZE', '20'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('VIBE_UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('VIBE_UPSTREAM_READ_TIMEOUT', '120'))
+UPSTREAM_MAX_RETRIES = 2
+UPSTREAM_BACKOFF_BASE = 0.5
+UPSTREAM_BACKOFF_MAX = 8
+UPSTREAM_RETRY_STATUS = {429, 502, 503, 504}
+# 冪等方法可安全重試；其他方法（POST 等）只在請求確定未送出，或上游以 429/503 加上 Retry-After 明確要求稍後再試時重試
+UPSTREAM_IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+UPSTREAM_RETRY_AFTER_STATUS = {429, 503}
+
+# 斷路器：連續失敗次數達到門檻後暫停呼叫該主機，經過冷卻時間後再試一次
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# LLM 端點池設定：JSON 字串或 JSON 檔案路徑，格式為 {"模型 ID": [{"url": ..., "api_key": ..., "health_url": ...}]}，
+# "*" 為未列出模型的預設端點池。未設定時使用 LLM_API_URL 作為唯一端點
+LLM_ENDPOINTS = os.environ.get('VIBE_LLM_ENDPOINTS')
+# 延遲的指數移動平均權重、開始對沖請求前等待第一段文字的秒數（0 表示不對沖）、
+# 失敗後改用其他端點的次數、連續失敗幾次視為不健康、不健康端點的冷卻秒數、主動健康檢查間隔
+ROUTER_EWMA_ALPHA = 0.3
+ROUTER_HEDGE_DELAY = float(os.environ.get('VIBE_LLM_HEDGE_DELAY', '5'))
+ROUTER_MAX_FAILOVER = 2
+ROUTER_UNHEALTHY_THRESHOLD = 3
+ROUTER_UNHEALTHY_COOLDOWN = 30
+ROUTER_HEALTH_INTERVAL = 30
+
+# 支援的檔案類型
+SUPPORTED_EXTENSIONS = ['.js', '.py', '.html', '.css', '.java', '.c', '.cpp', '.cs', 
+                        '.php', '.ts', '.jsx', '.tsx', '.rb', '.go', '.rs', '.swift',
+                        '.json', '.md', '.txt']
+
+# 以集合查詢副檔名，避免對每個檔案逐一比對
+SUPPORTED_EXTENSION_SET = frozenset(SUPPORTED_EXTENSIONS)
+
+# 檔案索引檢查目錄變更的最短間隔（秒）
+INDEX_REFRESH_INTERVAL = 2
+
+# 與 vibe-coding-tool 共用的模組所在目錄
+SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared')
+
+# 全文與符號搜尋：索引的檔案大小上限、檢查檔案是否變更的最短間隔（秒）、單次搜尋的時間上限、
+# 分頁大小、每個檔案回傳的符合行數上限，以及索引的保存位置（重新啟動時沿用，不需重建）
+SEARCH_MAX_FILE_SIZE = 1024 * 1024
+SEARCH_REFRESH_INTERVAL = 5
+SEARCH_TIMEOUT = 5.0
+SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_PAGE_SIZE = 200
+SEARCH_MAX_LINES_PER_FILE = 20
+SEARCH_INDEX_DIR = os.environ.get('VIBE_SEARCH_INDEX_DIR',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'vibe-coding', 'search'))
+SEARCH_INDEX_SAVE_INTERVAL = 30
+# 更新索引時每讀取多少個檔案就併入索引一次，查詢不需等待整個工作目錄讀取完畢
+SEARCH_SYNC_BATCH = 200
+# 保存的索引格式版本，格式改變時舊的索引會被捨棄並重建
+SEARCH_INDEX_VERSION = 2
+# 保留在記憶體中的最近工作目錄索引數量
+MAX_RECENT_WORKSPACES = 3
+
+# 相關檔案檢索：切塊行數、預設與最大回傳檔案數、BM25 參數，以及嵌入向量分數的權重
+RETRIEVAL_CHUNK_LINES = 60
+RETRIEVAL_TOP_K = 8
+MAX_RETRIEVAL_TOP_K = 50
+BM25_K1 = 1.2
+BM25_B = 0.75
+RETRIEVAL_EMBEDDING_WEIGHT = 0.5
+# 本機嵌入模型名稱（需以 register_embedding_model 註冊，並安裝 numpy），未設定時只使用 BM25
+RETRIEVAL_EMBEDDING_MODEL = os.environ.get('VIBE_EMBEDDING_MODEL')
+
+# 目錄清單分頁大小
+DIRECTORY_PAGE_SIZE = 200
+MAX_DIRECTORY_PAGE_SIZE = 1000
+
+# 編輯緩衝區的鎖分段數量與記憶體上限（超過時把最久未更新的緩衝區寫回磁碟）
+BUFFER_LOCK_STRIPES = 64
+MAX_BUFFER_BYTES = 128 * 1024 * 1024
+
+# 定期保存檔案的間隔（秒）
+AUTO_SAVE_INTERVAL = 5
+
+# 檔案快照設定：是否以 zlib 壓縮、總大小上限、每個檔案保留的版本數
+SNAPSHOT_COMPRESS = True
+MAX_SNAPSHOT_BYTES = 256 * 1024 * 1024
+MAX_SNAPSHOT_VERSIONS = 10
+
+# 差異比較設定：演算法、逾時秒數（逾時後改為較粗略的結果）、前後文行數、檔案大小上限
+DIFF_ENGINE = os.environ.get('VIBE_DIFF_ENGINE', 'myers')
+DIFF_TIMEOUT = 2.0
+DIFF_CONTEXT_LINES = 3
+MAX_DIFF_FILE_SIZE = 50 * 1024 * 1024
+DIFF_STREAM_CHUNK_LINES = 1000
+DIFF_ANCHOR_THRESHOLD = 64
+
+# LLM 回應快取：記憶體 LRU 筆數、有效秒數；設定 VIBE_LLM_CACHE_DB 時另外使用 SQLite 磁碟快取
+LLM_CACHE_MAX_ENTRIES = 256
+LLM_CACHE_TTL = int(os.environ.get('VIBE_LLM_CACHE_TTL', '3600'))
+LLM_CACHE_DB = os.environ.get('VIBE_LLM_CACHE_DB')
+LLM_CACHE_DB_MAX_BYTES = 200 * 1024 * 1024
+
+# LLM 工作排程：工作執行緒數、佇列上限、每個模型與每個使用者同時執行的上限、完成的工作保留秒數
+LLM_WORKERS = int(os.environ.get('VIBE_LLM_WORKERS', '4'))
+LLM_QUEUE_SIZE = int(os.environ.get('VIBE_LLM_QUEUE_SIZE', '64'))
+LLM_MODEL_CONCURRENCY = 2
+LLM_USER_CONCURRENCY = 2
+LLM_JOB_TTL = 600
+# 優先順序由高到低：互動式查詢優先於批次查詢
+LLM_PRIORITY_LANES = ('interactive', 'bulk')
+
+# 批次讀取檔案的並行數與單次請求的檔案數上限
+# 大型檔案：超過門檻時 /api/file 只回傳一頁內容且編輯器為唯讀；分頁的預設行數與單次最多位元組數；
+# 行偏移索引每隔幾行記錄一次位置，以及快取幾個檔案的索引；判斷二進位檔時讀取的位元組數
+LARGE_FILE_THRESHOLD = int(os.environ.get('VIBE_LARGE_FILE_THRESHOLD', str(2 * 1024 * 1024)))
+FILE_PAGE_LINES = 1000
+MAX_FILE_PAGE_BYTES = 4 * 1024 * 1024
+LINE_INDEX_STRIDE = 64
+LINE_INDEX_CACHE_SIZE = 32
+BINARY_SNIFF_BYTES = 8192
+
+# 最近讀取的檔案內容快取的總位元組上限，以及只保留雜湊（內容已被淘汰）的檔案數上限
+MAX_FILE_CACHE_BYTES = 64 * 1024 * 1024
+MAX_FILE_DIGESTS = 10000
+
+FILE_READ_WORKERS = 8
+MAX_BATCH_FILES = 500
+
+# 套用 patch 時允許的 fuzz（可忽略的開頭/結尾 context 行數）與最大行號偏移
+PATCH_MAX_FUZZ = 2
+PATCH_MAX_OFFSET = 1000
+
+# 寫入檔案的持久性等級:
+#   none - 寫入臨時檔後改名（不 fsync）
+#   file - 另外對檔案 fsync（預設）
+#   full - 另外對所在目錄 fsync，確保改名本身也已落盤
+FILE_DURABILITY_LEVELS = ('none', 'file', 'full')
+FILE_DURABILITY = os.environ.get('VIBE_FILE_DURABILITY', 'file')
+if FILE_DURABILITY not in FILE_DURABILITY_LEVELS:
+    logger.warning(f"未知的持久性等級 {FILE_DURABILITY}，改用 file")
+    FILE_DURABILITY = 'file'
+
+# 新檔案的權限，與 open() 建立檔案時相同（0666 扣除 umask）；mkstemp 建立的臨時檔固定為 0600。
+# umask 只能以設定的方式讀取，因此在匯入時（尚未有其他執行緒）讀取一次
+_umask = os.umask(0o022)
+os.umask(_umask)
+NEW_FILE_MODE = 0o666 & ~_umask
+
+# 伺服器模式：production 使用多執行緒伺服器（已安裝 waitress 時優先使用），development 使用含重載與除錯器的開發伺服器。
+# 工作目錄、編輯緩衝區與 LLM 工作佇列都存在行程內，因此以多執行緒而非多行程擴充
+SERVER_MODE = os.environ.get('VIBE_SERVER_MODE', 'production')
+SERVER_HOST = os.environ.get('VIBE_HOST', 'localhost')
+SERVER_PORT = int(os.environ.get('VIBE_PORT', '5487'))
+SERVER_THREADS = int(os.environ.get('VIBE_THREADS', '16'))
+# 收到 SIGTERM/SIGINT 後等待進行中的請求完成的秒數
+SHUTDOWN_TIMEOUT = float(os.environ.get('VIBE_SHUTDOWN_TIMEOUT', '10'))
+OPEN_BROWSER = os.environ.get('VIBE_OPEN_BROWSER', '1') != '0'
+
+# 靜態資源：常駐記憶體的檔案大小上限、壓縮的最小大小、可壓縮的類型，以及後備目錄中允許提供的副檔名
+STATIC_MAX_CACHED_BYTES = 5 * 1024 * 1024
+STATIC_MIN_COMPRESS_BYTES = 1024
+STATIC_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+STATIC_FALLBACK_EXTENSIONS = {'.html', '.css', '.js', '.ico', '.png', '.svg', '.jpg', '.gif', '.woff', '.woff2'}
+# 檔名含內容雜湊的資源永遠不變，可長期快取；其他資源每次都要向伺服器確認
+STATIC_IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+STATIC_REVALIDATE_CACHE = 'no-cache'
+
+def load_shared_module(name):
+    """載入與 vibe-coding-tool 共用的 shared/<name>.py；shared 不是套件，因此以檔案路徑載入"""
+    module_name = f'vibe_shared_{name}'
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(SHARED_DIR, f'{name}.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+# 工作目錄的掃描與檔案索引由 shared/workspace.py 提供，與 vibe-coding-tool 共用
+shared_workspace = load_shared_module('workspace')
+load_gitignore_patterns = shared_workspace.load_gitignore_patterns
+is_ignored = shared_workspace.is_ignored
+scan_directory = shared_workspace.scan_directory
+
+def matches_extension(filename, extensions):
+    """以集合查詢判斷檔案副檔名是否受支援"""
+    return extensions is None or os.path.splitext(filename)[1] in extensions
+
+def get_file_list(directory, extensions=None):
+    """獲取指定目錄下的所有檔案清單（略過忽略的目錄）"""
+    if extensions is not None:
+        extensions = frozenset(extensions)
+    ignore_patterns = load_gitignore_patterns(directory)
+    file_list = []
+    pending = ['']
+    
+    while pending:
+        relative_dir = pending.pop()
+        try:
+            _, files, dirs = scan_directory(directory, relative_dir,
+                                            lambda name: matches_extension(name, extensions), ignore_patterns)
+        except OSError:
+            continue
+        
+        for name in files:
+            file_list.append(f"{relative_dir}/{name}" if relative_dir else name)
+        for name in dirs:
+            pending.append(f"{relative_dir}/{name}" if relative_dir else name)
+    
+    return file_list
+
+class WorkspaceIndex(shared_workspace.WorkspaceIndex):
+    """工作目錄的檔案索引，只收錄副檔名在 extensions 中的檔案（None 表示全部）"""
+    
+    def __init__(self, directory, extensions=None, refresh_interval=INDEX_REFRESH_INTERVAL):
+        self.extensions = frozenset(extensions) if extensions is not None else None
+        super().__init__(directory, lambda name: matches_extension(name, self.extensions), refresh_interval)
+
+class SnapshotStore:
+    """以內容雜湊定址的檔案快照：相同內容只儲存一次，依相對路徑與版本號查詢"""
+    
+    def __init__(self, directory, compress=SNAPSHOT_COMPRESS, max_bytes=MAX_SNAPSHOT_BYTES,
+                 max_versions=MAX_SNAPSHOT_VERSIONS):
+        self.directory = directory
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()   # 雜湊 -> 儲存大小，依最近使用排序
+        self._refs = {}               # 雜湊 -> 被多少個版本引用
+        self._history = {}            # 相對路徑 -> [(版本號, 雜湊), ...]
+        self._next_version = {}       # 相對路徑 -> 下一個版本號
+        self._total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+    
+    @staticmethod
+    def _key(relative_path):
+        return os.path.normpath(relative_path).replace(os.sep, '/')
+    
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+    
+    def _write_blob(self, digest, data):
+        blob_path = self._blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        stored = zlib.compress(data, 1) if self.compress else data
+        atomic_write(blob_path, stored, durability='none')
+        return len(stored)
+    
+    def _read_blob(self, digest):
+        with open(self._blob_path(digest), 'rb') as f:
+            stored = f.read()
+        return zlib.decompress(stored) if self.compress else stored
+    
+    def _release(self, digest):
+        """減少引用次數，沒有任何版本引用時刪除內容"""
+        self._refs[digest] -= 1
+        if self._refs[digest] > 0:
+            return
+        del self._refs[digest]
+        self._total_bytes -= self._blobs.pop(digest, 0)
+        try:
+            os.unlink(self._blob_path(digest))
+        except OSError:
+            pass
+    
+    def record(self, relative_path, data, digest=None):
+        """記錄檔案內容；與最新版本相同時不寫入，回傳 (版本號, 雜湊)。digest 為已算好的 SHA-256"""
+        key = self._key(relative_path)
+        digest = digest or hashlib.sha256(data).hexdigest()
+        
+        with self._lock:
+            history = self._history.get(key)
+            if history and history[-1][1] == digest:
+                self._blobs.move_to_end(digest)
+                return history[-1]
+            is_new_blob = digest not in self._blobs
+        
+        # 在鎖外寫入磁碟；同時寫入相同內容時以原子改名確保結果一致
+        size = self._write_blob(digest, data) if is_new_blob else 0
+        
+        with self._lock:
+            if digest not in self._blobs:
+                self._blobs[digest] = size
+                self._total_bytes += size
+            self._blobs.move_to_end(digest)
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+            
+            version = self._next_version.get(key, 1)
+            self._next_version[key] = version + 1
+            history = self._history.setdefault(key, [])
+            history.append((version, digest))
+            
+            # 每個路徑只保留最近的幾個版本
+            while len(history) > self.max_versions:
+                _, old_digest = history.pop(0)
+                self._release(old_digest)
+            
+            self._evict()
+            return version, digest
+    
+    def _evict(self):
+        """總大小超過上限時，移除最久未使用且不是任何路徑最新版本的內容"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        
+        protected = {history[-1][1] for history in self._history.values() if history}
+        for digest in list(self._blobs):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if digest in protected:
+                continue
+            for key, history in self._history.items():
+                kept = [entry for entry in history if entry[1] != digest]
+                removed = len(history) - len(kept)
+                if removed:
+                    self._history[key] = kept
+                    for _ in range(removed):
+                        self._release(digest)
+    
+    def get(self, relative_path, version=None):
+        """取得指定版本（預設為最新版本）的內容，不存在時回傳 None"""
+        key = self._key(relative_path)
+        with self._lock:
+            history = self._history.get(key)
+            if not history:
+                return None
+            if version is None:
+                digest = history[-1][1]
+            else:
+                digest = next((d for v, d in history if v == version), None)
+                if digest is None:
+                    return None
+            self._blobs.move_to_end(digest)
+        
+        try:
+            return self._read_blob(digest)
+        except OSError:
+            return None
+    
+    def versions(self, relative_path):
+        """取得路徑已記錄的版本清單"""
+        with self._lock:
+            return [{'version': v, 'hash': d} for v, d in self._history.get(self._key(relative_path), [])]
+    
+    def stats(self):
+        with self._lock:
+            return {'blobs': len(self._blobs), 'bytes': self._total_bytes,
+                    'max_bytes': self.max_bytes, 'paths': len(self._history)}
+
+def atomic_write(file_path, content, durability=None):
+    """以原子方式寫入檔案：先寫入同目錄的臨時檔，再改名覆蓋原檔，讀取端不會看到寫到一半的內容
+    
+    file_path 為符號連結時寫入連結指向的檔案，連結本身保持不變。
+    """
+    durability = durability or FILE_DURABILITY
+    file_path = os.path.realpath(file_path)
+    directory = os.path.dirname(file_path)
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(file_path)}.", suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if durability != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        
+        # 保留原檔的權限設定；新檔案依 umask 設定
+        try:
+            os.chmod(temp_path, os.stat(file_path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(temp_path, NEW_FILE_MODE)
+        
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    
+    if durability == 'full' and hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def is_path_safe(base_path, requested_path):
+    """確保請求的路徑在基礎路徑內，防止路徑遍歷攻擊"""
+    # 獲取規範化的絕對路徑
+    base_abs = os.path.abspath(base_path)
+    req_abs = os.path.abspath(os.path.join(base_path, requested_path))
+    
+    # 檢查請求的路徑是否以基礎路徑開頭
+    return req_abs.startswith(base_abs)
+
+class WriteBehindSaver:
+    """延遲寫回的保存排程器：同一路徑的多次更新會合併，執行緒只在下一個保存到期時才醒來"""
+    
+    def __init__(self, save_func, delay=AUTO_SAVE_INTERVAL):
+        self.save_func = save_func
+        self.delay = delay
+        self._heap = []   # (到期時間, 序號, 路徑)，過期的項目在取出時略過
+        self._due = {}    # 路徑 -> 目前有效的到期時間
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+    
+    def schedule(self, path, delay=None):
+        """安排保存；在到期前再次更新同一路徑會把保存時間往後延"""
+        due = time.monotonic() + (self.delay if delay is None else delay)
+        with self._cond:
+            self._due[path] = due
+            heapq.heappush(self._heap, (due, next(self._seq), path))
+            # 只有新項目成為最早到期時才需要喚醒執行緒
+            if self._heap[0][2] == path:
+                self._cond.notify()
+    
+    def cancel(self, path):
+        """取消尚未執行的保存（例如已被強制保存）"""
+        with self._cond:
+            self._due.pop(path, None)
+    
+    def pending(self):
+        """取得等待保存的路徑"""
+        with self._cond:
+            return list(self._due)
+    
+    def start(self):
+        """啟動後台保存線程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind-saver', daemon=True)
+            self._thread.start()
+    
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stopped
+    
+    def _next_due_path(self):
+        """等待直到有保存到期，回傳該路徑；停止時回傳 None"""
+        with self._cond:
+            while not self._stopped:
+                # 丟棄已被更新或取消的舊項目
+                while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                
+                due, _, path = self._heap[0]
+                timeout = due - time.monotonic()
+                if timeout <= 0:
+                    heapq.heappop(self._heap)
+                    del self._due[path]
+                    return path
+                self._cond.wait(timeout)
+            return None
+    
+    def _run(self):
+        while True:
+            path = self._next_due_path()
+            if path is None:
+                return
+            self._save(path)
+    
+    def _save(self, path):
+        try:
+            self.save_func(path)
+        except Exception as e:
+            logger.error(f"自動保存檔案 {path} 時發生錯誤: {str(e)}")
+            # 保存失敗時稍後重試
+            if not self._stopped:
+                self.schedule(path)
+    
+    def flush_all(self):
+        """立即保存所有等待中的檔案"""
+        with self._cond:
+            paths = list(self._due)
+            self._due.clear()
+            self._heap.clear()
+        
+        for path in paths:
+            self._save(path)
+        return len(paths)
+    
+    def stop(self):
+        """停止後台線程並保存所有等待中的檔案"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        flushed = self.flush_all()
+        if flushed:
+            logger.info(f"關閉前已保存 {flushed} 個檔案")
+
+class VersionConflictError(Exception):
+    """編輯所依據的版本已不是最新版本"""
+    
+    def __init__(self, version):
+        super().__init__('檔案已被其他編輯更新，請重新載入後再試')
+        self.version = version
+
+def apply_line_edits(content, edits):
+    """依序套用行編輯：每個編輯以 start（從 0 開始的行號）、delete（刪除行數）與 lines（插入的行）描述
+    
+    行以 '\n' 分隔，與編輯器內容的 split('\n') 一一對應；格式錯誤或超出範圍時拋出 ValueError。
+    """
+    lines = content.split('\n')
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise ValueError('無效的編輯操作')
+        start = edit.get('start')
+        delete = edit.get('delete', 0)
+        inserted = edit.get('lines', [])
+        if (not isinstance(start, int) or not isinstance(delete, int) or not isinstance(inserted, list)
+                or not all(isinstance(line, str) for line in inserted)):
+            raise ValueError('無效的編輯操作')
+        if start < 0 or delete < 0 or start + delete > len(lines):
+            raise ValueError(f'編輯範圍超出檔案行數: {start}+{delete} > {len(lines)}')
+        lines[start:start + delete] = inserted
+    return '\n'.join(lines)
+
+class EditBuffer:
+    """單一檔案尚未寫回磁碟的編輯內容"""
+    __slots__ = ('content', 'version', 'size', 'updated_at')
+    
+    def __init__(self, content, version):
+        self.content = content
+        self.version = version
+        # 粗略估計 UTF-8 大小，避免每次更新都重新編碼整個內容
+        self.size = len(content) if content.isascii() else len(content) * 4
+        self.updated_at = time.time()
+
+class BufferStore:
+    """執行緒安全的編輯緩衝區：以鎖分段保護各路徑的讀寫，並限制總記憶體用量"""
+    
+    def __init__(self, flush_func=None, max_bytes=MAX_BUFFER_BYTES, stripes=BUFFER_LOCK_STRIPES):
+        self.flush_func = flush_func
+        self.max_bytes = max_bytes
+        # 修改緩衝區用的分段鎖，以及序列化同一路徑寫回磁碟用的分段鎖
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._save_stripes = [threading.Lock() for _ in range(stripes)]
+        # 保護下列共用狀態；取得順序固定為 分段鎖 -> _meta_lock
+        self._meta_lock = threading.Lock()
+        self._buffers = OrderedDict()   # 路徑 -> EditBuffer，依最後更新時間排序
+        self._versions = {}             # 路徑 -> 最新版本號，緩衝區移除後仍保留以確保版本遞增
+        self._total_bytes = 0
+        self._metrics = {'updates': 0, 'delta_updates': 0, 'saves': 0, 'stale_saves': 0,
+                         'evictions': 0, 'discards': 0, 'conflicts': 0}
+    
+    @staticmethod
+    def _key(path):
+        return os.path.normpath(path)
+    
+    def lock_for(self, path):
+        """取得路徑對應的分段鎖"""
+        return self._stripes[hash(self._key(path)) % len(self._stripes)]
+    
+    def _count(self, metric):
+        with self._meta_lock:
+            self._metrics[metric] += 1
+    
+    def _set_buffer(self, key, buffer):
+        """在 _meta_lock 下替換緩衝區並更新記憶體統計"""
+        old = self._buffers.pop(key, None)
+        if old is not None:
+            self._total_bytes -= old.size
+        if buffer is not None:
+            self._buffers[key] = buffer
+            self._total_bytes += buffer.size
+    
+    def update(self, path, content, base_version=None):
+        """更新緩衝區內容，回傳新的版本號；指定 base_version 且不是目前版本時拋出 VersionConflictError"""
+        key = self._key(path)
+        with self.lock_for(key):
+            with self._meta_lock:
+                if base_version is not None and base_version != self._versions.get(key, 0):
+                    self._metrics['conflicts'] += 1
+                    raise VersionConflictError(self._versions.get(key, 0))
+                version = self._versions.get(key, 0) + 1
+                self._versions[key] = version
+                self._set_buffer(key, EditBuffer(content, version))
+                self._metrics['updates'] += 1
+        
+        self._enforce_limit(exclude=key)
+        return version
+    
+    def apply_edits(self, path, base_version, edits, load_base):
+        """把行編輯套用到 base_version 的內容上，回傳新的版本號
+        
+        沒有未保存的緩衝區時以 load_base() 讀取磁碟內容作為基準；
+        base_version 不是目前版本時拋出 VersionConflictError，不做任何修改。
+        """
+        key = self._key(path)
+        with self.lock_for(key):
+            with self._meta_lock:
+                current_version = self._versions.get(key, 0)
+                buffer = self._buffers.get(key)
+                if base_version != current_version:
+                    self._metrics['conflicts'] += 1
+                    raise VersionConflictError(current_version)
+            
+            # 其他路徑的更新不受影響；同一路徑的更新由分段鎖序列化，讀取磁碟期間版本不會改變
+            base = buffer.content if buffer is not None else load_base()
+            content = apply_line_edits(base, edits)
+            
+            with self._meta_lock:
+                version = current_version + 1
+                self._versions[key] = version
+                self._set_buffer(key, EditBuffer(content, version))
+                self._metrics['updates'] += 1
+                self._metrics['delta_updates'] += 1
+        
+        self._enforce_limit(exclude=key)
+        return version
+    
+    def read(self, path, load_disk):
+        """回傳 (內容, 版本號, 是否來自緩衝區)；沒有未保存的變更時以 load_disk() 讀取磁碟內容
+        
+        讀取磁碟期間持有寫回用的分段鎖，讀到的磁碟內容一定對應回傳的版本號。
+        """
+        key = self._key(path)
+        with self._save_stripes[hash(key) % len(self._save_stripes)]:
+            with self._meta_lock:
+                buffer = self._buffers.get(key)
+                version = self._versions.get(key, 0)
+            if buffer is not None:
+                return buffer.content, version, True
+            return load_disk(), version, False
+    
+    def get(self, path):
+        """取得緩衝區 (內容, 版本號)，沒有未保存的變更時回傳 None"""
+        with self._meta_lock:
+            buffer = self._buffers.get(self._key(path))
+            return (buffer.content, buffer.version) if buffer else None
+    
+    def version(self, path):
+        """取得路徑目前的版本號"""
+        with self._meta_lock:
+            return self._versions.get(self._key(path), 0)
+    
+    def is_dirty(self, path):
+        with self._meta_lock:
+            return self._key(path) in self._buffers
+    
+    def dirty_paths(self):
+        with self._meta_lock:
+            return list(self._buffers)
+    
+    def mark_saved(self, path, version):
+        """寫回完成後移除緩衝區；若寫入期間已有更新的版本則保留"""
+        key = self._key(path)
+        with self._meta_lock:
+            buffer = self._buffers.get(key)
+            if buffer is not None and buffer.version == version:
+                self._set_buffer(key, None)
+                self._metrics['saves'] += 1
+                return True
+            self._metrics['stale_saves'] += 1
+            return False
+    
+    def discard(self, path):
+        """捨棄未保存的變更；版本號遞增，依據被捨棄內容的編輯會被視為衝突"""
+        key = self._key(path)
+        with self.lock_for(key):
+            with self._meta_lock:
+                if key in self._buffers:
+                    self._set_buffer(key, None)
+                    self._versions[key] = self._versions.get(key, 0) + 1
+                    self._metrics['discards'] += 1
+    
+    def touch(self, path):
+        """磁碟內容被緩衝區以外的途徑修改時遞增版本號"""
+        key = self._key(path)
+        with self.lock_for(key):
+            with self._meta_lock:
+                self._versions[key] = self._versions.get(key, 0) + 1
+    
+    def write_through(self, path, load_disk, write):
+        """以緩衝區（沒有時為 load_disk() 讀到的磁碟內容）為基準直接寫入磁碟，回傳 write 的結果
+        
+        write(內容) 回傳 (結果, 是否已寫入)。整個過程持有修改與寫回用的分段鎖，同一路徑的編輯與
+        自動保存都會等待，不會在寫入後以較舊的緩衝區覆蓋；寫入後移除緩衝區並遞增版本號。
+        """
+        key = self._key(path)
+        with self.lock_for(key), self._save_stripes[hash(key) % len(self._save_stripes)]:
+            with self._meta_lock:
+                buffer = self._buffers.get(key)
+            result, written = write(buffer.content if buffer is not None else load_disk())
+            if written:
+                with self._meta_lock:
+                    self._set_buffer(key, None)
+                    self._versions[key] = self._versions.get(key, 0) + 1
+            return result
+    
+    def save(self, path):
+        """把緩衝區寫回磁碟，回傳是否有寫入"""
+        key = self._key(path)
+        # 寫入磁碟期間不阻擋新的更新；版本號確保較新的內容不會被舊的寫入標記為已保存
+        with self._save_stripes[hash(key) % len(self._save_stripes)]:
+            current = self.get(key)
+            if current is None:
+                return False
+            content, version = current
+            
+            # 檢查檔案是否仍然存在
+            if not os.path.exists(key):
+                logger.warning(f"檔案已不存在，捨棄未保存的變更: {key}")
+                self.mark_saved(key, version)
+                return False
+            
+            atomic_write(key, content)
+            self.mark_saved(key, version)
+            return True
+    
+    def _enforce_limit(self, exclude=None):
+        """總用量超過上限時，先寫回最久未更新的緩衝區再釋放記憶體"""
+        attempted = set()
+        while True:
+            with self._meta_lock:
+                if self._total_bytes <= self.max_bytes:
+                    return
+                victim = next((key for key in self._buffers
+                               if key != exclude and key not in attempted), None)
+            if victim is None:
+                return
+            
+            attempted.add(victim)
+            try:
+                if self.flush_func:
+                    self.flush_func(victim)
+                else:
+                    self.save(victim)
+                self._count('evictions')
+            except Exception as e:
+                logger.error(f"釋放緩衝區 {victim} 時寫回失敗: {str(e)}")
+    
+    def stats(self):
+        """取得緩衝區統計資料"""
+        with self._meta_lock:
+            stats = dict(self._metrics)
+            stats.update({
+                'buffers': len(self._buffers),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'tracked_paths': len(self._versions)
+            })
+            return stats
+
+def save_buffered_file(full_path):
+    """把緩衝區內容寫回檔案"""
+    if buffer_store.save(full_path):
+        logger.info(f"自動保存檔案: {full_path}")
+
+def flush_buffered_file(full_path):
+    """記憶體不足時寫回緩衝區，並取消排程中的保存"""
+    auto_saver.cancel(full_path)
+    save_buffered_file(full_path)
+
+# 編輯中檔案的緩衝區
+buffer_store = BufferStore(flush_func=flush_buffered_file)
+
+# 開啟檔案時的內容快照，作為差異比較的基準
+snapshot_store = SnapshotStore(os.path.join(TEMP_DIR, 'snapshots'))
+
+# 自動保存排程器，關閉程式時保存所有未寫入的變更
+auto_saver = WriteBehindSaver(save_buffered_file)
+# 在建立應用時啟動，由外部 WSGI 伺服器載入時同樣會寫回
+auto_saver.start()
+atexit.register(auto_saver.stop)
+
+# 各語言的符號定義：副檔名 -> [(種類, 正規表示式)]，第一個群組為符號名稱
+_C_LIKE_FUNCTION = r'^(?:[\w\*&:<>,]+\s+)+\**(\w+)\s*\([^;]*$'
+SYMBOL_PATTERNS = {
+    '.py': [('class', r'^\s*class\s+(\w+)'), ('function', r'^\s*(?:async\s+)?def\s+(\w+)')],
+    '.js': [('class', r'\bclass\s+(\w+)'), ('function', r'\bfunction\s*\*?\s+(\w+)'),
+            ('function', r'\b(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s*)?(?:function\b|\([^)]*\)\s*=>|\w+\s*=>)')],
+    '.ts': [('interface', r'\binterface\s+(\w+)'), ('type', r'^\s*(?:export\s+)?type\s+(\w+)\s*=')],
+    '.java': [('class', r'\b(?:class|interface|enum)\s+(\w+)'),
+              ('method', r'^\s*(?:(?:public|private|protected|static|final|abstract|synchronized)\s+)+[\w<>\[\],\s]+?\s+(\w+)\s*\(')],
+    '.c': [('struct', r'^\s*(?:typedef\s+)?(?:struct|union|enum)\s+(\w+)'), ('function', _C_LIKE_FUNCTION)],
+    '.cpp': [('class', r'^\s*(?:class|struct|namespace)\s+(\w+)'), ('function', _C_LIKE_FUNCTION)],
+    '.go': [('function', r'^func\s+(?:\([^)]*\)\s*)?(\w+)'), ('type', r'^type\s+(\w+)')],
+    '.rs': [('function', r'\bfn\s+(\w+)'), ('type', r'\b(?:struct|enum|trait|mod)\s+(\w+)')],
+    '.rb': [('class', r'^\s*(?:class|module)\s+(\w+)'), ('method', r'^\s*def\s+(?:self\.)?(\w+[?!]?)')],
+    '.php': [('class', r'\b(?:class|interface|trait)\s+(\w+)'), ('function', r'\bfunction\s+(\w+)')],
+    '.swift': [('type', r'\b(?:class|struct|enum|protocol|extension)\s+(\w+)'), ('function', r'\bfunc\s+(\w+)')],
+    '.md': [('heading', r'^#{1,6}\s+(.+?)\s*#*$')],
+}
+SYMBOL_PATTERNS['.jsx'] = SYMBOL_PATTERNS['.js']
+SYMBOL_PATTERNS['.ts'] = SYMBOL_PATTERNS['.js'] + SYMBOL_PATTERNS['.ts']
+SYMBOL_PATTERNS['.tsx'] = SYMBOL_PATTERNS['.ts']
+SYMBOL_PATTERNS['.cs'] = SYMBOL_PATTERNS['.java']
+SYMBOL_PATTERNS = {ext: [(kind, re.compile(pattern)) for kind, pattern in patterns]
+                   for ext, patterns in SYMBOL_PATTERNS.items()}
+
+# 不會成為符號名稱的關鍵字（C 類語言的函式規則容易誤判控制敘述）
+SYMBOL_STOP_WORDS = frozenset(['if', 'for', 'while', 'switch', 'return', 'catch', 'sizeof', 'else', 'do', 'new'])
+
+def extract_symbols(path, text):
+    """擷取檔案中的函式、類別等定義，回傳 [(名稱, 種類, 行號)]"""
+    patterns = SYMBOL_PATTERNS.get(os.path.splitext(path)[1].lower())
+    if not patterns:
+        return []
+    
+    symbols = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        for kind, pattern in patterns:
+            match = pattern.search(line)
+            if match and match.group(1) not in SYMBOL_STOP_WORDS:
+                symbols.append((match.group(1), kind, line_number))
+                break
+    return symbols
+
+def extract_trigrams(text):
+    """取得文字（轉小寫後）中所有不跨行的三字元組"""
+    trigrams = set()
+    for line in text.lower().split('\n'):
+        trigrams.update(line[i:i + 3] for i in range(len(line) - 2))
+    return trigrams
+
+_REGEX_SPECIAL = set('.^$*+?{}[]()|\\')
+
+def regex_required_literals(pattern):
+    """找出符合正規表示式的文字一定包含的字面字串，用於以三字元組縮小候選檔案
+    
+    只處理最常見的情況；含有 | 時無法確定必要字串，回傳空清單。
+    """
+    if '|' in pattern:
+        return []
+    
+    literals = []
+    current = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            if escaped.isalnum():
+                # \w、\d、\b 等字元類別或錨點
+                literals.append(''.join(current))
+                current = []
+            else:
+                current.append(escaped)
+            i += 2
+            continue
+        
+        if char in '*?{':
+            # 前一個字元可能不出現
+            if current:
+                current.pop()
+            literals.append(''.join(current))
+            current = []
+            if char == '{':
+                i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif char == '[':
+            literals.append(''.join(current))
+            current = []
+            end = pattern.find(']', i + 2)
+            i = end if end != -1 else len(pattern)
+        elif char == '(':
+            # 群組可能是選擇性的（例如 (...)?），整個略過
+            literals.append(''.join(current))
+            current = []
+            depth = 0
+            while i < len(pattern):
+                if pattern[i] == '\\':
+                    i += 1
+                elif pattern[i] == '(':
+                    depth += 1
+                elif pattern[i] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            # 群組本身不產生必要字串，其後的量詞 (?、*、+、{m,n}) 一併略過，
+            # 否則 {1,3} 中的數字會被當成必要字串
+            if pattern[i + 1:i + 2] == '{':
+                end = pattern.find('}', i + 1)
+                i = end if end != -1 else len(pattern)
+            elif pattern[i + 1:i + 2] in ('?', '*', '+'):
+                i += 1
+        elif char in _REGEX_SPECIAL:
+            # + 之前的字元至少出現一次，但之後的字元不一定緊接著它；其他特殊字元同樣切斷字面字串
+            literals.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    literals.append(''.join(current))
+    return [literal for literal in literals if len(literal) >= 3]
+
+class SearchIndex:
+    """工作目錄的全文（三字元組倒排索引）與符號索引
+    
+    依 WorkspaceIndex 的檔案清單增量更新：只重新索引大小或 mtime 改變的檔案。
+    索引會保存到磁碟，重新啟動後只需重新索引有變更的檔案。
+    超過 SEARCH_MAX_FILE_SIZE 的檔案不建立三字元組，查詢時一律直接掃描；二進位檔不列入搜尋。
+    """
+    
+    def __init__(self, workspace_index, index_dir=SEARCH_INDEX_DIR):
+        self.workspace_index = workspace_index
+        self.directory = workspace_index.directory
+        digest = hashlib.sha1(self.directory.encode('utf-8')).hexdigest()[:16]
+        self.index_path = os.path.join(index_dir, f'{digest}.json.z') if index_dir else None
+        # 相對路徑 -> {'mtime', 'size', 'status', 'trigrams', 'symbols'}，status 為 indexed、large 或 binary
+        self._files = {}
+        # 三字元組 -> 含有它的檔案路徑集合
+        self._postings = {}
+        # 未建立三字元組、查詢時需直接掃描的大型檔案
+        self._large = set()
+        self._last_sync = 0
+        self._last_save = 0
+        self._dirty = False
+        # _lock 保護索引資料，只在讀取快照與併入結果時短暫持有；_sync_lock 確保同時只有一個更新
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        # 第一次建立完成前視為建立中
+        self.indexing = True
+        self._load()
+    
+    def _load(self):
+        """載入保存的索引，只保留工作目錄相同的索引"""
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+            if data.get('directory') != self.directory or data.get('version') != SEARCH_INDEX_VERSION:
+                return
+            for path, entry in data['files'].items():
+                entry['trigrams'] = set(entry['trigrams'])
+                entry['symbols'] = [tuple(symbol) for symbol in entry['symbols']]
+                self._add(path, entry)
+            logger.info(f"載入搜尋索引: {len(self._files)} 個檔案")
+        except Exception as e:
+            logger.warning(f"無法載入搜尋索引 {self.index_path}: {str(e)}")
+            self._files = {}
+            self._postings = {}
+    
+    def save(self):
+        """把索引寫入磁碟"""
+        if not self.index_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            files = {path: {'mtime': entry['mtime'], 'size': entry['size'], 'status': entry['status'],
+                            'trigrams': list(entry['trigrams']), 'symbols': entry['symbols']}
+                     for path, entry in self._files.items()}
+            self._dirty = False
+            self._last_save = time.time()
+        
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            data = json.dumps({'directory': self.directory, 'version': SEARCH_INDEX_VERSION, 'files': files},
+                              ensure_ascii=False)
+            atomic_write(self.index_path, zlib.compress(data.encode('utf-8'), 6), durability='none')
+        except OSError as e:
+            logger.warning(f"無法保存搜尋索引: {str(e)}")
+    
+    def _add(self, path, entry):
+        self._files[path] = entry
+        if entry['status'] == 'large':
+            self._large.add(path)
+        for trigram in entry['trigrams']:
+            self._postings.setdefault(trigram, set()).add(path)
+    
+    def _remove(self, path):
+        entry = self._files.pop(path, None)
+        if entry is None:
+            return
+        self._large.discard(path)
+        for trigram in entry['trigrams']:
+            postings = self._postings.get(trigram)
+            if postings is not None:
+                postings.discard(path)
+                if not postings:
+                    del self._postings[trigram]
+    
+    def _read_entry(self, path, stat):
+        """讀取單一檔案並建立索引項目；過大的檔案只記錄 mtime，二進位檔不列入搜尋"""
+        entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'status': 'indexed',
+                 'trigrams': set(), 'symbols': []}
+        if stat.st_size > SEARCH_MAX_FILE_SIZE:
+            entry['status'] = 'large'
+            return entry
+        try:
+            with open(os.path.join(self.directory, path), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return entry
+        if b'\0' in data[:8192]:
+            entry['status'] = 'binary'
+            return entry
+        text = data.decode('utf-8', errors='replace')
+        entry['trigrams'] = extract_trigrams(text)
+        entry['symbols'] = extract_symbols(path, text)
+        return entry
+    
+    def _merge(self, entries, removed=()):
+        """把讀取好的索引項目併入索引"""
+        with self._lock:
+            for path in removed:
+                self._remove(path)
+            for path, entry in entries.items():
+                self._remove(path)
+                self._add(path, entry)
+            if entries or removed:
+                self._dirty = True
+    
+    def sync(self, force=False, blocking=True):
+        """依目前的檔案清單更新索引，回傳重新索引的檔案數
+        
+        讀取檔案時不持有 _lock，每 SEARCH_SYNC_BATCH 個檔案併入一次，查詢可在更新期間使用已完成的部分；
+        blocking 為 False 時，若已有其他執行緒在更新則立即返回。
+        """
+        if not force and time.time() - self._last_sync < SEARCH_REFRESH_INTERVAL:
+            return 0
+        if not self._sync_lock.acquire(blocking=blocking):
+            return 0
+        return self._sync_locked()
+    
+    def _sync_locked(self):
+        """在已取得 _sync_lock 的情況下更新索引，結束時釋放鎖"""
+        try:
+            self.indexing = True
+            started = time.time()
+            paths = self.workspace_index.files()
+            current = set(paths)
+            with self._lock:
+                known = {path: (entry['mtime'], entry['size']) for path, entry in self._files.items()}
+            
+            removed = [path for path in known if path not in current]
+            updated = len(removed)
+            batch = {}
+            for path in paths:
+                try:
+                    stat = os.stat(os.path.join(self.directory, path))
+                except OSError:
+                    if path in known:
+                        removed.append(path)
+                    continue
+                if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                    batch[path] = self._read_entry(path, stat)
+                    updated += 1
+                    if len(batch) >= SEARCH_SYNC_BATCH:
+                        self._merge(batch)
+                        batch = {}
+            self._merge(batch, removed)
+            
+            self._last_sync = time.time()
+            if updated:
+                logger.info(f"更新搜尋索引: {updated} 個檔案，耗時 {time.time() - started:.2f} 秒")
+        finally:
+            self.indexing = False
+            self._sync_lock.release()
+        
+        if self._dirty and time.time() - self._last_save >= SEARCH_INDEX_SAVE_INTERVAL:
+            self.save()
+        return updated
+    
+    def refresh(self):
+        """查詢前呼叫：必要時在背景執行緒重新索引有變更的檔案，查詢本身只讀取目前的索引
+        
+        第一次建立由 build_indexes 負責；已有更新在進行或距上次更新未滿 SEARCH_REFRESH_INTERVAL 時不做事。
+        """
+        if not self._last_sync or time.time() - self._last_sync < SEARCH_REFRESH_INTERVAL:
+            return
+        if self._sync_lock.acquire(blocking=False):
+            threading.Thread(target=self._sync_locked, daemon=True).start()
+    
+    def _candidates(self, literals):
+        """回傳可能符合的檔案路徑；沒有可用的三字元組時回傳所有非二進位檔，大型檔案一律列入"""
+        candidates = None
+        for literal in literals:
+            literal = literal.lower()
+            for i in range(len(literal) - 2):
+                postings = self._postings.get(literal[i:i + 3], set())
+                candidates = set(postings) if candidates is None else candidates & postings
+                if not candidates:
+                    return set(self._large)
+        if candidates is None:
+            return {path for path, entry in self._files.items() if entry['status'] != 'binary'}
+        return candidates | self._large
+    
+    def search_text(self, query, regex=False, case_sensitive=False, path_glob=None):
+        """搜尋檔案內容，回傳 (依分數排序的結果, 是否完整搜尋)"""
+        flags = 0 if case_sensitive else re.IGNORECASE
+        pattern = re.compile(query if regex else re.escape(query), flags)
+        literals = regex_required_literals(query) if regex else [query]
+        
+        with self._lock:
+            candidates = sorted(self._candidates(literals))
+            symbols = {path: self._files[path]['symbols'] for path in candidates}
+        if path_glob:
+            candidates = [path for path in candidates if fnmatch.fnmatch(path, path_glob)]
+        
+        deadline = time.monotonic() + SEARCH_TIMEOUT
+        results = []
+        complete = True
+        for path in candidates:
+            if time.monotonic() > deadline:
+                complete = False
+                break
+            try:
+                with open(os.path.join(self.directory, path), 'r', encoding='utf-8', errors='replace') as f:
+                    text = f.read()
+            except OSError:
+                continue
+            
+            matches = []
+            match_count = 0
+            for line_number, line in enumerate(text.splitlines(), 1):
+                ranges = [[m.start(), m.end()] for m in pattern.finditer(line) if m.end() > m.start()]
+                if not ranges:
+                    continue
+                match_count += 1
+                if len(matches) < SEARCH_MAX_LINES_PER_FILE:
+                    matches.append({'line': line_number, 'text': line[:300], 'ranges': ranges})
+            if not match_count:
+                continue
+            
+            # 排序：檔名符合 > 定義了同名符號 > 符合的行數
+            defined = [{'name': name, 'kind': kind, 'line': line}
+                       for name, kind, line in symbols.get(path, []) if pattern.fullmatch(name)]
+            score = match_count + 10 * len(defined)
+            if pattern.search(os.path.basename(path)):
+                score += 20
+            results.append({'path': path, 'score': score, 'match_count': match_count,
+                            'matches': matches, 'definitions': defined})
+        
+        results.sort(key=lambda r: (-r['score'], r['path']))
+        return results, complete
+    
+    def search_symbols(self, query, path_glob=None):
+        """依名稱搜尋符號：完全符合 > 前綴 > 包含，同等級時較短的名稱優先"""
+        needle = query.lower()
+        results = []
+        with self._lock:
+            for path, entry in self._files.items():
+                if path_glob and not fnmatch.fnmatch(path, path_glob):
+                    continue
+                for name, kind, line in entry['symbols']:
+                    lowered = name.lower()
+                    if needle not in lowered:
+                        continue
+                    rank = 0 if lowered == needle else 1 if lowered.startswith(needle) else 2
+                    results.append((rank, len(name), path, line,
+                                    {'name': name, 'kind': kind, 'path': path, 'line': line}))
+        results.sort(key=lambda r: r[:4])
+        return [r[4] for r in results]
+    
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'trigrams': len(self._postings),
+                    'symbols': sum(len(e['symbols']) for e in self._files.values()),
+                    'large_files': len(self._large), 'indexing': self.indexing}
+
+try:
+    import numpy
+except ImportError:
+    # 未安裝 numpy 時不支援嵌入向量檢索
+    numpy = None
+
+# 本機嵌入模型：名稱 -> 函式（文字清單 -> 向量清單）
+EMBEDDING_MODELS = {}
+
+def register_embedding_model(name, embed_func):
+    """註冊本機嵌入模型，以 VIBE_EMBEDDING_MODEL 指定名稱啟用"""
+    EMBEDDING_MODELS[name] = embed_func
+
+class EmbeddingMatrix:
+    """以 NumPy memmap 保存區塊的單位向量，查詢時一次內積計算所有區塊的相似度
+    
+    刪除的區塊所在的列會放回空閒清單重複使用；容量不足時加倍並複製到新的檔案。
+    """
+    
+    def __init__(self, path, embed_func, capacity=1024):
+        self.path = path
+        self.embed_func = embed_func
+        self.dim = None
+        self.capacity = capacity
+        self.matrix = None
+        self._rows = {}         # 區塊 ID -> 列
+        self._row_chunks = {}   # 列 -> 區塊 ID
+        self._free_rows = []
+        self._next_row = 0
+    
+    def _allocate(self, dim, capacity):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        matrix = numpy.memmap(self.path + '.tmp', dtype=numpy.float32, mode='w+', shape=(capacity, dim))
+        if self.matrix is not None:
+            matrix[:self._next_row] = self.matrix[:self._next_row]
+            del self.matrix
+        os.replace(self.path + '.tmp', self.path)
+        self.matrix = matrix
+        self.dim = dim
+        self.capacity = capacity
+    
+    def embed(self, texts):
+        """計算文字的單位向量；不修改矩陣，可在不持有索引鎖時呼叫"""
+        vectors = numpy.asarray(self.embed_func(texts), dtype=numpy.float32)
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / numpy.where(norms == 0, 1, norms)
+    
+    def add(self, chunk_ids, vectors):
+        if not chunk_ids:
+            return
+        if self.matrix is None:
+            self._allocate(vectors.shape[1], self.capacity)
+        
+        for chunk_id, vector in zip(chunk_ids, vectors):
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                if self._next_row >= self.capacity:
+                    self._allocate(self.dim, self.capacity * 2)
+                row = self._next_row
+                self._next_row += 1
+            self.matrix[row] = vector
+            self._rows[chunk_id] = row
+            self._row_chunks[row] = chunk_id
+    
+    def remove(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            row = self._rows.pop(chunk_id, None)
+            if row is not None:
+                del self._row_chunks[row]
+                self.matrix[row] = 0
+                self._free_rows.append(row)
+    
+    def scores(self, text):
+        """回傳 {區塊 ID: 餘弦相似度}"""
+        if self.matrix is None or not self._rows:
+            return {}
+        query = numpy.asarray(self.embed_func([text])[0], dtype=numpy.float32)
+        norm = numpy.linalg.norm(query)
+        if norm == 0:
+            return {}
+        similarities = self.matrix[:self._next_row] @ (query / norm)
+        return {chunk_id: float(similarities[row]) for row, chunk_id in self._row_chunks.items()}
+
+class RelatedFileIndex:
+    """以 BM25（可選擇再加上本機嵌入向量）依提示詞檢索相關的檔案區塊
+    
+    檔案依 RETRIEVAL_CHUNK_LINES 行切塊；與 SearchIndex 相同，只重新索引大小或 mtime 改變的檔案，
+    讀取與切塊時不持有查詢用的鎖。
+    """
+    
+    def __init__(self, workspace_index, embedding_model=RETRIEVAL_EMBEDDING_MODEL, index_dir=SEARCH_INDEX_DIR):
+        self.workspace_index = workspace_index
+        self.directory = workspace_index.directory
+        self._files = {}      # 相對路徑 -> {'mtime', 'size', 'chunks': [區塊 ID]}
+        self._chunks = {}     # 區塊 ID -> (路徑, 起始行, 結束行, 詞數)
+        self._postings = {}   # 詞 -> {區塊 ID: 詞頻}
+        self._total_length = 0
+        self._chunk_ids = itertools.count()
+        self._last_sync = 0
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        # 第一次建立完成前視為建立中
+        self.indexing = True
+        
+        self.embeddings = None
+        if embedding_model:
+            if numpy is None:
+                logger.warning("未安裝 numpy，停用嵌入向量檢索")
+            elif embedding_model not in EMBEDDING_MODELS:
+                logger.warning(f"未註冊的嵌入模型 {embedding_model}，停用嵌入向量檢索")
+            else:
+                digest = hashlib.sha1(self.directory.encode('utf-8')).hexdigest()[:16]
+                self.embeddings = EmbeddingMatrix(os.path.join(index_dir, f'{digest}.vectors'),
+                                                  EMBEDDING_MODELS[embedding_model])
+    
+    def _remove(self, path):
+        entry = self._files.pop(path, None)
+        if entry is None:
+            return
+        for chunk_id in entry['chunks']:
+            _, _, _, length = self._chunks.pop(chunk_id)
+            self._total_length -= length
+        removed = set(entry['chunks'])
+        for term in entry['terms']:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            for chunk_id in removed & postings.keys():
+                del postings[chunk_id]
+            if not postings:
+                del self._postings[term]
+        if self.embeddings is not None:
+            self.embeddings.remove(entry['chunks'])
+    
+    def _read_file(self, path, stat):
+        """讀取並切塊單一檔案，回傳索引項目所需的資料；不修改索引，可在不持有鎖時呼叫"""
+        parsed = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'chunks': [], 'vectors': None}
+        if stat.st_size > SEARCH_MAX_FILE_SIZE:
+            return parsed
+        try:
+            with open(os.path.join(self.directory, path), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return parsed
+        if b'\0' in data[:8192]:
+            return parsed
+        
+        lines = data.decode('utf-8', errors='replace').splitlines()
+        # 路徑中的詞加入每個區塊，讓提到檔名或目錄名的提示詞也能找到該檔案
+        path_terms = extract_terms(path)
+        texts = []
+        for start in range(0, max(len(lines), 1), RETRIEVAL_CHUNK_LINES):
+            text = '\n'.join(lines[start:start + RETRIEVAL_CHUNK_LINES])
+            terms = extract_terms(text) + path_terms
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            parsed['chunks'].append((start + 1, min(start + RETRIEVAL_CHUNK_LINES, len(lines)), counts, len(terms)))
+            texts.append(f'{path}\n{text}')
+        
+        if self.embeddings is not None:
+            try:
+                parsed['vectors'] = self.embeddings.embed(texts)
+            except Exception as e:
+                logger.warning(f"計算 {path} 的嵌入向量時發生錯誤: {str(e)}")
+        return parsed
+    
+    def _add(self, path, parsed):
+        """在 _lock 下把 _read_file 的結果加入索引"""
+        self._remove(path)
+        entry = {'mtime': parsed['mtime'], 'size': parsed['size'], 'chunks': [], 'terms': set()}
+        self._files[path] = entry
+        for start_line, end_line, counts, length in parsed['chunks']:
+            chunk_id = next(self._chunk_ids)
+            self._chunks[chunk_id] = (path, start_line, end_line, length)
+            self._total_length += length
+            entry['chunks'].append(chunk_id)
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[chunk_id] = count
+            entry['terms'].update(counts)
+        if parsed['vectors'] is not None:
+            self.embeddings.add(entry['chunks'], parsed['vectors'])
+    
+    def _merge(self, batch, removed=()):
+        with self._lock:
+            for path in removed:
+                self._remove(path)
+            for path, parsed in batch.items():
+                self._add(path, parsed)
+    
+    def sync(self, force=False, blocking=True):
+        """依目前的檔案清單更新索引，回傳重新索引的檔案數
+        
+        與 SearchIndex.sync 相同，每 SEARCH_SYNC_BATCH 個檔案併入一次；blocking 為 False 時不等待進行中的更新。
+        """
+        if not force and time.time() - self._last_sync < SEARCH_REFRESH_INTERVAL:
+            return 0
+        if not self._sync_lock.acquire(blocking=blocking):
+            return 0
+        return self._sync_locked()
+    
+    def _sync_locked(self):
+        """在已取得 _sync_lock 的情況下更新索引，結束時釋放鎖"""
+        try:
+            self.indexing = True
+            paths = self.workspace_index.files()
+            current = set(paths)
+            with self._lock:
+                known = {path: (entry['mtime'], entry['size']) for path, entry in self._files.items()}
+            
+            removed = [path for path in known if path not in current]
+            updated = len(removed)
+            batch = {}
+            for path in paths:
+                try:
+                    stat = os.stat(os.path.join(self.directory, path))
+                except OSError:
+                    if path in known:
+                        removed.append(path)
+                    continue
+                if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                    batch[path] = self._read_file(path, stat)
+                    updated += 1
+                    if len(batch) >= SEARCH_SYNC_BATCH:
+                        self._merge(batch)
+                        batch = {}
+            self._merge(batch, removed)
+            
+            self._last_sync = time.time()
+            return updated
+        finally:
+            self.indexing = False
+            self._sync_lock.release()
+    
+    def refresh(self):
+        """查詢前呼叫：與 SearchIndex.refresh 相同，只在背景執行緒重新索引有變更的檔案"""
+        if not self._last_sync or time.time() - self._last_sync < SEARCH_REFRESH_INTERVAL:
+            return
+        if self._sync_lock.acquire(blocking=False):
+            threading.Thread(target=self._sync_locked, daemon=True).start()
+    
+    def _bm25_scores(self, terms):
+        scores = {}
+        chunk_count = len(self._chunks)
+        if not chunk_count:
+            return scores
+        average_length = self._total_length / chunk_count or 1
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings.items():
+                length = self._chunks[chunk_id][3]
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return scores
+    
+    def related(self, prompt, k=RETRIEVAL_TOP_K, exclude=()):
+        """回傳與提示詞最相關的 k 個檔案，每個檔案附上分數最高的區塊（依分數排序）
+        
+        背景仍在建立索引時不等待，只以已完成的部分檢索。
+        """
+        self.refresh()
+        exclude = set(exclude)
+        with self._lock:
+            scores = self._bm25_scores(extract_terms(prompt))
+            if scores:
+                # 正規化到 0-1，才能與餘弦相似度加權合併
+                top = max(scores.values())
+                scores = {chunk_id: score / top for chunk_id, score in scores.items()}
+            if self.embeddings is not None:
+                for chunk_id, similarity in self.embeddings.scores(prompt).items():
+                    if similarity > 0:
+                        scores[chunk_id] = scores.get(chunk_id, 0.0) + RETRIEVAL_EMBEDDING_WEIGHT * similarity
+            
+            files = {}
+            for chunk_id, score in scores.items():
+                path, start_line, end_line, _ = self._chunks[chunk_id]
+                if path in exclude:
+                    continue
+                files.setdefault(path, []).append({'start_line': start_line, 'end_line': end_line,
+                                                   'score': round(score, 4)})
+        
+        results = []
+        for path, chunks in files.items():
+            chunks.sort(key=lambda c: -c['score'])
+            # 檔案分數以最佳區塊為主，其他區塊小幅加分
+            score = chunks[0]['score'] + 0.1 * sum(c['score'] for c in chunks[1:3])
+            results.append({'path': path, 'score': round(score, 4), 'chunks': chunks[:3]})
+        results.sort(key=lambda r: (-r['score'], r['path']))
+        return results[:k]
+    
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'chunks': len(self._chunks), 'terms': len(self._postings),
+                    'embeddings': self.embeddings is not None, 'indexing': self.indexing}
+
+# 目前工作目錄的搜尋索引
+search_index = None
+
+# 目前工作目錄的相關檔案檢索索引
+related_index = None
+
+# 最近使用過的工作目錄 -> (SearchIndex, RelatedFileIndex)，切換回來時只需重新索引有變更的檔案
+recent_indexes = OrderedDict()
+
+def _intern_lines(a_lines, b_lines):
+    """把每一行轉成整數編號，比較時只需比對整數"""
+    line_ids = {}
+    a = [line_ids.setdefault(line, len(line_ids)) for line in a_lines]
+    b = [line_ids.setdefault(line, len(line_ids)) for line in b_lines]
+    return a, b
+
+def _myers_split(a, a_lo, a_hi, b, b_lo, b_hi, deadline):
+    """以 Myers 演算法找出中間蛇的分割點（線性空間），沒有共同的行或逾時時回傳 None"""
+    a_len = a_hi - a_lo
+    b_len = b_hi - b_lo
+    max_d = (a_len + b_len + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = v1[:]
+    delta = a_len - b_len
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    
+    for d in range(max_d):
+        if time.monotonic() > deadline:
+            return None
+        
+        # 正向搜尋
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < a_len and y1 < b_len and a[a_lo + x1] == b[b_lo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > a_len:
+                k1end += 2
+            elif y1 > b_len:
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    if x1 >= a_len - v2[k2_offset]:
+                        return a_lo + x1, b_lo + y1
+        
+        # 反向搜尋
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < a_len and y2 < b_len and a[a_hi - 1 - x2] == b[b_hi - 1 - y2]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > a_len:
+                k2end += 2
+            elif y2 > b_len:
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    if x1 >= a_len - x2:
+                        return a_lo + x1, b_lo + y1
+    
+    return None
+
+def _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi):
+    """找出兩邊都只出現一次的行，取其最長遞增配對作為錨點；兩邊沒有任何共同行時回傳 None"""
+    a_count, a_pos = {}, {}
+    for i in range(a_lo, a_hi):
+        a_count[a[i]] = a_count.get(a[i], 0) + 1
+        a_pos[a[i]] = i
+    b_count, b_pos = {}, {}
+    for j in range(b_lo, b_hi):
+        b_count[b[j]] = b_count.get(b[j], 0) + 1
+        b_pos[b[j]] = j
+    
+    common = a_count.keys() & b_count.keys()
+    if not common:
+        return None
+    
+    pairs = sorted((a_pos[x], b_pos[x]) for x in common if a_count[x] == 1 and b_count[x] == 1)
+    
+    # patience sorting 求最長遞增子序列
+    tails, tail_index = [], []
+    previous = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        k = bisect.bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[k] = j
+            tail_index[k] = index
+        previous[index] = tail_index[k - 1] if k > 0 else -1
+    
+    anchors = []
+    index = tail_index[-1] if tail_index else -1
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+def myers_matching_blocks(a_lines, b_lines, timeout=None):
+    """以行雜湊與唯一行錨點預先切分後執行 Myers 差異演算法，回傳 (匹配區塊, 是否未逾時)；逾時的區段以整段取代處理"""
+    a, b = _intern_lines(a_lines, b_lines)
+    deadline = time.monotonic() + (DIFF_TIMEOUT if timeout is None else timeout)
+    exact = True
+    matches = []
+    pending = [(0, len(a), 0, len(b))]
+    
+    while pending:
+        a_lo, a_hi, b_lo, b_hi = pending.pop()
+        
+        # 先去除相同的開頭與結尾
+        start = a_lo
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        if a_lo > start:
+            matches.append((start, b_lo - (a_lo - start), a_lo - start))
+        
+        end = a_hi
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        if end > a_hi:
+            matches.append((a_hi, b_hi, end - a_hi))
+        
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        
+        # 較大的區段先以唯一行作為錨點切開（patience/histogram 風格），只對錨點間的小區段執行 Myers
+        if (a_hi - a_lo) + (b_hi - b_lo) > DIFF_ANCHOR_THRESHOLD:
+            anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+            if anchors is None:
+                continue  # 沒有任何共同行，整段取代即為最佳結果
+            if anchors:
+                prev_i, prev_j = a_lo, b_lo
+                for i, j in anchors:
+                    matches.append((i, j, 1))
+                    pending.append((prev_i, i, prev_j, j))
+                    prev_i, prev_j = i + 1, j + 1
+                pending.append((prev_i, a_hi, prev_j, b_hi))
+                continue
+        
+        split = _myers_split(a, a_lo, a_hi, b, b_lo, b_hi, deadline)
+        if split is None or split in ((a_lo, b_lo), (a_hi, b_hi)):
+            # 沒有共同的行時整段取代即為最佳結果；若是逾時則結果仍正確但不一定最小
+            if time.monotonic() > deadline:
+                exact = False
+            continue
+        
+        x, y = split
+        pending.append((x, a_hi, y, b_hi))
+        pending.append((a_lo, x, b_lo, y))
+    
+    matches.sort()
+    
+    # 合併相鄰的匹配區塊
+    blocks = []
+    for i, j, size in matches:
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + size)
+        else:
+            blocks.append((i, j, size))
+    blocks.append((len(a), len(b), 0))
+    return blocks, exact
+
+def difflib_matching_blocks(a_lines, b_lines, timeout=None):
+    """difflib 的比較結果（較慢，但與舊版輸出一致）"""
+    matcher = difflib.SequenceMatcher(None, a_lines, b_lines, autojunk=False)
+    return [tuple(block) for block in matcher.get_matching_blocks()], True
+
+# 可用的差異演算法
+DIFF_ENGINES = {
+    'myers': myers_matching_blocks,
+    'difflib': difflib_matching_blocks,
+}
+
+def compute_opcodes(a_lines, b_lines, engine=None, timeout=None):
+    """計算與 SequenceMatcher.get_opcodes() 相同格式的 opcodes，回傳 (opcodes, 是否為精確結果)"""
+    engine = engine or DIFF_ENGINE
+    engine_func = DIFF_ENGINES.get(engine, myers_matching_blocks)
+    try:
+        blocks, exact = engine_func(a_lines, b_lines, timeout)
+    except Exception as e:
+        logger.error(f"差異演算法 {engine} 失敗，改用 difflib: {str(e)}")
+        blocks, exact = difflib_matching_blocks(a_lines, b_lines)
+    
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, ai, j, bj))
+        if size:
+            opcodes.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    
+    return opcodes, exact
+
+def group_opcodes(opcodes, context=DIFF_CONTEXT_LINES):
+    """把 opcodes 分組成 hunk，保留前後 context 行（同 difflib.get_grouped_opcodes）"""
+    if not opcodes:
+        return
+    if len(opcodes) == 1 and opcodes[0][0] == 'equal':
+        return
+    
+    codes = list(opcodes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # 大段相同的內容把 hunk 切開
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def iter_diff_hunks(a_lines, b_lines, opcodes, context=DIFF_CONTEXT_LINES):
+    """產生結構化的 hunk：{old_start, old_lines, new_start, new_lines, lines}"""
+    for group in group_opcodes(opcodes, context):
+        i1, i2 = group[0][1], group[-1][2]
+        j1, j2 = group[0][3], group[-1][4]
+        lines = []
+        for tag, a1, a2, b1, b2 in group:
+            if tag == 'equal':
+                lines.extend(' ' + line for line in a_lines[a1:a2])
+                continue
+            if tag in ('replace', 'delete'):
+                lines.extend('-' + line for line in a_lines[a1:a2])
+            if tag in ('replace', 'insert'):
+                lines.extend('+' + line for line in b_lines[b1:b2])
+        
+        # 與 unified diff 相同：長度為 0 時起始行號指向前一行
+        yield {
+            'old_start': i1 + 1 if i2 > i1 else i1,
+            'old_lines': i2 - i1,
+            'new_start': j1 + 1 if j2 > j1 else j1,
+            'new_lines': j2 - j1,
+            'lines': lines
+        }
+
+def iter_unified_diff(a_lines, b_lines, fromfile, tofile, opcodes, context=DIFF_CONTEXT_LINES):
+    """逐行產生 unified diff 文字（不含換行符號）"""
+    started = False
+    for hunk in iter_diff_hunks(a_lines, b_lines, opcodes, context):
+        if not started:
+            yield f'--- {fromfile}'
+            yield f'+++ {tofile}'
+            started = True
+        old_range = f"{hunk['old_start']}" if hunk['old_lines'] == 1 else f"{hunk['old_start']},{hunk['old_lines']}"
+        new_range = f"{hunk['new_start']}" if hunk['new_lines'] == 1 else f"{hunk['new_start']},{hunk['new_lines']}"
+        yield f'@@ -{old_range} +{new_range} @@'
+        yield from hunk['lines']
+
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def _patch_path(raw_path):
+    """解析 ---/+++ 行中的路徑，去除時間戳記與 a/、b/ 前綴；/dev/null 回傳 None"""
+    path = raw_path.split('\t')[0].strip()
+    if path == '/dev/null':
+        return None
+    if path.startswith('a/') or path.startswith('b/'):
+        path = path[2:]
+    return path
+
+def parse_unified_diff(text):
+    """解析 unified diff（可包含多個檔案與前後的說明文字），回傳各檔案的 hunk 清單"""
+    patches = []
+    current = None
+    hunk = None
+    lines = text.splitlines()
+    
+    def finish_hunk():
+        # 去除結尾由空白行轉成的 context
+        while hunk and hunk['lines'] and hunk['lines'][-1] == ' ' and hunk.get('blank_tail'):
+            hunk['lines'].pop()
+            hunk['blank_tail'] -= 1
+        if hunk is not None:
+            hunk.pop('blank_tail', None)
+            hunk['old_lines'] = sum(1 for line in hunk['lines'] if line[0] in ' -')
+            hunk['new_lines'] = sum(1 for line in hunk['lines'] if line[0] in ' +')
+    
+    for index, line in enumerate(lines):
+        next_line = lines[index + 1] if index + 1 < len(lines) else ''
+        
+        if line.startswith('--- ') and next_line.startswith('+++ '):
+            finish_hunk()
+            hunk = None
+            current = {'old_path': _patch_path(line[4:]), 'new_path': None, 'hunks': []}
+            patches.append(current)
+            continue
+        if line.startswith('+++ ') and current is not None and hunk is None and not current['hunks']:
+            current['new_path'] = _patch_path(line[4:])
+            continue
+        
+        match = HUNK_HEADER_RE.match(line)
+        if match and current is not None:
+            finish_hunk()
+            hunk = {'old_start': int(match.group(1)), 'new_start': int(match.group(3)),
+                    'lines': [], 'blank_tail': 0}
+            current['hunks'].append(hunk)
+            continue
+        
+        if hunk is None:
+            continue  # diff 之外的說明文字
+        
+        if line.startswith('\\'):
+            continue  # "\ No newline at end of file"
+        if line == '':
+            # LLM 產生的 diff 常把只有空白的 context 行變成空行
+            hunk['lines'].append(' ')
+            hunk['blank_tail'] += 1
+            continue
+        if line[0] in ' +-':
+            hunk['lines'].append(line)
+            hunk['blank_tail'] = 0
+            continue
+        
+        # 其他文字表示這個 hunk 已結束
+        finish_hunk()
+        hunk = None
+    
+    finish_hunk()
+    return [patch for patch in patches if patch['hunks'] or patch['new_path'] is None]
+
+def _lines_equal(actual, expected, loose):
+    if loose:
+        return all(x.strip() == y.strip() for x, y in zip(actual, expected))
+    return actual == expected
+
+def _locate_hunk(lines, old, expected, min_pos, max_offset):
+    """從預期位置向外搜尋 old 出現的位置，先精確比對再忽略空白比對，回傳 (位置, 是否忽略空白)"""
+    last = len(lines) - len(old)
+    if last < min_pos:
+        return None, False
+    expected = min(max(expected, min_pos), last)
+    
+    for loose in (False, True):
+        for distance in range(0, max_offset + 1):
+            candidates = (expected,) if distance == 0 else (expected - distance, expected + distance)
+            for pos in candidates:
+                if min_pos <= pos <= last and _lines_equal(lines[pos:pos + len(old)], old, loose):
+                    return pos, loose
+            if expected - distance < min_pos and expected + distance > last:
+                break
+    return None, False
+
+def apply_hunks(lines, hunks, max_fuzz=PATCH_MAX_FUZZ, max_offset=PATCH_MAX_OFFSET):
+    """把 hunk 依序套用到行清單上，回傳 (新的行清單, 每個 hunk 的結果)"""
+    result = list(lines)
+    results = []
+    delta = 0     # 先前已套用的 hunk 造成的行數變化
+    min_pos = 0   # 後面的 hunk 不可與前面的重疊
+    
+    for index, hunk in enumerate(hunks):
+        body = hunk['lines']
+        leading = next((i for i, line in enumerate(body) if line[0] != ' '), len(body))
+        trailing = next((i for i, line in enumerate(reversed(body)) if line[0] != ' '), len(body))
+        expected = hunk['old_start'] - 1 + delta if hunk['old_lines'] else hunk['old_start'] + delta
+        
+        applied = None
+        # fuzz：逐步忽略開頭與結尾的 context 行，與 patch(1) 相同
+        for fuzz in range(0, max_fuzz + 1):
+            cut_front = min(fuzz, leading)
+            cut_back = min(fuzz, trailing)
+            if fuzz and cut_front + cut_back == 0:
+                break
+            trimmed = body[cut_front:len(body) - cut_back]
+            old = [line[1:] for line in trimmed if line[0] in ' -']
+            new = [line[1:] for line in trimmed if line[0] in ' +']
+            
+            pos, loose = _locate_hunk(result, old, expected + cut_front, min_pos, max_offset)
+            if pos is not None:
+                applied = (pos, fuzz, loose, old, new, cut_front)
+                break
+        
+        if applied is None:
+            results.append({'hunk': index, 'status': 'rejected', 'old_start': hunk['old_start']})
+            continue
+        
+        pos, fuzz, loose, old, new, cut_front = applied
+        result[pos:pos + len(old)] = new
+        results.append({'hunk': index, 'status': 'applied', 'line': pos + 1,
+                        'offset': pos - (expected + cut_front), 'fuzz': fuzz,
+                        'ignored_whitespace': loose})
+        delta += len(new) - len(old)
+        min_pos = pos + len(new)
+    
+    return result, results
+
+def apply_file_patch(patch, dry_run=False):
+    """把單一檔案的 patch 套用到工作目錄（優先使用尚未保存的緩衝區內容），回傳結果"""
+    relative_path = patch['new_path'] or patch['old_path']
+    outcome = {'path': relative_path, 'hunks': []}
+    
+    if not relative_path or not is_path_safe(current_workspace, relative_path):
+        outcome.update(status='rejected', error='無效的檔案路徑')
+        return outcome
+    
+    full_path = os.path.normpath(os.path.join(current_workspace, relative_path))
+    is_new = patch['old_path'] is None
+    is_delete = patch['new_path'] is None
+    
+    def load_disk():
+        if is_new or not os.path.isfile(full_path):
+            return None
+        with open(full_path, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+            return f.read()
+    
+    def write(content):
+        if is_new:
+            if os.path.exists(full_path):
+                outcome.update(status='rejected', error='檔案已存在')
+                return outcome, False
+            content = ''
+        elif content is None:
+            outcome.update(status='rejected', error='檔案不存在')
+            return outcome, False
+        
+        newline = '\r\n' if '\r\n' in content else '\n'
+        ends_with_newline = content.endswith('\n') or not content
+        new_lines, hunk_results = apply_hunks(content.splitlines(), patch['hunks'])
+        outcome['hunks'] = hunk_results
+        
+        applied = sum(1 for r in hunk_results if r['status'] == 'applied')
+        if hunk_results and applied == 0:
+            outcome['status'] = 'rejected'
+            return outcome, False
+        if applied < len(hunk_results):
+            outcome['status'] = 'partial'
+        else:
+            outcome['status'] = 'created' if is_new else 'deleted' if is_delete else 'applied'
+        
+        if dry_run:
+            return outcome, False
+        
+        if is_delete and not new_lines:
+            os.remove(full_path)
+        else:
+            if is_new:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            new_content = newline.join(new_lines)
+            if new_lines and ends_with_newline:
+                new_content += newline
+            atomic_write(full_path, new_content)
+        return outcome, True
+    
+    # 讀取、套用與寫入期間持有該路徑的鎖，同時進行的編輯會等待並在版本不符時得到 409，
+    # 自動保存也不會把套用前的緩衝區寫回；版本號遞增讓編輯器重新同步
+    buffer_store.write_through(full_path, load_disk, write)
+    auto_saver.cancel(full_path)
+    return outcome
+
+# 斷路器與 vibe-coding-tool 共用
+shared_circuit_breaker = load_shared_module('circuit_breaker')
+CircuitOpenError = shared_circuit_breaker.CircuitOpenError
+CircuitBreaker = shared_circuit_breaker.CircuitBreaker
+
+class UpstreamClient:
+    """共用的上游 HTTP 客戶端：keep-alive 連線池、逾時、含抖動的指數退避重試，以及每個主機的斷路器"""
+    
+    def __init__(self, pool_size=UPSTREAM_POOL_SIZE, connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 read_timeout=UPSTREAM_READ_TIMEOUT, max_retries=UPSTREAM_MAX_RETRIES):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        # pool_block=True：連線數達上限時等待，而不是額外開新連線
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._breakers = {}
+        self._lock = threading.Lock()
+    
+    def breaker(self, url):
+        """取得 URL 所屬主機的斷路器"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+            return self._breakers[host]
+    
+    @staticmethod
+    def _backoff(attempt, response=None):
+        """計算重試前的等待時間：優先使用 Retry-After，否則為 full jitter 指數退避"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(int(retry_after), UPSTREAM_BACKOFF_MAX)
+        return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+    
+    @staticmethod
+    def _not_sent(error):
+        """請求是否確定尚未送出：連線逾時或無法建立連線。連線中斷（Connection aborted）時上游可能已收到請求"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    
+    @staticmethod
+    def _retry_status(idempotent, response):
+        if response.status_code not in UPSTREAM_RETRY_STATUS:
+            return False
+        if idempotent:
+            return True
+        return response.status_code in UPSTREAM_RETRY_AFTER_STATUS and 'Retry-After' in response.headers
+    
+    def request(self, method, url, retries=None, **kwargs):
+        """發送請求並視情況重試，讀取逾時不重試以免重複執行
+        
+        冪等方法在連線失敗與 429/502/503/504 時重試；POST 等方法只在請求確定未送出，
+        或上游回應 429/503 並附上 Retry-After 時重試，避免上游重複處理同一個請求。
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.max_retries if retries is None else retries
+        idempotent = method.upper() in UPSTREAM_IDEMPOTENT_METHODS
+        breaker = self.breaker(url)
+        
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f'上游服務暫時無法使用: {urlsplit(url).netloc}')
+            
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                breaker.record_failure()
+                if attempt >= retries or not (idempotent or self._not_sent(e)):
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            except requests.exceptions.RequestException:
+                breaker.record_failure()
+                raise
+            
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            
+            if attempt < retries and self._retry_status(idempotent, response):
+                delay = self._backoff(attempt, response)
+                response.close()
+                time.sleep(delay)
+                continue
+            return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stats(self):
+        with self._lock:
+            return {host: breaker.snapshot() for host, breaker in self._breakers.items()}
+
+# 所有對 LLM API 與 LLM 應用程序的呼叫共用的客戶端
+upstream_client = UpstreamClient()
+
+def iter_openai_stream(response):
+    """解析 OpenAI chat completions 相容的 SSE 串流，逐段產生文字"""
+    # SSE 一律為 UTF-8；requests 對未標示 charset 的 text/event-stream 會以 ISO-8859-1 解碼
+    response.encoding = 'utf-8'
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            break
+        choices = json.loads(payload).get('choices') or [{}]
+        text = (choices[0].get('delta') or {}).get('content')
+        if text:
+            yield text
+
+class LLMEndpoint:
+    """端點池中的一個 LLM 端點，記錄第一段文字的延遲（EWMA）、進行中的請求數與健康狀態"""
+    
+    def __init__(self, url, api_key='', health_url=None):
+        self.url = url
+        self.api_key = api_key
+        self.health_url = health_url
+        self.latency = None
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.unhealthy_since = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+    
+    def available(self):
+        """是否可以接收請求；不健康的端點冷卻後放行以便恢復"""
+        if not self.healthy and time.monotonic() - self.unhealthy_since < ROUTER_UNHEALTHY_COOLDOWN:
+            return False
+        breaker = upstream_client.breaker(self.url)
+        return breaker.state != 'open' or time.monotonic() - breaker.opened_at >= breaker.reset_timeout
+    
+    def score(self):
+        """預期的等待成本：延遲越低、進行中的請求越少越好；尚無資料的端點優先嘗試"""
+        with self._lock:
+            return (self.latency or 0.0) * (self.in_flight + 1)
+    
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+    
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+    
+    def record_latency(self, seconds):
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency = ROUTER_EWMA_ALPHA * seconds + (1 - ROUTER_EWMA_ALPHA) * self.latency
+    
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.healthy = True
+    
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.consecutive_failures >= ROUTER_UNHEALTHY_THRESHOLD:
+                self.healthy = False
+                self.unhealthy_since = time.monotonic()
+    
+    def stream(self, llm_request):
+        """向端點請求串流回應；重試交由路由器改用其他端點處理"""
+        response = upstream_client.post(
+            self.url,
+            json=dict(llm_request, stream=True),
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            stream=True,
+            retries=0
+        )
+        try:
+            response.raise_for_status()
+            yield from iter_openai_stream(response)
+        finally:
+            response.close()
+    
+    def check_health(self):
+        """主動健康檢查，只對有設定 health_url 的端點執行"""
+        if not self.health_url:
+            return
+        try:
+            response = upstream_client.get(self.health_url, timeout=(UPSTREAM_CONNECT_TIMEOUT, 5), retries=0)
+            response.close()
+            ok = response.status_code < 400
+        except Exception as e:
+            ok = False
+            self.last_error = str(e)
+        with self._lock:
+            if ok:
+                self.healthy = True
+                self.consecutive_failures = 0
+            elif self.healthy:
+                self.healthy = False
+                self.unhealthy_since = time.monotonic()
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'url': self.url,
+                'latency': None if self.latency is None else round(self.latency, 4),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'failures': self.failures,
+                'healthy': self.healthy,
+                'last_error': self.last_error
+            }
+
+class LLMRouter:
+    """依模型 ID 把 LLM 請求送到延遲最低的端點，失敗時改用其他端點，回應過慢時對沖"""
+    
+    def __init__(self, pools, hedge_delay=ROUTER_HEDGE_DELAY, max_failover=ROUTER_MAX_FAILOVER):
+        self.pools = pools
+        self.hedge_delay = hedge_delay
+        self.max_failover = max_failover
+        self._health_thread = None
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'failovers': 0, 'hedges': 0, 'hedge_wins': 0}
+    
+    @classmethod
+    def from_config(cls, config=LLM_ENDPOINTS):
+        """由 VIBE_LLM_ENDPOINTS 建立路由器；沒有任何端點時回傳 None（使用模擬回應）"""
+        pools = {}
+        if config:
+            if not config.lstrip().startswith('{'):
+                with open(config, 'r', encoding='utf-8') as f:
+                    config = f.read()
+            for model_id, endpoints in json.loads(config).items():
+                pools[model_id] = [LLMEndpoint(e['url'], e.get('api_key', LLM_API_KEY), e.get('health_url'))
+                                   for e in endpoints]
+        elif LLM_API_URL:
+            pools['*'] = [LLMEndpoint(LLM_API_URL, LLM_API_KEY)]
+        return cls(pools) if pools else None
+    
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+    
+    def select(self, model_id, exclude=()):
+        """選出分數最低的可用端點；全部不可用時仍從未嘗試過的端點中挑選"""
+        candidates = [e for e in self.pools.get(model_id) or self.pools.get('*') or [] if e not in exclude]
+        available = [e for e in candidates if e.available()] or candidates
+        return min(available, key=lambda e: e.score()) if available else None
+    
+    def _attempt(self, endpoint, llm_request, events, cancel):
+        """在背景執行一個端點的請求，把 (端點, 類型, 內容) 放入 events"""
+        started = time.monotonic()
+        first = True
+        endpoint.begin()
+        try:
+            for text in endpoint.stream(llm_request):
+                if cancel.is_set():
+                    return
+                if first:
+                    endpoint.record_latency(time.monotonic() - started)
+                    first = False
+                events.put((endpoint, 'token', text))
+            endpoint.record_success()
+            events.put((endpoint, 'done', None))
+        except Exception as e:
+            if not cancel.is_set():
+                logger.warning(f"LLM端點 {endpoint.url} 發生錯誤: {str(e)}")
+                endpoint.record_failure(e)
+            events.put((endpoint, 'error', e))
+        finally:
+            endpoint.end()
+    
+    def iter_completion(self, llm_request):
+        """逐段產生LLM回應；在收到第一段文字前失敗會改用其他端點，
+        超過 hedge_delay 仍沒有回應時同時向第二個端點發送請求，採用先回應的一方"""
+        self._ensure_health_checks()
+        self._count('requests')
+        model_id = llm_request.get('model')
+        events = queue.Queue()
+        attempts = {}   # 端點 -> (取消事件, 開始時間)
+        pending = set()
+        winner = None
+        hedge = None
+        failovers = 0
+        
+        def launch():
+            endpoint = self.select(model_id, exclude=attempts)
+            if endpoint is not None:
+                cancel = threading.Event()
+                attempts[endpoint] = (cancel, time.monotonic())
+                pending.add(endpoint)
+                threading.Thread(target=self._attempt, args=(endpoint, llm_request, events, cancel),
+                                 daemon=True).start()
+            return endpoint
+        
+        if launch() is None:
+            raise RuntimeError(f'模型 {model_id} 沒有可用的LLM端點')
+        
+        try:
+            while True:
+                hedging = winner is None and hedge is None and self.hedge_delay > 0
+                try:
+                    endpoint, kind, payload = events.get(timeout=self.hedge_delay if hedging else None)
+                except queue.Empty:
+                    hedge = launch() or False
+                    if hedge:
+                        self._count('hedges')
+                    continue
+                
+                if winner is None:
+                    if kind == 'error':
+                        pending.discard(endpoint)
+                        if pending:
+                            continue
+                        if failovers < self.max_failover and launch() is not None:
+                            failovers += 1
+                            self._count('failovers')
+                            continue
+                        raise payload
+                    
+                    # 第一個回應的端點勝出，取消其他請求；落敗端點已等待的時間作為其延遲的下限
+                    winner = endpoint
+                    if endpoint is hedge:
+                        self._count('hedge_wins')
+                    for other, (cancel, started) in attempts.items():
+                        if other is not winner and other in pending:
+                            cancel.set()
+                            other.record_latency(time.monotonic() - started)
+                
+                if endpoint is not winner:
+                    continue
+                if kind == 'token':
+                    yield payload
+                elif kind == 'done':
+                    return
+                else:
+                    raise payload
+        finally:
+            for cancel, _ in attempts.values():
+                cancel.set()
+    
+    def _ensure_health_checks(self):
+        with self._lock:
+            if self._health_thread is None and any(e.health_url for e in self.endpoints()):
+                self._health_thread = threading.Thread(target=self._health_loop, name='llm-health', daemon=True)
+                self._health_thread.start()
+    
+    def _health_loop(self):
+        while True:
+            for endpoint in self.endpoints():
+                endpoint.check_health()
+            time.sleep(ROUTER_HEALTH_INTERVAL)
+    
+    def endpoints(self):
+        return [endpoint for pool in self.pools.values() for endpoint in pool]
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pools'] = {model_id: [e.snapshot() for e in pool] for model_id, pool in self.pools.items()}
+        return stats
+
+# LLM 端點路由器，未設定任何端點時為 None
+llm_router = LLMRouter.from_config()
+
+def read_workspace_file(relative_path):
+    """讀取工作目錄中的檔案內容，優先使用尚未保存的緩衝區"""
+    if not is_path_safe(current_workspace, relative_path):
+        raise ValueError('無效的檔案路徑')
+    
+    full_path = os.path.normpath(os.path.join(current_workspace, relative_path))
+    buffered = buffer_store.get(full_path)
+    if buffered is not None:
+        return buffered[0]
+    
+    if not os.path.isfile(full_path):
+        raise FileNotFoundError('檔案不存在')
+    
+    with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
+
+def is_binary_file(full_path):
+    """只讀取檔案開頭判斷是否為二進位檔：含有 NUL 或過多控制字元"""
+    with open(full_path, 'rb') as f:
+        head = f.read(BINARY_SNIFF_BYTES)
+    if b'\0' in head:
+        return True
+    if not head:
+        return False
+    control = sum(1 for byte in head if byte < 32 and byte not in (9, 10, 12, 13, 27))
+    return control / len(head) > 0.3
+
+class LineIndex:
+    """檔案的稀疏行偏移索引：每 LINE_INDEX_STRIDE 行記錄一次起始位元組，以 mmap 建立一次後快取"""
+    
+    def __init__(self, full_path, stride=LINE_INDEX_STRIDE):
+        self.full_path = full_path
+        self.stride = stride
+        stat = os.stat(full_path)
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.checkpoints = array('q', [0])
+        self.total_lines = 0
+        if self.size:
+            self._build()
+    
+    def _build(self):
+        chunk_size = 4 * 1024 * 1024
+        newlines = 0
+        with open(self.full_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for chunk_start in range(0, self.size, chunk_size):
+                parts = mm[chunk_start:chunk_start + chunk_size].split(b'\n')
+                # 各行（除了 chunk 中最後一段）結束後的下一個位元組即下一行的起始位置
+                starts = list(itertools.accumulate(map((1).__add__, map(len, parts[:-1])),
+                                                   initial=chunk_start))[1:]
+                first = (-newlines - 1) % self.stride
+                self.checkpoints.extend(starts[first::self.stride])
+                newlines += len(starts)
+            ends_with_newline = mm[self.size - 1:self.size] == b'\n'
+        self.total_lines = newlines + (0 if ends_with_newline else 1)
+    
+    def is_current(self):
+        try:
+            stat = os.stat(self.full_path)
+        except OSError:
+            return False
+        return stat.st_mtime_ns == self.mtime_ns and stat.st_size == self.size
+    
+    def offset_of(self, mm, line):
+        """第 line 行（從 0 開始）的起始位元組；超過檔尾時回傳檔案大小"""
+        if line >= self.total_lines:
+            return self.size
+        position = self.checkpoints[line // self.stride]
+        for _ in range(line % self.stride):
+            position = mm.find(b'\n', position) + 1
+        return position
+    
+    def read_lines(self, start_line, count):
+        """讀取從 start_line（從 0 開始）起的 count 行，回傳 (位元組, 實際讀取的行數, 截斷資訊)
+        
+        超過 MAX_FILE_PAGE_BYTES 時只回傳上限內的完整行；第一行本身就超過上限時只回傳該行開頭
+        （在完整的 UTF-8 字元處截斷），截斷資訊為 (其餘部分的起始位元組, 該行的結束位元組)，否則為 None。
+        """
+        if not self.size or start_line >= self.total_lines:
+            return b'', 0, None
+        end_line = min(start_line + count, self.total_lines)
+        with open(self.full_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = self.offset_of(mm, start_line)
+            end = self.offset_of(mm, end_line)
+            if end - start <= MAX_FILE_PAGE_BYTES:
+                return mm[start:end], end_line - start_line, None
+            
+            complete = mm[start:start + MAX_FILE_PAGE_BYTES].count(b'\n')
+            if complete:
+                return mm[start:self.offset_of(mm, start_line + complete)], complete, None
+            
+            cut = start + MAX_FILE_PAGE_BYTES
+            while cut > start and mm[cut] & 0xC0 == 0x80:
+                cut -= 1
+            line_end = mm.find(b'\n', start)
+            return mm[start:cut], 1, (cut, self.size if line_end == -1 else line_end)
+
+class LineIndexCache:
+    """最近使用的檔案行偏移索引，檔案的大小或 mtime 改變時重新建立"""
+    
+    def __init__(self, capacity=LINE_INDEX_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, full_path):
+        with self._lock:
+            index = self._entries.get(full_path)
+            if index is not None and index.is_current():
+                self._entries.move_to_end(full_path)
+                return index
+        
+        index = LineIndex(full_path)
+        with self._lock:
+            self._entries[full_path] = index
+            self._entries.move_to_end(full_path)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return index
+
+line_index_cache = LineIndexCache()
+
+class FileContentCache:
+    """最近讀取的檔案內容與 SHA-256 雜湊，以 (路徑, mtime, 大小) 判斷是否仍有效
+    
+    內容依總位元組數以 LRU 淘汰；被淘汰的檔案仍保留雜湊，條件式請求不需重新讀取檔案。
+    """
+    
+    def __init__(self, max_bytes=MAX_FILE_CACHE_BYTES, max_digests=MAX_FILE_DIGESTS):
+        self.max_bytes = max_bytes
+        self.max_digests = max_digests
+        self._contents = OrderedDict()   # 完整路徑 -> (mtime, 大小, 內容)
+        self._digests = OrderedDict()    # 完整路徑 -> (mtime, 大小, 雜湊)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    
+    def digest(self, full_path, stat):
+        """回傳檔案目前內容的雜湊；不知道時回傳 None"""
+        with self._lock:
+            entry = self._digests.get(full_path)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                self._digests.move_to_end(full_path)
+                return entry[2]
+        return None
+    
+    def read(self, full_path, stat):
+        """回傳 (內容, 雜湊)，快取有效時不讀取磁碟"""
+        with self._lock:
+            entry = self._contents.get(full_path)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                self._contents.move_to_end(full_path)
+                self._stats['hits'] += 1
+                return entry[2], self._digests[full_path][2]
+            self._stats['misses'] += 1
+        
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        
+        with self._lock:
+            self._digests[full_path] = (stat.st_mtime_ns, stat.st_size, digest)
+            self._digests.move_to_end(full_path)
+            while len(self._digests) > self.max_digests:
+                stale_path, _ = self._digests.popitem(last=False)
+                self._drop(stale_path)
+            
+            self._drop(full_path)
+            if len(data) <= self.max_bytes:
+                self._contents[full_path] = (stat.st_mtime_ns, stat.st_size, data)
+                self._total_bytes += len(data)
+                while self._total_bytes > self.max_bytes:
+                    stale_path = next(iter(self._contents))
+                    self._drop(stale_path)
+                    self._stats['evictions'] += 1
+        return data, digest
+    
+    def _drop(self, full_path):
+        entry = self._contents.pop(full_path, None)
+        if entry is not None:
+            self._total_bytes -= len(entry[2])
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._contents), bytes=self._total_bytes,
+                        digests=len(self._digests))
+
+file_content_cache = FileContentCache()
 
-# 支援的檔案類型
-SUPPORTED_EXTENSIONS = ['.js', '.py', '.html', '.css', '.java', '.c', '.cpp', '.cs', 
-                        '.php', '.ts', '.jsx', '.tsx', '.rb', '.go', '.rs', '.swift',
-                        '.json', '.md', '.txt']
+def read_byte_range(full_path, offset, length):
+    """讀取檔案的一段位元組，回傳 (文字, 實際結束位置)
+    
+    結尾的 UTF-8 字元被切斷時多讀幾個位元組補齊，下一段從完整字元開始；
+    offset 未到檔案結尾時結束位置一定大於 offset，依 next_offset 分頁不會停在原地。
+    """
+    length = max(min(length, MAX_FILE_PAGE_BYTES), 1)
+    with open(full_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+        # 補齊結尾不完整的 UTF-8 多位元組字元
+        for back in range(1, min(4, len(data)) + 1):
+            byte = data[-back]
+            if byte & 0xC0 != 0x80:
+                expected = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4 if byte & 0xF8 == 0xF0 else 1
+                if expected > back:
+                    data += f.read(expected - back)
+                break
+    return data.decode('utf-8', errors='replace'), offset + len(data)
 
-# 最後修改的檔案及其內容的緩存
-file_cache = {}
-last_save_time = {}
+def read_workspace_files(paths):
+    """並行讀取多個檔案，回傳 (檔案清單, 錯誤清單)"""
+    def read_one(path):
+        try:
+            return {'path': path, 'content': read_workspace_file(path)}, None
+        except Exception as e:
+            return None, {'path': path, 'error': str(e)}
+    
+    files, errors = [], []
+    for result, error in file_read_executor.map(read_one, paths):
+        if error:
+            errors.append(error)
+        else:
+            files.append(result)
+    return files, errors
 
-# 定期保存檔案的間隔（秒）
-AUTO_SAVE_INTERVAL = 5
+# 批次讀取檔案用的執行緒池
+file_read_executor = ThreadPoolExecutor(max_workers=FILE_READ_WORKERS, thread_name_prefix='file-read')
 
-def get_file_list(directory, extensions=None):
-    """獲取指定目錄下的所有檔案清單"""
-    file_list = []
+class LLMResponseCache:
+    """LLM 回應快取：記憶體 LRU 為第一層，可選的 SQLite 磁碟快取為第二層，兩者皆有 TTL"""
     
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if extensions is None or any(file.endswith(ext) for ext in extensions):
-                relative_path = os.path.relpath(os.path.join(root, file), directory)
-                file_list.append(relative_path)
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL,
+                 db_path=LLM_CACHE_DB, db_max_bytes=LLM_CACHE_DB_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_max_bytes = db_max_bytes
+        self._memory = OrderedDict()   # 鍵 -> (到期時間, 值)
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0}
+        self._db = None
+        
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS llm_cache ('
+                    'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                    'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+                self._db.execute('CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)')
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"無法開啟LLM磁碟快取 {db_path}: {str(e)}")
+                self._db = None
     
-    return file_list
+    @staticmethod
+    def make_key(model_id, temperature, prompt, files):
+        """以模型、溫度、正規化後的提示詞與檔案內容雜湊產生快取鍵"""
+        normalized_prompt = ' '.join(prompt.split())
+        file_hashes = sorted(
+            (file['path'], hashlib.sha256(file['content'].encode('utf-8')).hexdigest())
+            for file in files)
+        raw = json.dumps([model_id, temperature, normalized_prompt, file_hashes], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查詢快取，回傳 (值, 命中的層級)；未命中時回傳 (None, None)"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return entry[1], 'memory'
+                del self._memory[key]
+            
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        'SELECT value, expires_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+                    if row and row[1] > now:
+                        self._db.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                        self._db.commit()
+                        value = json.loads(row[0])
+                        self._remember(key, value, row[1])
+                        self._stats['disk_hits'] += 1
+                        return value, 'disk'
+                except sqlite3.Error as e:
+                    logger.error(f"讀取LLM磁碟快取時發生錯誤: {str(e)}")
+            
+            self._stats['misses'] += 1
+            return None, None
+    
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+    
+    def set(self, key, value):
+        """寫入快取"""
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+            self._stats['stores'] += 1
+            
+            if self._db is not None:
+                try:
+                    encoded = json.dumps(value, ensure_ascii=False)
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO llm_cache (key, value, size, expires_at, accessed_at) '
+                        'VALUES (?, ?, ?, ?, ?)', (key, encoded, len(encoded), expires_at, now))
+                    self._evict_disk(now)
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"寫入LLM磁碟快取時發生錯誤: {str(e)}")
+    
+    def _evict_disk(self, now):
+        """刪除過期項目；總大小超過上限時刪除最久未使用的項目"""
+        self._db.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,))
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        if total <= self.db_max_bytes:
+            return
+        
+        freed = 0
+        stale_keys = []
+        for key, size in self._db.execute('SELECT key, size FROM llm_cache ORDER BY accessed_at'):
+            if total - freed <= self.db_max_bytes:
+                break
+            stale_keys.append((key,))
+            freed += size
+        self._db.executemany('DELETE FROM llm_cache WHERE key = ?', stale_keys)
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['disk_enabled'] = self._db is not None
+            return stats
 
-def create_file_backup(file_path):
-    """為檔案創建備份"""
-    if not os.path.exists(file_path):
-        return None
+# LLM 回應快取
+llm_cache = LLMResponseCache()
+
+class InFlightLLMCall:
+    """一次進行中的上游 LLM 呼叫，產生的文字片段與最終結果由所有等待者共享"""
     
-    # 創建備份檔案名稱
-    backup_filename = os.path.basename(file_path) + ".backup"
-    backup_path = os.path.join(TEMP_DIR, backup_filename)
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.started = False
+        self.cancelled = False
+        self.waiters = 1
+        self._cond = threading.Condition()
     
-    # 複製檔案內容
-    try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as src_file:
-            content = src_file.read()
+    @classmethod
+    def completed(cls, result):
+        """建立已完成的呼叫（例如快取命中的結果）"""
+        call = cls(None)
+        call.add_chunk(result['response'])
+        call.finish(result)
+        return call
+    
+    def add_chunk(self, text):
+        with self._cond:
+            self.chunks.append(text)
+            self._cond.notify_all()
+    
+    def finish(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+    
+    def attach(self):
+        """新增一個等待者；呼叫已取消時回傳 False"""
+        with self._cond:
+            if self.cancelled:
+                return False
+            self.waiters += 1
+            return True
+    
+    def detach(self):
+        """等待者離開；最後一個等待者離開時取消尚未完成的上游呼叫"""
+        with self._cond:
+            self.waiters -= 1
+            if self.waiters <= 0 and not self.done:
+                self.cancelled = True
+    
+    def iter_chunks(self):
+        """依序產生已收到與之後收到的文字片段，直到呼叫結束"""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                pending = self.chunks[index:]
+                finished = self.done
+            for text in pending:
+                yield text
+            index += len(pending)
+            if finished and index >= len(self.chunks):
+                return
+    
+    def wait(self):
+        """等待呼叫結束，回傳最終結果；失敗時拋出 RuntimeError"""
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+        if self.error:
+            raise RuntimeError(self.error)
+        return self.result
+
+class SingleFlight:
+    """相同快取鍵的進行中查詢只呼叫一次上游，其餘請求加入等待並共享結果"""
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'started': 0, 'coalesced': 0}
+    
+    def join(self, key):
+        """加入 key 對應的進行中呼叫，沒有時建立新的呼叫；回傳 (call, 是否為新呼叫)
+        
+        新呼叫需由呼叫端以 run() 執行，或以 abandon() 放棄。
+        """
+        with self._lock:
+            call = self._calls.get(key) if key else None
+            if call is not None and call.attach():
+                self._stats['coalesced'] += 1
+                return call, False
             
-        with open(backup_path, 'w', encoding='utf-8') as backup_file:
-            backup_file.write(content)
+            call = InFlightLLMCall(key)
+            if key:
+                self._calls[key] = call
+            self._stats['started'] += 1
+            return call, True
+    
+    def run(self, call, producer):
+        """執行 producer(call)；所有等待者在開始前就已離開時直接取消"""
+        try:
+            if call.cancelled:
+                call.finish(error='LLM查詢已取消')
+                return
+            call.started = True
+            producer(call)
+        except Exception as e:
+            logger.error(f"LLM查詢時發生錯誤: {str(e)}")
+            call.finish(error=f'LLM查詢時發生錯誤: {str(e)}')
+        finally:
+            if not call.done:
+                call.finish(error='LLM查詢已取消')
+            self._release(call)
+    
+    def abandon(self, call, error):
+        """放棄尚未執行的呼叫，已加入的等待者會收到錯誤"""
+        call.finish(error=error)
+        self._release(call)
+    
+    def _release(self, call):
+        with self._lock:
+            if call.key and self._calls.get(call.key) is call:
+                del self._calls[call.key]
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls))
+
+# 相同查詢的請求合併
+llm_single_flight = SingleFlight()
+
+class QueueFullError(Exception):
+    """LLM 工作佇列已滿"""
+    
+    def __init__(self, retry_after):
+        super().__init__('LLM工作佇列已滿，請稍後再試')
+        self.retry_after = retry_after
+
+class LLMJob:
+    """一個已提交的 LLM 查詢工作；合併到同一次呼叫的工作共用同一個 call"""
+    
+    def __init__(self, call, run, model, user, priority):
+        self.id = hashlib.sha1(os.urandom(16)).hexdigest()[:16]
+        self.call = call
+        self.run = run
+        self.model = model
+        self.user = user
+        self.priority = priority
+        self.created_at = time.time()
+
+class LLMJobScheduler:
+    """有界的 LLM 工作排程器：依優先順序分道排隊，並限制每個模型與每個使用者同時執行的工作數"""
+    
+    def __init__(self, workers=LLM_WORKERS, max_queue=LLM_QUEUE_SIZE,
+                 model_limit=LLM_MODEL_CONCURRENCY, user_limit=LLM_USER_CONCURRENCY, job_ttl=LLM_JOB_TTL):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.model_limit = model_limit
+        self.user_limit = user_limit
+        self.job_ttl = job_ttl
+        self._lanes = OrderedDict((lane, deque()) for lane in LLM_PRIORITY_LANES)
+        self._jobs = OrderedDict()
+        self._running_models = {}
+        self._running_users = {}
+        self._avg_duration = 5.0
+        self._threads = []
+        self._cond = threading.Condition()
+        self._stats = {'submitted': 0, 'rejected': 0, 'completed': 0}
+    
+    def _ensure_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'llm-worker-{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+    
+    def queued(self):
+        return sum(len(lane) for lane in self._lanes.values())
+    
+    def retry_after(self):
+        """依佇列長度與平均執行時間估計可以重試的秒數"""
+        return max(1, int(math.ceil(self.queued() * self._avg_duration / max(1, self.workers))))
+    
+    def submit(self, call, run, model, user, priority='interactive', track=True):
+        """提交工作；run 為 None 時表示合併到其他工作的呼叫，不需排入佇列。佇列已滿時拋出 QueueFullError
         
-        return backup_path
-    except Exception as e:
-        logger.error(f"創建檔案備份時發生錯誤: {str(e)}")
+        track 為 True 時工作會登記供之後以 ID 查詢，並持有 call 的一個等待者直到被取消或過期。
+        """
+        if priority not in self._lanes:
+            priority = LLM_PRIORITY_LANES[0]
+        job = LLMJob(call, run, model, user, priority)
+        
+        with self._cond:
+            self._prune()
+            if run is not None:
+                if self.queued() >= self.max_queue:
+                    self._stats['rejected'] += 1
+                    raise QueueFullError(self.retry_after())
+                self._ensure_workers()
+                self._lanes[priority].append(job)
+                self._cond.notify()
+            if track:
+                self._jobs[job.id] = job
+            self._stats['submitted'] += 1
+        return job
+    
+    def _prune(self):
+        """移除完成超過保留時間的工作"""
+        cutoff = time.time() - self.job_ttl
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if job.created_at > cutoff or not job.call.done:
+                break
+            self._jobs.popitem(last=False)
+            job.call.detach()
+    
+    def _next_job(self):
+        """依優先順序取出第一個未超過模型與使用者上限的工作"""
+        for lane in self._lanes.values():
+            for index, job in enumerate(lane):
+                if (self._running_models.get(job.model, 0) < self.model_limit and
+                        self._running_users.get(job.user, 0) < self.user_limit):
+                    del lane[index]
+                    return job
         return None
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running_models[job.model] = self._running_models.get(job.model, 0) + 1
+                self._running_users[job.user] = self._running_users.get(job.user, 0) + 1
+            
+            started = time.time()
+            try:
+                job.run()
+            except Exception as e:
+                logger.error(f"執行LLM工作 {job.id} 時發生錯誤: {str(e)}")
+            finally:
+                with self._cond:
+                    self._running_models[job.model] -= 1
+                    self._running_users[job.user] -= 1
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.time() - started)
+                    self._stats['completed'] += 1
+                    # 釋放名額後可能有被上限擋住的工作可以執行
+                    self._cond.notify_all()
+    
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+    
+    def cancel(self, job_id):
+        """取消工作：從登記中移除並離開共享的呼叫，沒有其他等待者時上游呼叫會停止"""
+        with self._cond:
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            return False
+        job.call.detach()
+        return True
+    
+    def describe(self, job):
+        """回傳工作的狀態資訊"""
+        call = job.call
+        if call.done:
+            status = 'failed' if call.error else 'done'
+        elif call.started:
+            status = 'running'
+        else:
+            status = 'queued'
+        
+        info = {'id': job.id, 'status': status, 'model': job.model, 'priority': job.priority,
+                'created_at': job.created_at}
+        if status == 'queued':
+            with self._cond:
+                position = 0
+                for lane in self._lanes.values():
+                    for queued_job in lane:
+                        if queued_job.call is call:
+                            info['position'] = position
+                            break
+                        position += 1
+        return info
+    
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'queued': {name: len(lane) for name, lane in self._lanes.items()},
+                'running': sum(self._running_models.values()),
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'jobs': len(self._jobs),
+                'avg_duration': round(self._avg_duration, 3)
+            })
+            return stats
 
-def is_path_safe(base_path, requested_path):
-    """確保請求的路徑在基礎路徑內，防止路徑遍歷攻擊"""
-    # 獲取規範化的絕對路徑
-    base_abs = os.path.abspath(base_path)
-    req_abs = os.path.abspath(os.path.join(base_path, requested_path))
+# LLM 工作排程器
+llm_scheduler = LLMJobScheduler()
+
+class ServerLifecycle:
+    """記錄伺服器的啟動時間、進行中的請求數與關閉狀態，供健康檢查與優雅關閉使用"""
     
-    # 檢查請求的路徑是否以基礎路徑開頭
-    return req_abs.startswith(base_abs)
+    def __init__(self):
+        self.started_at = time.time()
+        self.shutting_down = threading.Event()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+    
+    def request_started(self):
+        with self._cond:
+            self._in_flight += 1
+    
+    def request_finished(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+    
+    def in_flight(self):
+        with self._cond:
+            return self._in_flight
+    
+    def drain(self, timeout=SHUTDOWN_TIMEOUT):
+        """等待進行中的請求完成，回傳逾時後仍未完成的請求數"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._in_flight
+
+server_lifecycle = ServerLifecycle()
+
+@app.before_request
+def track_request_start():
+    server_lifecycle.request_started()
+
+@app.teardown_request
+def track_request_end(exc=None):
+    server_lifecycle.request_finished()
+
+@app.route('/healthz', methods=['GET'])
+def liveness():
+    """存活檢查：行程可以回應請求即為存活"""
+    return jsonify({'status': 'ok', 'uptime': round(time.time() - server_lifecycle.started_at, 1)})
+
+@app.route('/readyz', methods=['GET'])
+def readiness():
+    """就緒檢查：關閉中、自動保存線程停止或 LLM 工作佇列已滿時回傳 503"""
+    checks = {
+        'accepting': not server_lifecycle.shutting_down.is_set(),
+        'auto_saver': auto_saver.is_running(),
+        'llm_queue': llm_scheduler.queued() < llm_scheduler.max_queue
+    }
+    ready = all(checks.values())
+    return jsonify({'status': 'ready' if ready else 'unavailable', 'checks': checks,
+                    'in_flight': server_lifecycle.in_flight()}), 200 if ready else 503
+
+try:
+    import brotli
+except ImportError:
+    # 未安裝 brotli 時只提供 gzip 壓縮版本
+    brotli = None
+
+class StaticAsset:
+    """一個常駐記憶體的靜態資源及其預先壓縮的版本"""
+    __slots__ = ('path', 'source', 'mtime_ns', 'mimetype', 'digest', 'variants')
+    
+    def __init__(self, path, source, data, mtime_ns):
+        self.path = path
+        self.source = source
+        self.mtime_ns = mtime_ns
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.variants = {'identity': data}
+        
+        if len(data) >= STATIC_MIN_COMPRESS_BYTES and self.mimetype.startswith(STATIC_COMPRESSIBLE_TYPES):
+            # 優先使用建置時已產生的 .gz/.br 檔，否則在啟動時壓縮一次
+            for encoding, suffix, compress in (('gzip', '.gz', lambda d: gzip.compress(d, 9)),
+                                               ('br', '.br', brotli.compress if brotli else None)):
+                try:
+                    with open(source + suffix, 'rb') as f:
+                        self.variants[encoding] = f.read()
+                except OSError:
+                    if compress:
+                        self.variants[encoding] = compress(data)
+    
+    def fingerprinted_path(self):
+        """scripts.js -> scripts.<雜湊前 10 碼>.js"""
+        stem, ext = os.path.splitext(self.path)
+        return f'{stem}.{self.digest[:10]}{ext}'
+
+class StaticAssets:
+    """啟動時解析並快取靜態資源對照表，避免每個請求都檢查檔案系統
+    
+    資源以內容雜湊命名的別名提供長期快取；index.html 中的引用會改寫為這些別名。
+    auto_reload 為 True（開發模式）時，每次查詢會檢查來源檔是否已修改。
+    """
+    
+    def __init__(self, directories, auto_reload=False):
+        self.directories = directories
+        self.auto_reload = auto_reload
+        self._assets = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+        self.load()
+    
+    def _iter_sources(self):
+        """依優先順序列出 (資源路徑, 來源檔案)；靜態目錄優先於後備目錄"""
+        seen = set()
+        for directory, extensions in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for root, dirnames, filenames in os.walk(directory):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != '__pycache__']
+                for filename in filenames:
+                    source = os.path.join(root, filename)
+                    path = os.path.relpath(source, directory).replace(os.sep, '/')
+                    if path in seen or filename.endswith(('.gz', '.br')):
+                        continue
+                    if extensions is not None and os.path.splitext(filename)[1] not in extensions:
+                        continue
+                    seen.add(path)
+                    yield path, source
+    
+    def load(self):
+        """重新建立資源對照表"""
+        assets = {}
+        for path, source in self._iter_sources():
+            try:
+                stat = os.stat(source)
+                if stat.st_size > STATIC_MAX_CACHED_BYTES:
+                    continue
+                with open(source, 'rb') as f:
+                    assets[path] = StaticAsset(path, source, f.read(), stat.st_mtime_ns)
+            except OSError as e:
+                logger.warning(f"無法載入靜態資源 {source}: {str(e)}")
+        
+        fingerprints = {asset.fingerprinted_path(): asset for asset in assets.values()}
+        
+        # 入口頁改為引用加上雜湊的資源
+        index = assets.get('index.html')
+        if index is not None:
+            html = index.variants['identity'].decode('utf-8')
+            for path, asset in assets.items():
+                if path == 'index.html':
+                    continue
+                for attribute in ('href', 'src'):
+                    html = html.replace(f'{attribute}="{path}"', f'{attribute}="{asset.fingerprinted_path()}"')
+            assets['index.html'] = StaticAsset('index.html', index.source, html.encode('utf-8'), index.mtime_ns)
+        
+        with self._lock:
+            self._assets = assets
+            self._fingerprints = fingerprints
+        logger.info(f"已載入 {len(assets)} 個靜態資源")
+    
+    def _is_stale(self):
+        for asset in list(self._assets.values()):
+            try:
+                if os.stat(asset.source).st_mtime_ns != asset.mtime_ns:
+                    return True
+            except OSError:
+                return True
+        return False
+    
+    def get(self, path):
+        """回傳 (資源, 是否為含雜湊的別名)；找不到時回傳 (None, False)"""
+        if self.auto_reload and self._is_stale():
+            self.load()
+        with self._lock:
+            asset = self._fingerprints.get(path)
+            if asset is not None:
+                return asset, True
+            return self._assets.get(path), False
+    
+    def response(self, asset, immutable=False):
+        """依 Accept-Encoding 選擇壓縮版本，並處理 If-None-Match"""
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in asset.variants and candidate in request.accept_encodings:
+                encoding = candidate
+                break
+        
+        # 不同壓縮版本的位元組不同，ETag 也必須不同
+        etag = asset.digest[:16] if encoding == 'identity' else f'{asset.digest[:16]}-{encoding}'
+        headers = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': STATIC_IMMUTABLE_CACHE if immutable else STATIC_REVALIDATE_CACHE,
+            'Vary': 'Accept-Encoding'
+        }
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        
+        data = asset.variants[encoding]
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(data, mimetype=asset.mimetype, headers=headers)
 
-def auto_save_thread():
-    """定期保存修改的檔案的後台線程"""
-    while True:
-        current_time = time.time()
-        # 創建file_cache的副本進行迭代，避免在迭代過程中修改字典
-        files_to_check = dict(file_cache)
-        for file_path, content in files_to_check.items():
-            if file_path in last_save_time:
-                # 如果自上次保存以來已經過了設定的間隔時間
-                if current_time - last_save_time[file_path] >= AUTO_SAVE_INTERVAL:
-                    try:
-                        # 檢查檔案是否仍然存在
-                        if os.path.exists(file_path):
-                            with open(file_path, 'w', encoding='utf-8') as f:
-                                f.write(content)
-                            logger.info(f"自動保存檔案: {file_path}")
-                            # 從緩存中移除
-                            file_cache.pop(file_path, None)
-                            last_save_time.pop(file_path, None)
-                    except Exception as e:
-                        logger.error(f"自動保存檔案 {file_path} 時發生錯誤: {str(e)}")
-        time.sleep(1)  # 每秒檢查一次
+# 靜態資源對照表：static 資料夾優先，其次為本檔案所在目錄中的網頁檔案
+static_assets = StaticAssets(
+    [(app.static_folder, None),
+     (os.path.dirname(os.path.abspath(__file__)), STATIC_FALLBACK_EXTENSIONS)],
+    auto_reload=SERVER_MODE == 'development'
+)
 
 # 靜態檔案服務
 @app.route('/')
@@ -123,32 +3256,20 @@ def index():
 
 @app.route('/<path:path>')
 def static_files(path):
-    # 先檢查是否在static資料夾中
-    static_path = os.path.join(app.static_folder, path)
-    if os.path.exists(static_path) and os.path.isfile(static_path):
-        return send_from_directory(app.static_folder, path)
+    asset, immutable = static_assets.get(path)
+    if asset is not None:
+        return static_assets.response(asset, immutable)
     
-    # 否則嘗試從當前資料夾提供檔案
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    if os.path.exists(os.path.join(current_dir, path)) and os.path.isfile(os.path.join(current_dir, path)):
-        return send_from_directory(current_dir, path)
-        
     # 如果都不是，嘗試返回index.html
     return serve_main_page()
 
 def serve_main_page():
     """提供主頁面"""
-    # 優先檢查static資料夾中是否有index.html
-    static_index = os.path.join(app.static_folder, 'index.html')
-    if os.path.exists(static_index):
-        print(f"Found static index: {static_index}") 
-        return send_from_directory(app.static_folder, 'index.html')
-    
-    # 否則提供當前目錄中的vibe-coding.html
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    vibe_page = os.path.join(current_dir, 'vibe-coding.html')
-    if os.path.exists(vibe_page):
-        return send_from_directory(current_dir, 'vibe-coding.html')
+    # 優先使用static資料夾中的index.html，否則提供當前目錄中的vibe-coding.html
+    for name in ('index.html', 'vibe-coding.html'):
+        asset, _ = static_assets.get(name)
+        if asset is not None:
+            return static_assets.response(asset)
     
     # 如果都沒有，返回簡單的HTML訊息
     return "<html><body><h1>Vibe Coding Tool</h1><p>主頁面未找到，請確保static資料夾中有index.html或當前目錄有vibe-coding.html</p></body></html>"
@@ -163,20 +3284,162 @@ def set_workspace():
     if not directory or not os.path.isdir(directory):
         return jsonify({'success': False, 'error': '無效的目錄路徑'}), 400
     
-    global current_workspace
+    global current_workspace, workspace_index
+    try:
+        index = WorkspaceIndex(directory, SUPPORTED_EXTENSIONS)
+    except OSError as e:
+        return jsonify({'success': False, 'error': f'掃描目錄時發生錯誤: {str(e)}'}), 500
+    
     current_workspace = directory
+    workspace_index = index
+    
+    # 在背景建立搜尋索引，第一次搜尋時不需等待；最近用過的工作目錄沿用原本的索引
+    global search_index, related_index
+    if search_index is not None:
+        search_index.save()
+    if index.directory in recent_indexes:
+        search_index, related_index = recent_indexes.pop(index.directory)
+        search_index.workspace_index = related_index.workspace_index = index
+    else:
+        search_index = SearchIndex(index)
+        related_index = RelatedFileIndex(index)
+    recent_indexes[index.directory] = (search_index, related_index)
+    while len(recent_indexes) > MAX_RECENT_WORKSPACES:
+        recent_indexes.popitem(last=False)
+    
+    def build_indexes(search_index, related_index):
+        search_index.sync(True)
+        related_index.sync(True)
+    
+    threading.Thread(target=build_indexes, args=(search_index, related_index), daemon=True).start()
     
     return jsonify({'success': True, 'path': directory})
 
+@app.route('/api/search', methods=['GET'])
+def search():
+    """搜尋工作目錄：mode 為 literal（預設）、regex 或 symbol，可用 path 以萬用字元篩選檔案"""
+    if not current_workspace or search_index is None:
+        return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
+    
+    query = request.args.get('q', '')
+    mode = request.args.get('mode', 'literal')
+    path_glob = request.args.get('path') or None
+    case_sensitive = request.args.get('case') == '1'
+    if not query:
+        return jsonify({'success': False, 'error': '缺少搜尋字串'}), 400
+    if mode not in ('literal', 'regex', 'symbol'):
+        return jsonify({'success': False, 'error': f'不支援的搜尋模式: {mode}'}), 400
+    
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), MAX_SEARCH_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'success': False, 'error': '無效的分頁參數'}), 400
+    
+    started = time.time()
+    # 背景仍在建立索引時不等待，以已完成的部分搜尋並標示結果不完整
+    search_index.refresh()
+    indexing = search_index.indexing
+    complete = not indexing
+    if mode == 'symbol':
+        results = search_index.search_symbols(query, path_glob)
+    else:
+        try:
+            results, scanned_all = search_index.search_text(query, mode == 'regex', case_sensitive, path_glob)
+            complete = complete and scanned_all
+        except re.error as e:
+            return jsonify({'success': False, 'error': f'無效的正規表示式: {str(e)}'}), 400
+    
+    page = results[cursor:cursor + limit]
+    next_cursor = cursor + limit if cursor + limit < len(results) else None
+    return jsonify({
+        'success': True,
+        'results': page,
+        'total': len(results),
+        'next_cursor': next_cursor,
+        'complete': complete,
+        'indexing': indexing,
+        'elapsed': round(time.time() - started, 4)
+    })
+
+@app.route('/api/llm/related', methods=['POST'])
+def get_related_files():
+    """依提示詞推薦相關的檔案與區塊，exclude 為已選擇的檔案"""
+    if not current_workspace or related_index is None:
+        return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
+    
+    data = request.json or {}
+    prompt = data.get('prompt')
+    if not prompt:
+        return jsonify({'success': False, 'error': '缺少提示詞'}), 400
+    try:
+        k = min(max(int(data.get('k', RETRIEVAL_TOP_K)), 1), MAX_RETRIEVAL_TOP_K)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': '無效的 k'}), 400
+    
+    files = related_index.related(prompt, k, data.get('exclude', []))
+    return jsonify({'success': True, 'files': files, 'indexing': related_index.indexing})
+
+@app.route('/api/search/stats', methods=['GET'])
+def get_search_stats():
+    """獲取搜尋索引的統計資料"""
+    if search_index is None:
+        return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
+    return jsonify({'success': True, 'stats': search_index.stats()})
+
 @app.route('/api/files', methods=['GET'])
 def get_files():
     """獲取工作目錄中的檔案清單"""
     if not current_workspace:
         return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
     
-    files = get_file_list(current_workspace, SUPPORTED_EXTENSIONS)
+    files = workspace_index.files()
     return jsonify({'success': True, 'files': files})
 
+@app.route('/api/files/children', methods=['GET'])
+def get_directory_children():
+    """分頁獲取單一目錄下的子項目，供檔案樹延遲展開"""
+    if not current_workspace:
+        return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
+    
+    directory = request.args.get('dir', '').strip('/')
+    cursor = request.args.get('cursor')
+    
+    try:
+        limit = int(request.args.get('limit', DIRECTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'error': '無效的分頁大小'}), 400
+    limit = max(1, min(limit, MAX_DIRECTORY_PAGE_SIZE))
+    
+    # 防止路徑遍歷攻擊
+    if directory and not is_path_safe(current_workspace, directory):
+        return jsonify({'success': False, 'error': '無效的目錄路徑'}), 403
+    
+    directory = os.path.normpath(directory).replace(os.sep, '/') if directory else ''
+    if directory == '.':
+        directory = ''
+    
+    entries = workspace_index.children(directory)
+    if entries is None:
+        return jsonify({'success': False, 'error': '目錄不存在'}), 404
+    
+    # 游標為上一頁最後一個項目的排序鍵，檔案變動時分頁仍然穩定
+    start = 0
+    if cursor:
+        keys = [entry['key'] for entry in entries]
+        start = bisect.bisect_right(keys, cursor)
+    
+    page = entries[start:start + limit]
+    next_cursor = page[-1]['key'] if start + limit < len(entries) else None
+    
+    return jsonify({
+        'success': True,
+        'dir': directory,
+        'entries': page,
+        'total': len(entries),
+        'next_cursor': next_cursor
+    })
+
 @app.route('/api/file', methods=['GET'])
 def get_file_content():
     """獲取檔案內容"""
@@ -198,45 +3461,150 @@ def get_file_content():
         return jsonify({'success': False, 'error': '檔案不存在'}), 404
     
     try:
-        with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
+        size = os.path.getsize(full_path)
+        
+        # 二進位檔只讀取開頭判斷，不讀取內容
+        if is_binary_file(full_path):
+            return jsonify({'success': True, 'path': file_path, 'binary': True, 'size': size, 'content': None})
+        
+        large = size > LARGE_FILE_THRESHOLD
+        
+        # 位元組範圍：offset 與 length
+        if 'offset' in request.args:
+            offset = max(int(request.args['offset']), 0)
+            length = int(request.args.get('length', MAX_FILE_PAGE_BYTES))
+            if length < 1:
+                raise ValueError('length 必須大於 0')
+            content, end = read_byte_range(full_path, offset, length)
+            return jsonify({'success': True, 'path': file_path, 'content': content, 'size': size,
+                            'offset': offset, 'next_offset': end if end < size else None,
+                            'large': large, 'read_only': large})
+        
+        # 行範圍：start_line（從 1 開始）與 lines；大型檔案預設只回傳第一頁
+        if 'start_line' in request.args or large:
+            start_line = max(int(request.args.get('start_line', 1)), 1)
+            count = max(int(request.args.get('lines', FILE_PAGE_LINES)), 1)
+            index = line_index_cache.get(full_path)
+            data, read, truncated = index.read_lines(start_line - 1, count)
+            end_line = start_line + read - 1
+            result = {'success': True, 'path': file_path, 'content': data.decode('utf-8', errors='replace'),
+                      'size': size, 'total_lines': index.total_lines,
+                      'start_line': start_line, 'end_line': end_line,
+                      'next_line': end_line + 1 if end_line < index.total_lines else None,
+                      'large': large, 'read_only': large}
+            if truncated:
+                # 最後一行過長只回傳了開頭，其餘部分可用 offset 參數依位元組讀取
+                next_offset, line_end = truncated
+                result['truncated'] = {'line': end_line, 'next_offset': next_offset,
+                                       'omitted_bytes': line_end - next_offset}
+            return jsonify(result)
+        
+        def load_disk():
+            # 內容未變更時（If-None-Match 與目前的雜湊相同）不需讀取檔案，回傳 (None, 雜湊)
+            stat = os.stat(full_path)
+            digest = file_content_cache.digest(full_path, stat)
+            if digest and digest in request.if_none_match:
+                return None, digest
+            return file_content_cache.read(full_path, stat)
+        
+        # 版本號作為差異更新的基準；有未保存的變更時回傳緩衝區內容，而不是磁碟上較舊的內容
+        content, version, buffered = buffer_store.read(full_path, load_disk)
+        headers = {'Cache-Control': 'no-cache', 'X-File-Version': str(version)}
+        if buffered:
+            response = jsonify({'success': True, 'content': content, 'path': file_path, 'size': size,
+                                'version': version})
+            response.headers['X-File-Version'] = str(version)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        
+        data, digest = content
+        if data is None or digest in request.if_none_match:
+            return Response(status=304, headers=dict(headers, ETag=f'"{digest}"'))
+        content = data.decode('utf-8', errors='ignore')
         
-        # 創建備份 (首次打開檔案時)
-        create_file_backup(full_path)
+        # 記錄快照作為差異比較的基準 (內容未變時不會重複寫入)
+        snapshot_store.record(file_path, data, digest)
         
-        return jsonify({'success': True, 'content': content, 'path': file_path})
+        response = jsonify({'success': True, 'content': content, 'path': file_path, 'size': size,
+                            'version': version})
+        response.headers.update(headers)
+        response.headers['ETag'] = f'"{digest}"'
+        return response
+    except ValueError:
+        return jsonify({'success': False, 'error': '無效的範圍參數'}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': f'讀取檔案時發生錯誤: {str(e)}'}), 500
 
+@app.route('/api/files/batch', methods=['POST'])
+def get_files_batch():
+    """一次獲取多個檔案的內容"""
+    if not current_workspace:
+        return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
+    
+    data = request.json or {}
+    paths = data.get('paths')
+    
+    if not isinstance(paths, list) or not paths:
+        return jsonify({'success': False, 'error': '未指定檔案路徑'}), 400
+    
+    if len(paths) > MAX_BATCH_FILES:
+        return jsonify({'success': False, 'error': f'一次最多讀取 {MAX_BATCH_FILES} 個檔案'}), 400
+    
+    files, errors = read_workspace_files(paths)
+    return jsonify({'success': True, 'files': files, 'errors': errors})
+
 @app.route('/api/file', methods=['PUT'])
 def update_file_content():
-    """更新檔案內容"""
+    """更新檔案內容
+    
+    可傳送完整內容 (content)，或傳送相對於 base_version 的行編輯 (edits)；
+    base_version 不是目前版本時回傳 409，由前端重新載入最新版本後合併或由使用者決定。
+    """
     if not current_workspace:
         return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
     
     data = request.json
     file_path = data.get('path')
     content = data.get('content')
+    edits = data.get('edits')
+    base_version = data.get('base_version')
     
-    if not file_path or content is None:
+    if not file_path or (content is None and edits is None):
         return jsonify({'success': False, 'error': '缺少必要參數'}), 400
     
+    if edits is not None and (not isinstance(edits, list) or not isinstance(base_version, int)):
+        return jsonify({'success': False, 'error': '差異更新需要 edits 列表與 base_version'}), 400
+    
     # 防止路徑遍歷攻擊
     if not is_path_safe(current_workspace, file_path):
         return jsonify({'success': False, 'error': '無效的檔案路徑'}), 403
     
-    full_path = os.path.join(current_workspace, file_path)
+    full_path = os.path.normpath(os.path.join(current_workspace, file_path))
     
     # 檢查檔案是否存在
     if not os.path.isfile(full_path):
         return jsonify({'success': False, 'error': '檔案不存在'}), 404
     
+    # 大型檔案在編輯器中只載入部分內容，整份覆寫會遺失其餘內容
+    if os.path.getsize(full_path) > LARGE_FILE_THRESHOLD:
+        return jsonify({'success': False, 'error': '檔案過大，僅能以唯讀模式檢視'}), 409
+    
     try:
-        # 更新緩存而不是直接寫入檔案
-        file_cache[full_path] = content
-        last_save_time[full_path] = time.time()
+        # 更新緩衝區而不是直接寫入檔案，由自動保存排程器延遲寫回
+        if edits is not None:
+            def load_base():
+                stat = os.stat(full_path)
+                return file_content_cache.read(full_path, stat)[0].decode('utf-8', errors='ignore')
+            version = buffer_store.apply_edits(full_path, base_version, edits, load_base)
+        else:
+            version = buffer_store.update(full_path, content, base_version)
+        auto_saver.schedule(full_path)
         
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'version': version})
+    except VersionConflictError as e:
+        return jsonify({'success': False, 'error': str(e), 'conflict': True, 'version': e.version}), 409
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': f'更新檔案時發生錯誤: {str(e)}'}), 500
 
@@ -256,75 +3624,183 @@ def force_save_file():
     if not is_path_safe(current_workspace, file_path):
         return jsonify({'success': False, 'error': '無效的檔案路徑'}), 403
     
-    full_path = os.path.join(current_workspace, file_path)
+    full_path = os.path.normpath(os.path.join(current_workspace, file_path))
     
-    if full_path not in file_cache:
+    if not buffer_store.is_dirty(full_path):
         return jsonify({'success': False, 'error': '沒有待保存的變更'}), 400
     
     try:
-        with open(full_path, 'w', encoding='utf-8') as f:
-            f.write(file_cache[full_path])
-        
-        # 從緩存中移除
-        file_cache.pop(full_path, None)
-        last_save_time.pop(file_path, None)
+        auto_saver.cancel(full_path)
+        buffer_store.save(full_path)
         
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': f'保存檔案時發生錯誤: {str(e)}'}), 500
 
+@app.route('/api/buffers/stats', methods=['GET'])
+def get_buffer_stats():
+    """獲取編輯緩衝區的統計資料"""
+    stats = buffer_store.stats()
+    stats['pending_saves'] = len(auto_saver.pending())
+    stats['file_cache'] = file_content_cache.stats()
+    return jsonify({'success': True, 'stats': stats})
+
 @app.route('/api/llm/models', methods=['GET'])
 def get_llm_models():
     """獲取可用的 LLM 模型"""
     return jsonify({'success': True, 'models': LLM_MODELS})
 
-@app.route('/api/llm/query', methods=['POST'])
-def llm_query():
-    """向 LLM 提交查詢"""
+def submit_llm_query(data, track=True):
+    """驗證查詢並提交給排程器，回傳 (job, headers, 錯誤回應)
+    
+    快取命中或合併到進行中呼叫的查詢不會排入佇列；track 為 False 時工作不會登記給非同步 API 查詢。
+    """
     if not current_workspace:
-        return jsonify({'success': False, 'error': '未選擇工作目錄'}), 400
+        return None, None, (jsonify({'success': False, 'error': '未選擇工作目錄'}), 400)
     
-    data = request.json
     prompt = data.get('prompt')
     files = data.get('files', [])
     model_id = data.get('model')
     
     if not prompt:
-        return jsonify({'success': False, 'error': '缺少提示詞'}), 400
+        return None, None, (jsonify({'success': False, 'error': '缺少提示詞'}), 400)
     
     if not model_id:
-        return jsonify({'success': False, 'error': '缺少模型 ID'}), 400
+        return None, None, (jsonify({'success': False, 'error': '缺少模型 ID'}), 400)
+    
+    # auto_context：由檢索索引補上與提示詞相關的檔案
+    retrieved = []
+    if data.get('auto_context') and related_index is not None:
+        selected = [file if isinstance(file, str) else file.get('path') for file in files]
+        try:
+            k = min(max(int(data.get('k', RETRIEVAL_TOP_K)), 1), MAX_RETRIEVAL_TOP_K)
+        except (TypeError, ValueError):
+            k = RETRIEVAL_TOP_K
+        retrieved = [r['path'] for r in related_index.related(prompt, k, exclude=selected) if r['score'] > 0]
+        files = list(files) + retrieved
+    
+    # 只提供路徑的檔案由伺服器端從緩衝區或磁碟讀取內容
+    files, errors = resolve_llm_files(files)
+    if errors:
+        details = ', '.join(f"{e['path']} ({e['error']})" for e in errors)
+        return None, None, (jsonify({'success': False, 'error': f'讀取檔案時發生錯誤: {details}'}), 400)
+    
+    llm_request, context_info = build_llm_request(prompt, files, model_id)
+    if retrieved:
+        context_info['retrieved_files'] = retrieved
+    
+    # 相同模型、提示詞與檔案內容的查詢直接使用快取的回應（no_cache 可略過快取）
+    cache_key = LLMResponseCache.make_key(model_id, llm_request['temperature'], prompt, files)
+    cached, cache_tier = (None, None) if data.get('no_cache') else llm_cache.get(cache_key)
+    headers = {'X-LLM-Cache': 'HIT' if cached else 'MISS'}
+    if cache_tier:
+        headers['X-LLM-Cache-Tier'] = cache_tier
+    
+    user = request.headers.get('X-Vibe-User') or request.remote_addr or 'anonymous'
+    priority = data.get('priority', LLM_PRIORITY_LANES[0])
+    
+    if cached:
+        return llm_scheduler.submit(InFlightLLMCall.completed(cached), None, model_id, user, priority, track), headers, None
+    
+    def producer(call):
+        result = run_llm_call(call, llm_request, files, context_info)
+        if result and not result['changes'].get('error'):
+            llm_cache.set(cache_key, result)
+    
+    # 相同查詢正在進行時直接加入等待，共用同一次上游呼叫；否則排入工作佇列
+    call, started = llm_single_flight.join(None if data.get('no_cache') else cache_key)
+    if not started:
+        headers['X-LLM-Coalesced'] = '1'
+        return llm_scheduler.submit(call, None, model_id, user, priority, track), headers, None
     
     try:
-        # 這裡包裝請求發送給LLM API，您需要替換為實際的API端點和認證方式
-        # 這是一個示例實現
-        llm_request = {
-            'model': model_id,
-            'messages': [
-                {'role': 'system', 'content': '你是一個幫助分析和改進代碼的助手。請以git風格提出修改建議。'},
-                {'role': 'user', 'content': format_llm_request(prompt, files)}
-            ],
-            'temperature': 0.7
-        }
-        
-        # 這是LLM API的調用，需要根據公司內部的API進行修改
-        # response = requests.post('https://your-llm-api-endpoint/completions', json=llm_request)
-        # llm_response = response.json()['choices'][0]['message']['content']
-        
-        # 由於這是示例，我們模擬一個響應
-        llm_response = "這是模擬的LLM響應。在實際使用時，這裡會包含LLM返回的代碼修改建議，使用git風格的差異格式。"
-        
-        # 將LLM響應發送給LLM應用程序進行處理
-        processed_result = process_with_llm_app(llm_response, files)
-        
-        return jsonify({
-            'success': True, 
-            'response': llm_response,
-            'changes': processed_result
-        })
+        job = llm_scheduler.submit(call, lambda: llm_single_flight.run(call, producer),
+                                    model_id, user, priority, track)
+    except QueueFullError as e:
+        llm_single_flight.abandon(call, str(e))
+        headers['Retry-After'] = str(e.retry_after)
+        return None, headers, (jsonify({'success': False, 'error': str(e)}), 429, headers)
+    return job, headers, None
+
+@app.route('/api/llm/query', methods=['POST'])
+def llm_query():
+    """向 LLM 提交查詢並等待結果"""
+    job, headers, error = submit_llm_query(request.json, track=False)
+    if error:
+        return error
+    
+    # 串流模式：以 Server-Sent Events 逐段回傳 LLM 產生的文字
+    if request.json.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(stream_llm_events(job.call)),
+                        mimetype='text/event-stream',
+                        headers=dict(headers, **{'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}))
+    
+    try:
+        result = job.call.wait()
+        return jsonify(dict(result, success=True)), 200, headers
     except Exception as e:
-        logger.error(f"LLM查詢時發生錯誤: {str(e)}")
-        return jsonify({'success': False, 'error': f'LLM查詢時發生錯誤: {str(e)}'}), 500
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        job.call.detach()
+
+@app.route('/api/llm/jobs', methods=['POST'])
+def submit_llm_job():
+    """提交非同步的 LLM 查詢工作，回傳工作 ID"""
+    job, headers, error = submit_llm_query(request.json)
+    if error:
+        return error
+    return jsonify({'success': True, 'job': llm_scheduler.describe(job)}), 202, headers
+
+@app.route('/api/llm/jobs/<job_id>', methods=['GET'])
+def get_llm_job(job_id):
+    """查詢 LLM 工作的狀態，完成時一併回傳結果"""
+    job = llm_scheduler.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': '工作不存在'}), 404
+    
+    response = {'success': True, 'job': llm_scheduler.describe(job)}
+    if job.call.done:
+        if job.call.error:
+            response['error'] = job.call.error
+        else:
+            response.update(job.call.result)
+    return jsonify(response)
+
+@app.route('/api/llm/jobs/<job_id>/stream', methods=['GET'])
+def stream_llm_job(job_id):
+    """以 Server-Sent Events 串流 LLM 工作的輸出"""
+    job = llm_scheduler.get(job_id)
+    if job is None or not job.call.attach():
+        return jsonify({'success': False, 'error': '工作不存在'}), 404
+    return Response(stream_with_context(stream_llm_events(job.call)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/llm/jobs/<job_id>', methods=['DELETE'])
+def cancel_llm_job(job_id):
+    """取消 LLM 工作"""
+    if not llm_scheduler.cancel(job_id):
+        return jsonify({'success': False, 'error': '工作不存在'}), 404
+    return jsonify({'success': True})
+
+@app.route('/api/admin/llm/router', methods=['GET'])
+def get_llm_router_stats():
+    """獲取LLM端點路由的統計資料：各端點的延遲、進行中請求數、健康狀態與斷路器狀態"""
+    if llm_router is None:
+        return jsonify({'success': True, 'enabled': False})
+    return jsonify({'success': True, 'enabled': True, 'stats': llm_router.stats(),
+                    'circuits': upstream_client.stats()})
+
+@app.route('/api/llm/jobs/stats', methods=['GET'])
+def get_llm_job_stats():
+    """獲取LLM工作排程器的統計資料"""
+    return jsonify({'success': True, 'stats': llm_scheduler.stats()})
+
+@app.route('/api/llm/cache/stats', methods=['GET'])
+def get_llm_cache_stats():
+    """獲取LLM回應快取與請求合併的統計資料"""
+    return jsonify({'success': True, 'stats': llm_cache.stats(),
+                    'single_flight': llm_single_flight.stats()})
 
 @app.route('/api/diff', methods=['GET'])
 def get_file_diff():
@@ -342,38 +3818,61 @@ def get_file_diff():
         return jsonify({'success': False, 'error': '無效的檔案路徑'}), 403
     
     full_path = os.path.join(current_workspace, file_path)
-    backup_filename = os.path.basename(full_path) + ".backup"
-    backup_path = os.path.join(TEMP_DIR, backup_filename)
+    original_data = snapshot_store.get(file_path)
     
-    if not os.path.isfile(full_path) or not os.path.isfile(backup_path):
+    if not os.path.isfile(full_path) or original_data is None:
         return jsonify({'success': False, 'error': '無法比較檔案，原始備份不存在'}), 404
     
+    # 選項: format=text|hunks、content=0 不回傳完整內容、stream=1 以串流輸出差異、engine=myers|difflib
+    output_format = request.args.get('format', 'text')
+    include_content = request.args.get('content', '1') != '0'
+    stream = request.args.get('stream') == '1'
+    engine = request.args.get('engine')
+    
+    if engine and engine not in DIFF_ENGINES:
+        return jsonify({'success': False, 'error': f'不支援的差異演算法: {engine}'}), 400
+    
+    if max(len(original_data), os.path.getsize(full_path)) > MAX_DIFF_FILE_SIZE:
+        return jsonify({'success': False, 'error': '檔案過大，無法比較'}), 413
+    
     try:
-        # 讀取原始檔案
-        with open(backup_path, 'r', encoding='utf-8', errors='ignore') as f:
-            original_content = f.readlines()
+        # 讀取原始快照
+        original_text = io.StringIO(original_data.decode('utf-8', errors='ignore'), newline=None).read()
         
         # 讀取當前檔案
         with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
-            current_content = f.readlines()
+            current_text = f.read()
         
         # 產生差異
-        diff = difflib.unified_diff(
-            original_content, 
-            current_content,
-            fromfile=f'a/{file_path}',
-            tofile=f'b/{file_path}',
-            lineterm=''
-        )
+        original_lines = original_text.splitlines()
+        current_lines = current_text.splitlines()
+        opcodes, exact = compute_opcodes(original_lines, current_lines, engine)
         
-        diff_text = '\n'.join(diff)
+        if stream:
+            def generate():
+                lines = iter_unified_diff(original_lines, current_lines,
+                                          f'a/{file_path}', f'b/{file_path}', opcodes)
+                chunk = list(itertools.islice(lines, DIFF_STREAM_CHUNK_LINES))
+                while chunk:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = list(itertools.islice(lines, DIFF_STREAM_CHUNK_LINES))
+            
+            response = Response(generate(), mimetype='text/x-diff')
+            response.headers['X-Diff-Exact'] = '1' if exact else '0'
+            return response
         
-        return jsonify({
-            'success': True, 
-            'diff': diff_text,
-            'original': ''.join(original_content),
-            'current': ''.join(current_content)
-        })
+        result = {'success': True, 'exact': exact}
+        if output_format == 'hunks':
+            result['hunks'] = list(iter_diff_hunks(original_lines, current_lines, opcodes))
+        else:
+            result['diff'] = '\n'.join(iter_unified_diff(
+                original_lines, current_lines, f'a/{file_path}', f'b/{file_path}', opcodes))
+        
+        if include_content:
+            result['original'] = original_text
+            result['current'] = current_text
+        
+        return jsonify(result)
     except Exception as e:
         return jsonify({'success': False, 'error': f'產生差異時發生錯誤: {str(e)}'}), 500
 
@@ -389,56 +3888,267 @@ def apply_git_changes():
     if not changes:
         return jsonify({'success': False, 'error': '未提供變更內容'}), 400
     
+    dry_run = bool(data.get('dry_run'))
+    
     try:
-        # 創建臨時檔案來存儲變更
-        patch_file = os.path.join(TEMP_DIR, 'changes.patch')
-        with open(patch_file, 'w', encoding='utf-8') as f:
-            f.write(changes)
-        
-        # 使用git apply來應用變更
-        result = subprocess.run(
-            ['git', 'apply', '--reject', '--whitespace=fix', patch_file],
-            cwd=current_workspace,
-            capture_output=True,
-            text=True
-        )
+        patches = parse_unified_diff(changes)
+        if not patches:
+            return jsonify({'success': False, 'error': '無法解析變更內容'}), 400
         
-        if result.returncode != 0:
-            logger.error(f"應用變更失敗: {result.stderr}")
-            return jsonify({
-                'success': False, 
-                'error': f'應用變更失敗: {result.stderr}'
-            }), 500
+        results = [apply_file_patch(patch, dry_run) for patch in patches]
         
         # 獲取受影響的檔案清單
-        affected_files = []
-        for line in result.stdout.split('\n'):
-            if line.startswith('patching file '):
-                file_path = line.replace('patching file ', '').strip()
-                affected_files.append(file_path)
+        affected_files = [r['path'] for r in results if r['status'] != 'rejected']
+        failed = [r for r in results if r['status'] in ('rejected', 'partial')]
+        
+        if failed:
+            details = ', '.join(f"{r['path']} ({r.get('error', r['status'])})" for r in failed)
+            logger.error(f"應用變更失敗: {details}")
+            return jsonify({
+                'success': False,
+                'error': f'部分變更無法套用: {details}',
+                'dry_run': dry_run,
+                'affected_files': affected_files,
+                'files': results
+            }), 409
         
         return jsonify({
             'success': True,
-            'message': '變更已成功應用',
-            'affected_files': affected_files
+            'message': '變更檢查通過' if dry_run else '變更已成功應用',
+            'dry_run': dry_run,
+            'affected_files': affected_files,
+            'files': results
         })
     except Exception as e:
         logger.error(f"應用變更時發生錯誤: {str(e)}")
         return jsonify({'success': False, 'error': f'應用變更時發生錯誤: {str(e)}'}), 500
 
-def format_llm_request(prompt, files):
-    """格式化發送給LLM的請求"""
-    request_text = f"{prompt}\n\n"
-    request_text += "以下是相關代碼文件：\n\n"
+def estimate_tokens(text):
+    """以 UTF-8 位元組數粗估 token 數（約 4 bytes 一個 token）"""
+    size = len(text) if text.isascii() else len(text.encode('utf-8'))
+    return (size + 3) // 4
+
+# 各模型的 token 計算函數（以模型 ID 前綴比對），找不到時使用 estimate_tokens
+TOKENIZERS = {}
+
+def register_tokenizer(model_prefix, count_func):
+    """註冊模型的 token 計算函數"""
+    TOKENIZERS[model_prefix] = count_func
+
+try:
+    import tiktoken
+    
+    def _tiktoken_counter(encoding_name):
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    
+    register_tokenizer('gpt-', _tiktoken_counter('cl100k_base'))
+except Exception:
+    # 未安裝 tiktoken（或無法下載編碼表）時使用估算值
+    pass
+
+def count_tokens(text, model_id=None):
+    """計算文字的 token 數"""
+    if model_id:
+        for prefix, count_func in TOKENIZERS.items():
+            if model_id.startswith(prefix):
+                return count_func(text)
+    return estimate_tokens(text)
+
+def get_context_budget(model_id):
+    """取得模型可用於輸入的 token 數"""
+    model = next((m for m in LLM_MODELS if m['id'] == model_id), None)
+    context_window = model.get('context_window', DEFAULT_CONTEXT_WINDOW) if model else DEFAULT_CONTEXT_WINDOW
+    return max(context_window - LLM_RESPONSE_TOKEN_RESERVE, 0)
+
+def extract_terms(text):
+    """取出用於相關性比對的詞（識別字會再依 snake_case / camelCase 拆開）"""
+    terms = []
+    for word in re.findall(r'[A-Za-z_][A-Za-z0-9_]+', text):
+        lowered = word.lower()
+        terms.append(lowered)
+        parts = re.findall(r'[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])', word)
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts if len(part) > 1)
+    return terms
+
+def score_relevance(prompt_terms, text, path=''):
+    """以詞頻計算內容與提示詞的相關性；提示詞提到檔名時額外加分"""
+    if not prompt_terms:
+        return 0.0
+    counts = {}
+    for term in extract_terms(text):
+        if term in prompt_terms:
+            counts[term] = counts.get(term, 0) + 1
+    score = sum(math.log1p(count) for count in counts.values())
+    
+    path_terms = set(extract_terms(path))
+    score += 5.0 * len(path_terms & prompt_terms)
+    return score
+
+def _render_file(parts, path, content, line_range=None):
+    header = f"文件: {path}" if line_range is None else f"文件: {path} (第 {line_range[0]}-{line_range[1]} 行)"
+    parts.append(f"{header}\n```\n{content}\n```\n\n")
+
+def build_llm_context(prompt, files, model_id=None):
+    """組合提示詞與檔案內容；超過模型的 token 預算時依相關性挑選檔案或片段，回傳 (文字, 統計)"""
+    intro = f"{prompt}\n\n以下是相關代碼文件：\n\n"
+    outro = "請分析這些代碼，並以git差異的格式提出改進建議。"
+    budget = get_context_budget(model_id) - count_tokens(LLM_SYSTEM_PROMPT + intro + outro, model_id)
+    
+    file_tokens = [count_tokens(file['content'], model_id) + count_tokens(file['path'], model_id) + 8
+                   for file in files]
+    info = {'budget': max(budget, 0), 'files': len(files), 'truncated_files': [], 'omitted_files': []}
+    parts = [intro]
     
+    # 全部放得下時維持原本的順序與內容
+    if sum(file_tokens) <= budget:
+        for file in files:
+            _render_file(parts, file['path'], file['content'])
+        parts.append(outro)
+        info['used_tokens'] = sum(file_tokens)
+        return ''.join(parts), info
+    
+    prompt_terms = set(extract_terms(prompt))
+    ranked = sorted(range(len(files)), reverse=True,
+                    key=lambda i: score_relevance(prompt_terms, files[i]['content'], files[i]['path']))
+    
+    # 第一階段：依相關性放入完整檔案
+    remaining = budget
+    whole, partial = [], []
+    for i in ranked:
+        if file_tokens[i] <= remaining:
+            whole.append(i)
+            remaining -= file_tokens[i]
+        else:
+            partial.append(i)
+    
+    # 第二階段：其餘檔案切塊，依相關性放入片段
+    rank_of = {i: rank for rank, i in enumerate(ranked)}
+    chunks = []
+    for i in partial:
+        lines = files[i]['content'].splitlines()
+        for start in range(0, len(lines), CONTEXT_CHUNK_LINES):
+            text = '\n'.join(lines[start:start + CONTEXT_CHUNK_LINES])
+            score = score_relevance(prompt_terms, text, files[i]['path'])
+            chunks.append((score, -rank_of[i], -start, i, start, text))
+    chunks.sort(reverse=True)
+    
+    selected = {}
+    for score, _, _, i, start, text in chunks:
+        tokens = count_tokens(text, model_id) + count_tokens(files[i]['path'], model_id) + 16
+        if tokens <= remaining:
+            selected.setdefault(i, []).append((start, text))
+            remaining -= tokens
+    
+    for i in ranked:
+        path = files[i]['path']
+        if i in whole:
+            _render_file(parts, path, files[i]['content'])
+        elif i in selected:
+            info['truncated_files'].append(path)
+            # 相鄰的片段合併成一段輸出
+            merged = []
+            for start, text in sorted(selected[i]):
+                if merged and merged[-1][1] == start:
+                    merged[-1] = (merged[-1][0], start + CONTEXT_CHUNK_LINES, merged[-1][2] + [text])
+                else:
+                    merged.append((start, start + CONTEXT_CHUNK_LINES, [text]))
+            for start, _, texts in merged:
+                text = '\n'.join(texts)
+                _render_file(parts, path, text, (start + 1, start + text.count('\n') + 1))
+        else:
+            info['omitted_files'].append(path)
+    
+    parts.append(outro)
+    info['used_tokens'] = budget - remaining
+    return ''.join(parts), info
+
+def format_llm_request(prompt, files, model_id=None):
+    """格式化發送給LLM的請求"""
+    return build_llm_context(prompt, files, model_id)[0]
+
+def resolve_llm_files(files):
+    """補上只有路徑（字串或沒有 content 的物件）的檔案內容，回傳 (檔案清單, 錯誤清單)"""
+    resolved = []
+    missing = []
     for file in files:
-        request_text += f"文件: {file['path']}\n"
-        request_text += "```\n"
-        request_text += file['content']
-        request_text += "\n```\n\n"
+        if isinstance(file, str):
+            missing.append(file)
+        elif file.get('content') is None:
+            missing.append(file.get('path'))
+        else:
+            resolved.append(file)
+    
+    if not missing:
+        return resolved, []
+    
+    loaded, errors = read_workspace_files(missing)
+    return resolved + loaded, errors
+
+def build_llm_request(prompt, files, model_id):
+    """建立發送給LLM API的請求內容，回傳 (請求, context 統計)"""
+    content, context_info = build_llm_context(prompt, files, model_id)
+    llm_request = {
+        'model': model_id,
+        'messages': [
+            {'role': 'system', 'content': LLM_SYSTEM_PROMPT},
+            {'role': 'user', 'content': content}
+        ],
+        'temperature': 0.7
+    }
+    return llm_request, context_info
+
+def iter_llm_completion(llm_request):
+    """經由路由器向LLM端點請求串流回應，逐段產生文字；生成器被關閉時一併關閉上游連線"""
+    if llm_router is None:
+        # 未設定LLM API時，模擬一個逐段產生的響應
+        llm_response = "這是模擬的LLM響應。在實際使用時，這裡會包含LLM返回的代碼修改建議，使用git風格的差異格式。"
+        for start in range(0, len(llm_response), 8):
+            yield llm_response[start:start + 8]
+        return
+    
+    yield from llm_router.iter_completion(llm_request)
+
+def sse_event(event, data):
+    """格式化一個 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def run_llm_call(call, llm_request, files, context_info=None):
+    """執行上游LLM呼叫並把文字片段寫入共享的 call；所有等待者都離開時提前結束"""
+    chunks = []
+    completion = iter_llm_completion(llm_request)
+    try:
+        for text in completion:
+            if call.cancelled:
+                # 所有客戶端已中斷連線，關閉 completion 時會一併取消上游請求
+                logger.info("客戶端中斷LLM串流")
+                return None
+            chunks.append(text)
+            call.add_chunk(text)
+    finally:
+        completion.close()
+    
+    llm_response = ''.join(chunks)
     
-    request_text += "請分析這些代碼，並以git差異的格式提出改進建議。"
-    return request_text
+    # 將LLM響應發送給LLM應用程序進行處理
+    processed_result = process_with_llm_app(llm_response, files)
+    result = {'response': llm_response, 'changes': processed_result, 'context': context_info}
+    call.finish(result)
+    return result
+
+def stream_llm_events(call):
+    """把共享的LLM呼叫轉成 SSE 事件：token 為每段文字，done 為完整結果，error 為錯誤"""
+    try:
+        for text in call.iter_chunks():
+            yield sse_event('token', {'text': text})
+        
+        if call.error:
+            yield sse_event('error', {'error': call.error})
+        else:
+            yield sse_event('done', call.result)
+    finally:
+        call.detach()
 
 def process_with_llm_app(llm_response, files):
     """將LLM回應發送給LLM應用程序進行處理"""
@@ -449,15 +4159,14 @@ def process_with_llm_app(llm_response, files):
             'files': files
         }
         
-        # 这里是调用LLM应用的代码，需要根据实际情况修改
-        # response = requests.post(LLM_APP_ENDPOINT, json=app_request)
-        # if response.status_code == 200:
-        #     return response.json()
-        # else:
-        #     logger.error(f"LLM應用處理失敗: {response.text}")
-        #     return {'error': 'LLM應用處理失敗'}
+        if LLM_APP_ENDPOINT:
+            response = upstream_client.post(LLM_APP_ENDPOINT, json=app_request)
+            if response.status_code == 200:
+                return response.json()
+            logger.error(f"LLM應用處理失敗: {response.text}")
+            return {'error': 'LLM應用處理失敗'}
         
-        # 由於這是示例，模擬一個回應
+        # 未設定LLM應用程序端點時，模擬一個回應
         return {
             'changes': '模擬的git變更內容',
             'affected_files': [file['path'] for file in files]
@@ -466,16 +4175,62 @@ def process_with_llm_app(llm_response, files):
         logger.error(f"調用LLM應用時發生錯誤: {str(e)}")
         return {'error': f'調用LLM應用時發生錯誤: {str(e)}'}
 
+def shutdown_gracefully(stop_server):
+    """停止接收新請求、等待進行中的請求完成、把尚未保存的編輯寫回磁碟，最後才關閉伺服器
+    
+    關閉伺服器後主執行緒會立即返回並結束程式，因此所有寫回都必須在 stop_server() 之前完成。
+    """
+    server_lifecycle.shutting_down.set()
+    logger.info("收到關閉信號，等待進行中的請求完成...")
+    remaining = server_lifecycle.drain()
+    if remaining:
+        logger.warning(f"等待逾時，仍有 {remaining} 個請求未完成")
+    
+    auto_saver.stop()
+    # 未排入自動保存的緩衝區（例如保存失敗後等待重試的檔案）也一併寫回
+    for path in buffer_store.dirty_paths():
+        try:
+            save_buffered_file(path)
+        except Exception as e:
+            logger.error(f"關閉前保存檔案 {path} 時發生錯誤: {str(e)}")
+    if search_index is not None:
+        search_index.save()
+    stop_server()
+
+def serve_production(host, port, threads=SERVER_THREADS):
+    """以多執行緒伺服器提供服務，收到 SIGTERM/SIGINT 時優雅關閉"""
+    try:
+        from waitress.server import create_server
+        server = create_server(app, host=host, port=port, threads=threads)
+        run_server, stop_server = server.run, server.close
+        logger.info(f"使用 waitress 伺服器，{threads} 個執行緒")
+    except ImportError:
+        server = make_server(host, port, app, threaded=True)
+        run_server, stop_server = server.serve_forever, server.shutdown
+        logger.info("未安裝 waitress，使用 werkzeug 多執行緒伺服器")
+    
+    shutdown_threads = []
+    
+    def handle_signal(signum, frame):
+        if not server_lifecycle.shutting_down.is_set():
+            # 伺服器必須由其他執行緒停止，信號處理函式本身需立即返回
+            thread = threading.Thread(target=shutdown_gracefully, args=(stop_server,), name='shutdown')
+            shutdown_threads.append(thread)
+            thread.start()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    run_server()
+    # 伺服器停止後，等待關閉流程（寫回與保存索引）完成才返回
+    for thread in shutdown_threads:
+        thread.join()
+
 if __name__ == '__main__':
     # 定義伺服器地址和端口
-    host = 'localhost'
-    port = 5487
+    host = SERVER_HOST
+    port = SERVER_PORT
     url = f"http://{host}:{port}/" # Flask 預設會從根目錄提供 vibe-coding.html
 
-    # 啟動自動保存線程
-    auto_save_thread = threading.Thread(target=auto_save_thread, daemon=True)
-    auto_save_thread.start()
-
     # 定義一個函數來開啟瀏覽器
     def open_browser():
         """稍微延遲後開啟瀏覽器，確保伺服器已啟動"""
@@ -485,11 +4240,14 @@ if __name__ == '__main__':
 
     # 建立一個線程來執行開啟瀏覽器的函數
     # 將 daemon 設為 True，這樣主程序退出時該線程也會退出
-    browser_thread = threading.Thread(target=open_browser, daemon=True)
-    browser_thread.start()
+    # 開發模式的重載器會讓腳本運行兩次，只在重載後的子行程開啟瀏覽器
+    if OPEN_BROWSER and (SERVER_MODE != 'development' or os.environ.get('WERKZEUG_RUN_MAIN')):
+        browser_thread = threading.Thread(target=open_browser, daemon=True)
+        browser_thread.start()
 
     # 啟動Flask伺服器
-    print(f"Vibe Coding Tool 伺服器啟動於 {url}")
-    # 注意：這裡的 use_reloader=True 可能會導致腳本運行兩次
-    # 如果瀏覽器開了兩次，可以考慮在開發完成後將其設為 False 或移除
-    run_simple(host, port, app, use_reloader=True, use_debugger=True)
\ No newline at end of file
+    print(f"Vibe Coding Tool 伺服器啟動於 {url}（{SERVER_MODE} 模式）")
+    if SERVER_MODE == 'development':
+        run_simple(host, port, app, use_reloader=True, use_debugger=True)
+    else:
+        serve_production(host, port)
@@ -9,6 +9,12 @@ let isFileModified = false;
 let originalContent = {};
 let currentModelId = '';
 let isDarkTheme = true; // 預設為深色模式
+let currentQueryController = null; // 進行中的 LLM 串流請求，用於取消
+let isReadOnlyFile = false; // 大型檔案以唯讀分頁模式檢視
+let nextFileLine = null; // 大型檔案下一頁的起始行，null 表示已載入完畢
+let isLoadingFilePage = false;
+let savedContent = null; // 伺服器已確認的內容，差異儲存的基準
+let fileVersion = null; // savedContent 對應的伺服器版本號，null 表示不可儲存 (唯讀)
 
 // DOM 加載完成後執行
 document.addEventListener('DOMContentLoaded', () => {
@@ -23,6 +29,9 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // 獲取可用的 LLM 模型
     fetchAvailableModels();
+    
+    // 若伺服器已設定工作目錄，延遲載入檔案樹
+    loadWorkspaceTree();
 });
 
 // 初始化 ACE 編輯器
@@ -56,6 +65,9 @@ function initEventListeners() {
 
     // 編輯器內容變更事件
     editor.on('change', () => {
+        if (isReadOnlyFile) {
+            return;
+        }
         document.getElementById('saveFileBtn').disabled = false;
         isFileModified = true;
         
@@ -68,6 +80,13 @@ function initEventListeners() {
         }, 5000); // 5秒後自動保存
     });
     
+    // 大型檔案捲動接近底部時載入下一頁
+    editor.session.on('changeScrollTop', () => {
+        if (nextFileLine !== null && editor.renderer.getLastVisibleRow() >= editor.session.getLength() - 50) {
+            loadNextFilePage();
+        }
+    });
+    
     // 切換編輯器/聊天視圖
     document.getElementById('editor-toggle-btn').addEventListener('click', () => {
         document.getElementById('editorPanel').classList.add('active');
@@ -191,93 +210,182 @@ function renderFileTree(files) {
 
 // 渲染檔案樹節點
 function renderFileTreeNode(node, parentElement, path = '') {
-    // 渲染目錄
+    // 渲染目錄（子節點在第一次展開時才建立）
     if (node.dirs) {
         for (const dirName in node.dirs) {
             const dirPath = path ? `${path}/${dirName}` : dirName;
-            const dirElement = document.createElement('div');
-            dirElement.className = 'file-tree-folder';
-            
-            const folderHeader = document.createElement('div');
-            folderHeader.className = 'file-item';
-            folderHeader.innerHTML = `
-                <i class="bi bi-folder-fill folder-icon"></i>
-                <span>${dirName}</span>
-            `;
-            
-            folderHeader.addEventListener('click', () => {
-                // 切換資料夾開關狀態
-                const content = dirElement.querySelector('.file-tree-indent');
-                content.style.display = content.style.display === 'none' ? 'block' : 'none';
-                const icon = folderHeader.querySelector('i');
-                icon.className = icon.className.includes('fill') ?
-                    'bi bi-folder folder-icon' : 'bi bi-folder-fill folder-icon';
+            const dirElement = createFolderElement(dirName, (dirContent) => {
+                renderFileTreeNode(node.dirs[dirName], dirContent, dirPath);
             });
-            
-            dirElement.appendChild(folderHeader);
-            
-            const dirContent = document.createElement('div');
-            dirContent.className = 'file-tree-indent';
-            dirElement.appendChild(dirContent);
-            
             parentElement.appendChild(dirElement);
-            
-            // 遞迴渲染子目錄
-            renderFileTreeNode(node.dirs[dirName], dirContent, dirPath);
         }
     }
     
     // 渲染檔案
     if (node.files) {
         node.files.forEach(file => {
-            const fullPath = file.fullPath;
-            const fileElement = document.createElement('div');
-            fileElement.className = 'file-item';
-            
-            fileElement.innerHTML = `
-                <input type="checkbox" class="file-checkbox" data-path="${fullPath}">
-                <i class="bi bi-file-earmark${file.type === 'code' ? '-code' : ''} file-icon"></i>
-                <span>${file.name}</span>
-            `;
-            
-            // 檔案點擊事件
-            fileElement.addEventListener('click', (e) => {
-                // 如果點擊的是 checkbox，則不做任何處理
-                if (e.target.type === 'checkbox') {
-                    const isChecked = e.target.checked;
-                    if (isChecked) {
-                        selectedFiles.add(fullPath);
-                    } else {
-                        selectedFiles.delete(fullPath);
-                    }
-                    return;
-                }
-                
-                // 打開檔案
-                openFile(fullPath);
-                
-                // 切換到編輯器標籤
-                document.getElementById('editorPanel').classList.add('active');
-                document.querySelector('.chat-container').style.display = 'none';
-            });
-            
-            // 複選框變更事件
-            const checkbox = fileElement.querySelector('input[type="checkbox"]');
-            checkbox.addEventListener('change', (e) => {
-                e.stopPropagation();
-                const isChecked = e.target.checked;
-                if (isChecked) {
-                    selectedFiles.add(fullPath);
-                } else {
-                    selectedFiles.delete(fullPath);
-                }
-            });
-            
-            parentElement.appendChild(fileElement);
+            parentElement.appendChild(createFileElement(file.name, file.fullPath, file.type));
         });
     }
 }
 
+// 建立資料夾節點，onFirstExpand 在第一次展開時用來載入子節點
+function createFolderElement(dirName, onFirstExpand) {
+    const dirElement = document.createElement('div');
+    dirElement.className = 'file-tree-folder';
+    
+    const folderHeader = document.createElement('div');
+    folderHeader.className = 'file-item';
+    folderHeader.innerHTML = `
+        <i class="bi bi-folder folder-icon"></i>
+        <span>${dirName}</span>
+    `;
+    
+    const dirContent = document.createElement('div');
+    dirContent.className = 'file-tree-indent';
+    dirContent.style.display = 'none';
+    
+    let loaded = false;
+    folderHeader.addEventListener('click', () => {
+        if (!loaded) {
+            loaded = true;
+            onFirstExpand(dirContent);
+        }
+        
+        // 切換資料夾開關狀態
+        dirContent.style.display = dirContent.style.display === 'none' ? 'block' : 'none';
+        const icon = folderHeader.querySelector('i');
+        icon.className = dirContent.style.display === 'none' ?
+            'bi bi-folder folder-icon' : 'bi bi-folder-fill folder-icon';
+    });
+    
+    dirElement.appendChild(folderHeader);
+    dirElement.appendChild(dirContent);
+    return dirElement;
+}
+
+// 建立檔案節點
+function createFileElement(fileName, fullPath, fileType) {
+    const fileElement = document.createElement('div');
+    fileElement.className = 'file-item';
+    
+    fileElement.innerHTML = `
+        <input type="checkbox" class="file-checkbox" data-path="${fullPath}" ${selectedFiles.has(fullPath) ? 'checked' : ''}>
+        <i class="bi bi-file-earmark${fileType === 'code' ? '-code' : ''} file-icon"></i>
+        <span>${fileName}</span>
+    `;
+    
+    // 檔案點擊事件
+    fileElement.addEventListener('click', (e) => {
+        // 如果點擊的是 checkbox，則不做任何處理
+        if (e.target.type === 'checkbox') {
+            const isChecked = e.target.checked;
+            if (isChecked) {
+                selectedFiles.add(fullPath);
+            } else {
+                selectedFiles.delete(fullPath);
+            }
+            return;
+        }
+        
+        // 打開檔案
+        openFile(fullPath);
+        
+        // 切換到編輯器標籤
+        document.getElementById('editorPanel').classList.add('active');
+        document.querySelector('.chat-container').style.display = 'none';
+    });
+    
+    // 複選框變更事件
+    const checkbox = fileElement.querySelector('input[type="checkbox"]');
+    checkbox.addEventListener('change', (e) => {
+        e.stopPropagation();
+        const isChecked = e.target.checked;
+        if (isChecked) {
+            selectedFiles.add(fullPath);
+        } else {
+            selectedFiles.delete(fullPath);
+        }
+    });
+    
+    return fileElement;
+}
+
+// 從伺服器載入工作目錄的檔案樹（只載入根目錄，子目錄展開時再載入）
+async function loadWorkspaceTree() {
+    try {
+        const response = await fetch('/api/files/children?dir=');
+        
+        // 伺服器尚未設定工作目錄時保留原本的畫面
+        if (!response.ok) {
+            return;
+        }
+        
+        const data = await response.json();
+        
+        if (data.success) {
+            const fileTreeElement = document.getElementById('fileTree');
+            fileTreeElement.innerHTML = '';
+            renderDirectoryEntries(data, fileTreeElement, '');
+        }
+    } catch (error) {
+        showError('載入檔案樹時發生錯誤', error.message);
+    }
+}
+
+// 分頁載入單一目錄的子項目
+async function loadDirectoryPage(dirPath, container, cursor = null) {
+    let url = `/api/files/children?dir=${encodeURIComponent(dirPath)}`;
+    if (cursor) {
+        url += `&cursor=${encodeURIComponent(cursor)}`;
+    }
+    
+    try {
+        const response = await fetch(url);
+        
+        if (!response.ok) {
+            throw new Error('Failed to fetch directory');
+        }
+        
+        const data = await response.json();
+        
+        if (data.success) {
+            renderDirectoryEntries(data, container, dirPath);
+        } else {
+            showError('載入目錄失敗', data.error);
+        }
+    } catch (error) {
+        showError('載入目錄時發生錯誤', error.message);
+    }
+}
+
+// 渲染一頁目錄項目，若還有下一頁則加上「載入更多」
+function renderDirectoryEntries(data, container, dirPath) {
+    data.entries.forEach(entry => {
+        if (entry.type === 'dir') {
+            container.appendChild(createFolderElement(entry.name, (dirContent) => {
+                loadDirectoryPage(entry.path, dirContent);
+            }));
+        } else {
+            container.appendChild(createFileElement(entry.name, entry.path, getFileType(entry.name)));
+        }
+    });
+    
+    if (data.next_cursor) {
+        const moreElement = document.createElement('div');
+        moreElement.className = 'file-item';
+        moreElement.innerHTML = `
+            <i class="bi bi-three-dots file-icon"></i>
+            <span>載入更多 (共 ${data.total} 項)</span>
+        `;
+        moreElement.addEventListener('click', () => {
+            container.removeChild(moreElement);
+            loadDirectoryPage(dirPath, container, data.next_cursor);
+        });
+        container.appendChild(moreElement);
+    }
+}
+
 // 獲取檔案類型
 function getFileType(filename) {
     const extension = filename.split('.').pop().toLowerCase();
@@ -305,19 +413,39 @@ async function openFile(filePath) {
         
         const data = await response.json();
         
+        if (data.success && data.binary) {
+            showError('無法開啟檔案', `${filePath} 是二進位檔案 (${data.size} bytes)`);
+            return;
+        }
+        
         if (data.success) {
+            // 大型檔案只載入第一頁並設為唯讀，捲動到底部時再載入下一頁
+            isReadOnlyFile = Boolean(data.read_only);
+            nextFileLine = isReadOnlyFile ? data.next_line : null;
+            editor.setReadOnly(isReadOnlyFile);
+            
             // 儲存原始內容，用於後續差異比較
-            originalContent[filePath] = data.content;
+            if (!isReadOnlyFile) {
+                originalContent[filePath] = data.content;
+            }
+            
+            // 版本號以回應標頭為準 (304 時瀏覽器快取的內容中的版本號可能已過期)
+            const versionHeader = response.headers.get('X-File-Version');
+            savedContent = isReadOnlyFile ? null : data.content;
+            fileVersion = isReadOnlyFile || !versionHeader ? null : Number(versionHeader);
             
             // 更新當前開啟的檔案路徑
             currentOpenFilePath = filePath;
             
             // 更新顯示檔案名稱
-            document.getElementById('currentEditingFile').textContent = filePath;
+            document.getElementById('currentEditingFile').textContent = isReadOnlyFile
+                ? `${filePath} (唯讀，共 ${data.total_lines} 行)`
+                : filePath;
             
             // 設定編輯器內容
-            editor.setValue(data.content);
+            editor.setValue(withTruncationMark(data));
             editor.clearSelection();
+            editor.gotoLine(1);
             
             // 根據檔案類型設定編輯器模式
             setEditorMode(filePath);
@@ -333,6 +461,43 @@ async function openFile(filePath) {
     }
 }
 
+// 單一行過長時伺服器只回傳該行開頭，在行末標示省略的位元組數
+function withTruncationMark(data) {
+    if (!data.truncated) {
+        return data.content;
+    }
+    const { line, omitted_bytes: omitted, next_offset: offset } = data.truncated;
+    return `${data.content} … [第 ${line} 行過長，已省略 ${omitted} 位元組 (自位元組 ${offset} 起)]\n`;
+}
+
+// 載入大型檔案的下一頁並附加到編輯器末端
+async function loadNextFilePage() {
+    if (!isReadOnlyFile || nextFileLine === null || isLoadingFilePage) {
+        return;
+    }
+    
+    isLoadingFilePage = true;
+    const filePath = currentOpenFilePath;
+    try {
+        const response = await fetch(`/api/file?path=${encodeURIComponent(filePath)}&start_line=${nextFileLine}`);
+        const data = await response.json();
+        
+        // 載入期間已切換到其他檔案時丟棄結果
+        if (!data.success || filePath !== currentOpenFilePath) {
+            return;
+        }
+        
+        const session = editor.session;
+        const lastRow = session.getLength() - 1;
+        session.insert({ row: lastRow, column: session.getLine(lastRow).length }, withTruncationMark(data));
+        nextFileLine = data.next_line;
+    } catch (error) {
+        showError('載入檔案時發生錯誤', error.message);
+    } finally {
+        isLoadingFilePage = false;
+    }
+}
+
 // 設定編輯器模式
 function setEditorMode(filePath) {
     const extension = filePath.split('.').pop().toLowerCase();
@@ -394,23 +559,30 @@ function setEditorMode(filePath) {
 
 // 儲存檔案變更
 async function saveFileChanges(silent = false) {
-    if (!currentOpenFilePath || !isFileModified) {
+    if (!currentOpenFilePath || !isFileModified || fileVersion === null) {
         return;
     }
     
     try {
-        const content = editor.getValue();
+        const filePath = currentOpenFilePath;
+        let content = editor.getValue();
         
-        const response = await fetch('/api/file', {
-            method: 'PUT',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                path: currentOpenFilePath,
-                content: content
-            })
-        });
+        // 只傳送相對於伺服器版本變更的行
+        let response = await putFileEdits(filePath, fileVersion, savedContent, content);
+        
+        // 版本衝突：重新載入伺服器上的最新版本，合併兩邊的修改或由使用者決定，不直接覆寫
+        if (response.status === 409) {
+            const resolved = await resolveSaveConflict(filePath, content);
+            if (resolved === null) {
+                return;
+            }
+            content = resolved.content;
+            response = await putFileEdits(filePath, resolved.version, resolved.base, content);
+            if (response.status === 409) {
+                showError('儲存檔案失敗', '檔案在合併期間再次被修改，將於下次儲存時重試');
+                return;
+            }
+        }
         
         if (!response.ok) {
             throw new Error('Failed to save file');
@@ -420,6 +592,10 @@ async function saveFileChanges(silent = false) {
         
         if (data.success) {
             // 更新狀態
+            if (filePath === currentOpenFilePath) {
+                savedContent = content;
+                fileVersion = data.version;
+            }
             isFileModified = false;
             document.getElementById('saveFileBtn').disabled = true;
             
@@ -451,6 +627,119 @@ async function saveFileChanges(silent = false) {
     }
 }
 
+// 送出檔案更新
+function putFileContent(body) {
+    return fetch('/api/file', {
+        method: 'PUT',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(body)
+    });
+}
+
+// 以相對於 base 的行編輯送出更新，伺服器版本不是 version 時回傳 409
+function putFileEdits(filePath, version, base, content) {
+    return putFileContent({
+        path: filePath,
+        base_version: version,
+        edits: [computeLineEdit(base, content)]
+    });
+}
+
+// 處理儲存時的版本衝突，回傳 {base, version, content} 作為重新送出的依據，放棄儲存時回傳 null
+async function resolveSaveConflict(filePath, mine) {
+    const response = await fetch(`/api/file?path=${encodeURIComponent(filePath)}`, { cache: 'no-store' });
+    if (!response.ok) {
+        throw new Error('Failed to reload file');
+    }
+    const data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error);
+    }
+    
+    // 等待期間已切換檔案或繼續編輯時先不處理，下次儲存會重新比對
+    if (filePath !== currentOpenFilePath || editor.getValue() !== mine) {
+        return null;
+    }
+    
+    const theirs = data.content;
+    const version = Number(response.headers.get('X-File-Version'));
+    
+    // 兩邊修改的行不重疊時自動合併
+    const merged = mergeLineEdits(savedContent, mine, theirs);
+    if (merged !== null) {
+        if (merged !== mine) {
+            replaceEditorContent(merged);
+        }
+        return { base: theirs, version: version, content: merged };
+    }
+    
+    if (confirm(`${filePath} 已在其他地方被修改，且與你的修改衝突。\n按「確定」以你的版本覆寫，按「取消」載入最新版本並捨棄你的修改。`)) {
+        return { base: theirs, version: version, content: mine };
+    }
+    
+    savedContent = theirs;
+    fileVersion = version;
+    replaceEditorContent(theirs);
+    isFileModified = false;
+    clearTimeout(autoSaveTimer);
+    document.getElementById('saveFileBtn').disabled = true;
+    return null;
+}
+
+// 替換編輯器內容並盡量保留游標位置
+function replaceEditorContent(content) {
+    const cursor = editor.getCursorPosition();
+    editor.setValue(content, -1);
+    editor.moveCursorToPosition(cursor);
+}
+
+// 三方合併：base 到 mine 與 base 到 theirs 的修改範圍不重疊 (中間至少隔一行未變更) 時回傳合併結果，否則回傳 null
+function mergeLineEdits(base, mine, theirs) {
+    const ours = computeLineEdit(base, mine);
+    const other = computeLineEdit(base, theirs);
+    if (other.delete === 0 && other.lines.length === 0) {
+        return mine;
+    }
+    if (ours.delete === 0 && ours.lines.length === 0) {
+        return theirs;
+    }
+    if (!(ours.start + ours.delete < other.start || other.start + other.delete < ours.start)) {
+        return null;
+    }
+    
+    // 先套用位置較後的修改，前面的行號才不會改變
+    const lines = base.split('\n');
+    for (const edit of [ours, other].sort((a, b) => b.start - a.start)) {
+        lines.splice(edit.start, edit.delete, ...edit.lines);
+    }
+    return lines.join('\n');
+}
+
+// 計算兩份內容之間的行編輯：去除相同的開頭與結尾行，只保留中間變更的部分
+function computeLineEdit(oldContent, newContent) {
+    const oldLines = oldContent.split('\n');
+    const newLines = newContent.split('\n');
+    
+    let prefix = 0;
+    while (prefix < oldLines.length && prefix < newLines.length && oldLines[prefix] === newLines[prefix]) {
+        prefix++;
+    }
+    
+    let suffix = 0;
+    while (suffix < oldLines.length - prefix && suffix < newLines.length - prefix &&
+           oldLines[oldLines.length - 1 - suffix] === newLines[newLines.length - 1 - suffix]) {
+        suffix++;
+    }
+    
+    return {
+        start: prefix,
+        delete: oldLines.length - prefix - suffix,
+        lines: newLines.slice(prefix, newLines.length - suffix)
+    };
+}
+
 // 獲取可用的 LLM 模型
 async function fetchAvailableModels() {
     try {
@@ -518,82 +807,153 @@ async function handlePromptSubmit() {
         return;
     }
     
-    // 檢查是否選擇了檔案
-    if (selectedFiles.size === 0) {
-        showError('錯誤', '請至少選擇一個檔案');
-        return;
-    }
+    // 沒有選擇檔案時，由伺服器依 prompt 自動找出相關的檔案
+    const autoContext = selectedFiles.size === 0;
     
     // 顯示載入中
     const loadingIndicator = document.getElementById('loadingIndicator');
     loadingIndicator.classList.remove('d-none');
     
-    // 創建檔案內容陣列
-    const filesContent = [];
+    let responseCard = null;
     
     try {
-        // 讀取所有選擇的檔案內容
-        for (const filePath of selectedFiles) {
-            const response = await fetch(`/api/file?path=${encodeURIComponent(filePath)}`);
-            
-            if (!response.ok) {
-                throw new Error(`Failed to fetch content for ${filePath}`);
-            }
-            
-            const data = await response.json();
+        // 只發送選擇的檔案路徑，由伺服器端讀取內容，以串流方式逐段顯示回應
+        responseCard = createStreamingResponseCard();
+        const data = await streamLLMQuery({
+            prompt: promptText,
+            files: Array.from(selectedFiles),
+            model: currentModelId,
+            auto_context: autoContext
+        }, (text) => {
+            // 收到第一段文字時即隱藏載入中
+            loadingIndicator.classList.add('d-none');
+            updateStreamingResponseCard(responseCard, text);
+        });
+        
+        if (data.success) {
+            // 顯示完整回應（轉換 Markdown 並加上操作按鈕）
+            displayLLMResponse(data.response, data.changes, responseCard);
             
-            if (data.success) {
-                filesContent.push({
-                    path: filePath,
-                    content: data.content
-                });
-            } else {
-                throw new Error(`Error reading ${filePath}: ${data.error}`);
-            }
+            // 清空輸入框
+            promptInput.value = '';
+        } else {
+            responseCard.remove();
+            showError('LLM 查詢失敗', data.error);
+        }
+    } catch (error) {
+        if (responseCard) {
+            responseCard.remove();
         }
         
-        // 發送 prompt 和檔案內容給 LLM API
+        // 被新的查詢取消時不顯示錯誤
+        if (error.name !== 'AbortError') {
+            showError('發送 prompt 時發生錯誤', error.message);
+        }
+    } finally {
+        // 隱藏載入中
+        loadingIndicator.classList.add('d-none');
+    }
+}
+
+// 以 Server-Sent Events 發送 LLM 查詢，每收到一段文字呼叫 onToken，結束時回傳完整結果
+async function streamLLMQuery(body, onToken) {
+    // 取消尚未完成的上一個查詢，伺服器會隨之中斷上游請求
+    if (currentQueryController) {
+        currentQueryController.abort();
+    }
+    const controller = new AbortController();
+    currentQueryController = controller;
+    
+    try {
         const response = await fetch('/api/llm/query', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
             },
-            body: JSON.stringify({
-                prompt: promptText,
-                files: filesContent,
-                model: currentModelId
-            })
+            body: JSON.stringify({ ...body, stream: true }),
+            signal: controller.signal
         });
         
         if (!response.ok) {
-            throw new Error('Failed to get response from LLM');
+            const data = await response.json().catch(() => null);
+            return data || { success: false, error: 'Failed to get response from LLM' };
         }
         
-        const data = await response.json();
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let fullText = '';
         
-        if (data.success) {
-            // 顯示回應
-            displayLLMResponse(data.response, data.changes);
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
             
-            // 清空輸入框
-            promptInput.value = '';
-        } else {
-            showError('LLM 查詢失敗', data.error);
+            buffer += decoder.decode(value, { stream: true });
+            
+            // 事件之間以空行分隔
+            let separator;
+            while ((separator = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separator);
+                buffer = buffer.slice(separator + 2);
+                
+                let eventName = 'message';
+                let eventData = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        eventData += line.slice(5).trim();
+                    }
+                });
+                
+                const payload = eventData ? JSON.parse(eventData) : {};
+                if (eventName === 'token') {
+                    fullText += payload.text;
+                    onToken(fullText);
+                } else if (eventName === 'done') {
+                    return { success: true, response: payload.response, changes: payload.changes };
+                } else if (eventName === 'error') {
+                    return { success: false, error: payload.error };
+                }
+            }
         }
-    } catch (error) {
-        showError('發送 prompt 時發生錯誤', error.message);
+        
+        return { success: false, error: '串流意外結束' };
     } finally {
-        // 隱藏載入中
-        loadingIndicator.classList.add('d-none');
+        if (currentQueryController === controller) {
+            currentQueryController = null;
+        }
+    }
+}
+
+// 建立串流中的回應卡片
+function createStreamingResponseCard() {
+    const responseDisplay = document.getElementById('responseDisplay');
+    const responseCard = document.createElement('div');
+    responseCard.className = 'response-card fade-in';
+    responseCard.innerHTML = '<div class="markdown-body"><pre class="streaming-text"></pre></div>';
+    responseDisplay.appendChild(responseCard);
+    return responseCard;
+}
+
+// 更新串流中的回應卡片（串流期間只顯示純文字，完成後才轉換 Markdown）
+function updateStreamingResponseCard(responseCard, text) {
+    const textElement = responseCard.querySelector('.streaming-text');
+    if (textElement) {
+        textElement.textContent = text;
     }
+    
+    const responseDisplay = document.getElementById('responseDisplay');
+    responseDisplay.scrollTop = responseDisplay.scrollHeight;
 }
 
-// 顯示 LLM 回應
-function displayLLMResponse(response, changes) {
+// 顯示 LLM 回應，若提供 responseCard 則沿用串流時建立的卡片
+function displayLLMResponse(response, changes, existingCard = null) {
     const responseDisplay = document.getElementById('responseDisplay');
     
     // 創建新的回應卡片
-    const responseCard = document.createElement('div');
+    const responseCard = existingCard || document.createElement('div');
     responseCard.className = 'response-card fade-in';
     
     // 轉換 Markdown 為 HTML
@@ -638,7 +998,9 @@ function displayLLMResponse(response, changes) {
     }
     
     // 添加到顯示區域
-    responseDisplay.appendChild(responseCard);
+    if (!existingCard) {
+        responseDisplay.appendChild(responseCard);
+    }
     
     // 滾動到底部
     responseDisplay.scrollTop = responseDisplay.scrollHeight;
@@ -663,12 +1025,13 @@ async function applyLLMChanges(changes) {
             })
         });
         
-        if (!response.ok) {
+        // 套用失敗時伺服器仍會回傳各檔案的結果與錯誤訊息
+        const data = await response.json().catch(() => null);
+        
+        if (!data) {
             throw new Error('Failed to apply changes');
         }
         
-        const data = await response.json();
-        
         if (data.success) {
             // 顯示成功消息
             const successMessage = document.createElement('div');
@@ -694,6 +1057,10 @@ async function applyLLMChanges(changes) {
                 openFile(currentOpenFilePath);
             }
         } else {
+            // 部分變更可能已套用，同樣需要重新載入
+            if (data.affected_files && data.affected_files.includes(currentOpenFilePath)) {
+                openFile(currentOpenFilePath);
+            }
             showError('應用變更失敗', data.error);
         }
     } catch (error) {
@@ -0,0 +1,43 @@
+"""UI/backend.py 與 vibe-coding-tool/vibe-coding-backend.py 共用的斷路器"""
+import time
+import threading
+
+class CircuitOpenError(Exception):
+    """上游主機的斷路器開啟中，暫時不發送請求"""
+
+class CircuitBreaker:
+    """單一上游主機的斷路器（closed -> open -> half_open -> closed）"""
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+    
+    def allow(self):
+        """是否允許發送請求；冷卻時間過後只放行一個試探請求"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+    
+    def snapshot(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
@@ -0,0 +1,239 @@
+"""UI/backend.py 與 vibe-coding-tool/vibe-coding-backend.py 共用的工作目錄掃描與檔案索引
+
+兩個應用都不是套件，以檔案路徑載入本模組（見各自的 load_shared_module）。
+"""
+import os
+import fnmatch
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 掃描時直接略過的目錄（不會進入其中）
+IGNORED_DIRS = frozenset({'.git', '.hg', '.svn', 'node_modules', '__pycache__',
+                          '.venv', 'venv', '.tox', '.mypy_cache', '.pytest_cache', '.idea'})
+
+# 檔案索引檢查目錄變更的最短間隔（秒）
+INDEX_REFRESH_INTERVAL = 2
+
+def join_path(relative_dir, name):
+    return f"{relative_dir}/{name}" if relative_dir else name
+
+def load_gitignore_patterns(directory):
+    """讀取工作目錄根部的 .gitignore（簡化版，不支援 ! 否定規則），回傳 (樣式, 只比對目錄, 相對根目錄比對)
+    
+    與 git 相同：開頭或中間含有 / 的樣式只相對於根目錄比對（/build 只略過根目錄的 build），
+    其餘樣式比對任何層級的名稱。
+    """
+    patterns = []
+    gitignore_path = os.path.join(directory, '.gitignore')
+    
+    try:
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or line.startswith('!'):
+                    continue
+                dir_only = line.endswith('/')
+                line = line.rstrip('/')
+                anchored = '/' in line
+                line = line.lstrip('/')
+                if line:
+                    patterns.append((line, dir_only, anchored))
+    except OSError:
+        pass
+    
+    return patterns
+
+def is_ignored(name, relative_path, is_dir, ignore_patterns, ignored_dirs=IGNORED_DIRS):
+    """判斷檔案或目錄是否應被略過"""
+    if is_dir and name in ignored_dirs:
+        return True
+    
+    for pattern, dir_only, anchored in ignore_patterns:
+        if dir_only and not is_dir:
+            continue
+        target = relative_path if anchored else name
+        if fnmatch.fnmatch(target, pattern):
+            return True
+    
+    return False
+
+def scan_directory(directory, relative_dir, file_filter=None, ignore_patterns=(), ignored_dirs=IGNORED_DIRS):
+    """掃描單一目錄，回傳 (mtime, 符合條件的檔名集合, 子目錄名稱集合)；file_filter 為 None 時接受所有檔案"""
+    full_dir = os.path.join(directory, relative_dir) if relative_dir else directory
+    files = set()
+    dirs = set()
+    
+    with os.scandir(full_dir) as entries:
+        mtime = os.stat(full_dir).st_mtime_ns
+        for entry in entries:
+            relative_path = join_path(relative_dir, entry.name)
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            
+            if is_ignored(entry.name, relative_path, is_dir, ignore_patterns, ignored_dirs):
+                continue
+            
+            if is_dir:
+                dirs.add(entry.name)
+            elif file_filter is None or file_filter(entry.name):
+                files.add(entry.name)
+    
+    return mtime, files, dirs
+
+class WorkspaceIndex:
+    """工作目錄的檔案索引：首次完整掃描，之後只重新掃描 mtime 有變化的目錄"""
+    
+    def __init__(self, directory, file_filter=None, refresh_interval=INDEX_REFRESH_INTERVAL,
+                 ignored_dirs=IGNORED_DIRS):
+        self.directory = os.path.abspath(directory)
+        self.file_filter = file_filter
+        self.ignored_dirs = ignored_dirs
+        self.ignore_patterns = load_gitignore_patterns(self.directory)
+        self.refresh_interval = refresh_interval
+        # 相對目錄路徑 ('' 為根目錄) -> {'mtime', 'files', 'dirs'}
+        self._dirs = {}
+        self._file_list = None
+        self._file_counts = {}
+        self._children = {}
+        self._last_refresh = 0
+        self._lock = threading.RLock()
+        
+        started = time.time()
+        self._scan_tree('')
+        self._last_refresh = time.time()
+        logger.info(f"建立檔案索引: {self.directory}，共 {len(self._dirs)} 個目錄，"
+                    f"耗時 {time.time() - started:.2f} 秒")
+    
+    def _scan(self, relative_dir):
+        return scan_directory(self.directory, relative_dir, self.file_filter,
+                              self.ignore_patterns, self.ignored_dirs)
+    
+    def _scan_tree(self, relative_dir):
+        """從指定目錄開始遞迴掃描並加入索引"""
+        pending = [relative_dir]
+        while pending:
+            current = pending.pop()
+            try:
+                mtime, files, dirs = self._scan(current)
+            except OSError:
+                continue
+            
+            self._dirs[current] = {'mtime': mtime, 'files': files, 'dirs': dirs}
+            pending.extend(join_path(current, name) for name in dirs)
+    
+    def _drop_tree(self, relative_dir):
+        """從索引中移除目錄及其所有子目錄"""
+        node = self._dirs.pop(relative_dir, None)
+        if node is None:
+            return
+        for name in node['dirs']:
+            self._drop_tree(join_path(relative_dir, name))
+    
+    def _refresh_dir(self, relative_dir):
+        """目錄 mtime 變化時重新掃描該目錄，並處理新增或刪除的子目錄"""
+        old_node = self._dirs.get(relative_dir)
+        try:
+            mtime, files, dirs = self._scan(relative_dir)
+        except OSError:
+            self._drop_tree(relative_dir)
+            return
+        
+        self._dirs[relative_dir] = {'mtime': mtime, 'files': files, 'dirs': dirs}
+        old_dirs = old_node['dirs'] if old_node else set()
+        
+        for name in old_dirs - dirs:
+            self._drop_tree(join_path(relative_dir, name))
+        for name in dirs - old_dirs:
+            self._scan_tree(join_path(relative_dir, name))
+    
+    def refresh(self, force=False):
+        """檢查各目錄的 mtime，只重新掃描有變化的目錄"""
+        with self._lock:
+            if not force and time.time() - self._last_refresh < self.refresh_interval:
+                return False
+            
+            changed = False
+            for relative_dir in list(self._dirs):
+                node = self._dirs.get(relative_dir)
+                if node is None:
+                    continue  # 已在本輪中隨父目錄移除
+                full_dir = os.path.join(self.directory, relative_dir) if relative_dir else self.directory
+                try:
+                    mtime = os.stat(full_dir).st_mtime_ns
+                except OSError:
+                    self._drop_tree(relative_dir)
+                    changed = True
+                    continue
+                
+                if mtime != node['mtime']:
+                    self._refresh_dir(relative_dir)
+                    changed = True
+            
+            if changed:
+                self._file_list = None
+            self._last_refresh = time.time()
+            return changed
+    
+    def _rebuild(self):
+        """重建檔案清單與各目錄（含子目錄）的檔案數量"""
+        file_list = []
+        file_counts = {}
+        
+        # 由深到淺累加，讓父目錄取得所有子目錄的檔案數量
+        for relative_dir in sorted(self._dirs, key=lambda d: d.count('/') if d else -1, reverse=True):
+            node = self._dirs[relative_dir]
+            count = len(node['files'])
+            for name in node['dirs']:
+                count += file_counts.get(join_path(relative_dir, name), 0)
+            file_counts[relative_dir] = count
+            for name in node['files']:
+                file_list.append(join_path(relative_dir, name))
+        
+        file_list.sort()
+        self._file_list = file_list
+        self._file_counts = file_counts
+        self._children = {}
+    
+    def files(self):
+        """取得索引中的所有檔案（相對路徑，依名稱排序）"""
+        with self._lock:
+            self.refresh()
+            if self._file_list is None:
+                self._rebuild()
+            return self._file_list
+    
+    def children(self, relative_dir):
+        """取得單一目錄下的子項目（目錄在前、檔案在後，皆依名稱排序），目錄不存在時回傳 None"""
+        with self._lock:
+            self.refresh()
+            if self._file_list is None:
+                self._rebuild()
+            if relative_dir not in self._dirs:
+                return None
+            
+            entries = self._children.get(relative_dir)
+            if entries is None:
+                node = self._dirs[relative_dir]
+                entries = []
+                for name in sorted(node['dirs']):
+                    path = join_path(relative_dir, name)
+                    # 不含任何支援檔案的目錄不顯示，與完整清單的行為一致
+                    if not self._file_counts.get(path):
+                        continue
+                    child = self._dirs[path]
+                    child_count = len(child['files']) + sum(
+                        1 for d in child['dirs']
+                        if self._file_counts.get(f"{path}/{d}"))
+                    entries.append({'key': f"d:{name}", 'name': name, 'path': path, 'type': 'dir',
+                                    'child_count': child_count,
+                                    'file_count': self._file_counts[path]})
+                for name in sorted(node['files']):
+                    path = join_path(relative_dir, name)
+                    entries.append({'key': f"f:{name}", 'name': name, 'path': path, 'type': 'file'})
+                self._children[relative_dir] = entries
+            return entries
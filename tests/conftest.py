@@ -0,0 +1,101 @@
+import os
+import sys
+import threading
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# backend.py 不是套件，直接把 UI 目錄加入匯入路徑
+sys.path.insert(0, os.path.join(ROOT_DIR, 'UI'))
+
+
+@pytest.fixture(scope='session')
+def vibe_backend():
+    """vibe-coding-backend.py 的檔名含連字號，與 vibe-coding-deployment.py 相同以檔案路徑載入"""
+    spec = importlib.util.spec_from_file_location(
+        'vibe_coding_backend_under_test', os.path.join(ROOT_DIR, 'vibe-coding-tool', 'vibe-coding-backend.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StubServer:
+    """本機的上游替身：routes 以 (方法, 路徑) 對應到處理函式，requests 記錄收到的請求"""
+    
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.body = self.rfile.read(length) if length else b''
+                with stub._lock:
+                    stub.requests.append((self.command, self.path))
+                route = stub.routes.get((self.command, self.path.split('?')[0]))
+                if route is None:
+                    self.respond(404)
+                else:
+                    route(self)
+            
+            do_GET = do_POST = handle_request
+            
+            def respond(self, status, body=b'', headers=None):
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def abort(self):
+                """讀取請求後不回應就關閉連線（客戶端看到 Connection aborted）"""
+                self.close_connection = True
+                self.connection.close()
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+    
+    def count(self, method, path):
+        with self._lock:
+            return sum(1 for request in self.requests if request[0] == method and request[1].split('?')[0] == path)
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def stub_servers():
+    """建立多個 StubServer，例如模擬端點池中的多個端點"""
+    servers = []
+    
+    def create():
+        servers.append(StubServer())
+        return servers[-1]
+    
+    yield create
+    for server in servers:
+        server.close()
@@ -0,0 +1,46 @@
+import os
+import stat
+
+import pytest
+
+import backend
+
+
+@pytest.fixture
+def umask():
+    previous = os.umask(0o027)
+    yield 0o027
+    os.umask(previous)
+
+
+def test_new_file_follows_umask(tmp_path, monkeypatch, umask):
+    monkeypatch.setattr(backend, 'NEW_FILE_MODE', 0o666 & ~umask)
+    path = tmp_path / 'new.txt'
+    backend.atomic_write(str(path), 'hello\n')
+    assert path.read_text(encoding='utf-8') == 'hello\n'
+    assert stat.S_IMODE(path.stat().st_mode) == 0o640
+    assert os.listdir(tmp_path) == ['new.txt']
+
+
+def test_existing_file_keeps_its_mode(tmp_path):
+    path = tmp_path / 'run.sh'
+    path.write_text('echo old\n', encoding='utf-8')
+    path.chmod(0o755)
+    backend.atomic_write(str(path), 'echo new\n')
+    assert path.read_text(encoding='utf-8') == 'echo new\n'
+    assert stat.S_IMODE(path.stat().st_mode) == 0o755
+
+
+def test_symlink_is_kept_and_target_updated(tmp_path):
+    (tmp_path / 'real').mkdir()
+    target = tmp_path / 'real' / 'config.py'
+    target.write_text('old = True\n', encoding='utf-8')
+    link = tmp_path / 'config.py'
+    link.symlink_to(os.path.join('real', 'config.py'))
+    
+    backend.atomic_write(str(link), 'new = True\n')
+    assert link.is_symlink()
+    assert os.readlink(link) == os.path.join('real', 'config.py')
+    assert target.read_text(encoding='utf-8') == 'new = True\n'
+    # 臨時檔建立在目標所在的目錄，改名才是原子操作
+    assert sorted(os.listdir(tmp_path / 'real')) == ['config.py']
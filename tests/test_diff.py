@@ -0,0 +1,106 @@
+import random
+
+import pytest
+
+import backend
+
+
+def apply_opcodes(a_lines, b_lines, opcodes):
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        result.extend(a_lines[i1:i2] if tag == 'equal' else b_lines[j1:j2])
+    return result
+
+
+def random_edit(lines, rng):
+    lines = list(lines)
+    for _ in range(rng.randint(0, 6)):
+        position = rng.randint(0, len(lines))
+        operation = rng.random()
+        if operation < 0.4:
+            lines.insert(position, f'new line {rng.randint(0, 5)}')
+        elif lines and operation < 0.7:
+            del lines[min(position, len(lines) - 1)]
+        elif lines:
+            lines[min(position, len(lines) - 1)] = f'changed {rng.randint(0, 5)}'
+    return lines
+
+
+def move_and_duplicate(lines, rng):
+    """搬移一段區塊並複製另一段，讓唯一行錨點與重複行都出現在比較中"""
+    lines = list(lines)
+    start = rng.randrange(len(lines) - 10)
+    block = lines[start:start + rng.randint(3, 10)]
+    del lines[start:start + len(block)]
+    lines[rng.randint(0, len(lines)):0] = block
+    duplicate_start = rng.randrange(len(lines) - 5)
+    lines[rng.randint(0, len(lines)):0] = lines[duplicate_start:duplicate_start + 5]
+    return random_edit(lines, rng)
+
+
+def small_cases():
+    rng = random.Random(7)
+    for _ in range(200):
+        a_lines = [f'line {rng.randint(0, 8)}' for _ in range(rng.randint(0, 30))]
+        yield a_lines, random_edit(a_lines, rng)
+
+
+def large_cases():
+    rng = random.Random(11)
+    for _ in range(60):
+        # 大部分是唯一的行，夾雜重複的空行與右括號，長度超過 DIFF_ANCHOR_THRESHOLD
+        a_lines = [rng.choice([f'statement_{i}()', '', '}']) for i in range(rng.randint(70, 400))]
+        yield a_lines, move_and_duplicate(a_lines, rng)
+
+
+def assert_valid_blocks(a_lines, b_lines, blocks):
+    last_i = last_j = 0
+    for i, j, size in blocks:
+        assert i >= last_i and j >= last_j
+        assert a_lines[i:i + size] == b_lines[j:j + size]
+        last_i, last_j = i + size, j + size
+    assert blocks[-1] == (len(a_lines), len(b_lines), 0)
+
+
+@pytest.mark.parametrize('engine', sorted(backend.DIFF_ENGINES))
+@pytest.mark.parametrize('cases', [small_cases, large_cases])
+def test_opcodes_reconstruct_target(engine, cases):
+    for a_lines, b_lines in cases():
+        opcodes, exact = backend.compute_opcodes(a_lines, b_lines, engine=engine)
+        assert exact
+        assert apply_opcodes(a_lines, b_lines, opcodes) == b_lines
+
+
+def test_large_inputs_use_unique_line_anchors(monkeypatch):
+    calls = []
+    original = backend._unique_anchors
+    
+    def spy(*args):
+        result = original(*args)
+        calls.append(result)
+        return result
+    
+    monkeypatch.setattr(backend, '_unique_anchors', spy)
+    for a_lines, b_lines in large_cases():
+        blocks, exact = backend.myers_matching_blocks(a_lines, b_lines)
+        assert exact
+        assert_valid_blocks(a_lines, b_lines, blocks)
+    assert any(calls)
+
+
+def test_unique_anchors_form_increasing_sequence():
+    a = [1, 2, 3, 4, 5, 6]
+    b = [4, 5, 6, 1, 2, 3]
+    anchors = backend._unique_anchors(a, 0, len(a), b, 0, len(b))
+    assert anchors in ([(0, 3), (1, 4), (2, 5)], [(3, 0), (4, 1), (5, 2)])
+    assert backend._unique_anchors([1, 2], 0, 2, [3, 4], 0, 2) is None
+    # 共同的行都重複出現時沒有錨點，交由 Myers 處理
+    assert backend._unique_anchors([1, 1], 0, 2, [1, 1, 1], 0, 3) == []
+
+
+def test_no_common_lines_is_a_single_replace():
+    a_lines = [f'old {i}' for i in range(100)]
+    b_lines = [f'new {i}' for i in range(100)]
+    opcodes, exact = backend.compute_opcodes(a_lines, b_lines)
+    assert exact
+    assert opcodes == [('replace', 0, 100, 0, 100)]
@@ -0,0 +1,84 @@
+import pytest
+
+import backend
+
+
+@pytest.mark.parametrize('base, edits, expected', [
+    ('a\nb\nc', [{'start': 1, 'delete': 1, 'lines': ['B']}], 'a\nB\nc'),
+    ('a\nb\nc', [{'start': 3, 'delete': 0, 'lines': ['d']}], 'a\nb\nc\nd'),
+    ('a\nb\nc', [{'start': 0, 'delete': 2, 'lines': []}], 'c'),
+    ('a\nb\n', [{'start': 0, 'delete': 0, 'lines': ['x']}, {'start': 2, 'delete': 1, 'lines': []}], 'x\na\n'),
+    ('', [{'start': 0, 'delete': 1, 'lines': ['new', '']}], 'new\n'),
+])
+def test_apply_line_edits(base, edits, expected):
+    assert backend.apply_line_edits(base, edits) == expected
+
+
+@pytest.mark.parametrize('edits', [
+    [{'start': 4, 'delete': 0, 'lines': []}],
+    [{'start': 0, 'delete': 5, 'lines': []}],
+    [{'start': -1, 'delete': 0, 'lines': []}],
+    [{'start': 0, 'delete': 0, 'lines': 'not a list'}],
+    ['not an edit'],
+])
+def test_apply_line_edits_rejects_invalid_edits(edits):
+    with pytest.raises(ValueError):
+        backend.apply_line_edits('a\nb\nc', edits)
+
+
+@pytest.fixture
+def store_file(tmp_path):
+    path = tmp_path / 'edit.py'
+    path.write_text('one\ntwo\nthree\n', encoding='utf-8')
+    return str(path)
+
+
+def load_from(path):
+    return lambda: open(path, encoding='utf-8').read()
+
+
+def test_edits_apply_on_current_version(store_file):
+    store = backend.BufferStore()
+    version = store.apply_edits(store_file, 0, [{'start': 1, 'delete': 1, 'lines': ['TWO']}], load_from(store_file))
+    assert version == 1
+    version = store.apply_edits(store_file, 1, [{'start': 0, 'delete': 1, 'lines': ['ONE']}], load_from(store_file))
+    assert store.get(store_file) == ('ONE\nTWO\nthree\n', 2)
+    
+    assert store.save(store_file)
+    assert open(store_file, encoding='utf-8').read() == 'ONE\nTWO\nthree\n'
+    # 寫回後緩衝區已移除，之後的編輯以磁碟內容為基準
+    store.apply_edits(store_file, 2, [{'start': 3, 'delete': 0, 'lines': ['four']}], load_from(store_file))
+    assert store.get(store_file) == ('ONE\nTWO\nthree\nfour\n', 3)
+
+
+def test_stale_base_version_conflicts_without_changes(store_file):
+    store = backend.BufferStore()
+    store.update(store_file, 'changed elsewhere\n')
+    
+    with pytest.raises(backend.VersionConflictError) as conflict:
+        store.apply_edits(store_file, 0, [{'start': 0, 'delete': 1, 'lines': ['x']}], load_from(store_file))
+    assert conflict.value.version == 1
+    with pytest.raises(backend.VersionConflictError):
+        store.update(store_file, 'overwrite\n', base_version=0)
+    
+    assert store.get(store_file) == ('changed elsewhere\n', 1)
+    assert store.stats()['conflicts'] == 2
+
+
+def test_discard_and_touch_invalidate_base_version(store_file):
+    store = backend.BufferStore()
+    store.update(store_file, 'unsaved\n')
+    store.discard(store_file)
+    assert store.version(store_file) == 2
+    with pytest.raises(backend.VersionConflictError):
+        store.apply_edits(store_file, 1, [], load_from(store_file))
+    
+    store.touch(store_file)
+    assert store.version(store_file) == 3
+
+
+def test_read_returns_content_matching_version(store_file):
+    store = backend.BufferStore()
+    assert store.read(store_file, load_from(store_file)) == ('one\ntwo\nthree\n', 0, False)
+    store.update(store_file, 'buffered\n')
+    assert store.read(store_file, load_from(store_file)) == ('buffered\n', 1, True)
@@ -0,0 +1,84 @@
+import pytest
+
+import backend
+
+
+@pytest.mark.parametrize('content', [
+    b'',
+    b'single line without newline',
+    b'one\ntwo\nthree\n',
+    b'\n\n\n',
+    b''.join(b'line %d \xe4\xb8\xad\n' % i for i in range(500)) + b'no trailing newline',
+])
+def test_line_index_pages_match_splitlines(tmp_path, content):
+    path = tmp_path / 'file.txt'
+    path.write_bytes(content)
+    expected = content.split(b'\n')
+    if content.endswith(b'\n') or not content:
+        expected.pop()
+    
+    index = backend.LineIndex(str(path), stride=7)
+    assert index.total_lines == len(expected)
+    for start, count in [(0, 1), (0, 10), (5, 13), (6, 64), (len(expected) - 1, 5), (len(expected), 3)]:
+        data, read, truncated = index.read_lines(start, count)
+        assert truncated is None
+        lines = expected[start:start + count]
+        assert read == len(lines)
+        assert data.split(b'\n')[:read] == lines
+
+
+def test_page_stops_at_last_complete_line(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'MAX_FILE_PAGE_BYTES', 16)
+    path = tmp_path / 'lines.txt'
+    path.write_bytes(b'aaaa\nbbbb\ncccc\ndddd\n')
+    data, read, truncated = backend.LineIndex(str(path)).read_lines(0, 10)
+    assert (data, read, truncated) == (b'aaaa\nbbbb\ncccc\n', 3, None)
+
+
+def test_overlong_line_is_marked_truncated(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'MAX_FILE_PAGE_BYTES', 16)
+    path = tmp_path / 'minified.js'
+    long_line = 'x' * 14 + '中文' + 'y' * 10
+    path.write_text(f'short\n{long_line}\nafter\n', encoding='utf-8')
+    index = backend.LineIndex(str(path))
+    
+    data, read, truncated = index.read_lines(1, 5)
+    # 截斷點落在「中」的中間時退回到字元開頭，其餘部分的位置與該行的結束位置一併回傳
+    assert data == b'x' * 14
+    assert read == 1
+    next_offset, line_end = truncated
+    raw = path.read_bytes()
+    assert raw[next_offset:line_end].decode('utf-8') == '中文' + 'y' * 10
+    assert index.read_lines(2, 5) == (b'after\n', 1, None)
+
+
+def test_file_route_reports_truncated_line(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'MAX_FILE_PAGE_BYTES', 16)
+    monkeypatch.setattr(backend, 'current_workspace', str(tmp_path))
+    (tmp_path / 'minified.js').write_text('a' * 40 + '\nend\n', encoding='utf-8')
+    data = backend.app.test_client().get('/api/file?path=minified.js&start_line=1').get_json()
+    assert data['content'] == 'a' * 16
+    assert (data['end_line'], data['next_line']) == (1, 2)
+    assert data['truncated'] == {'line': 1, 'next_offset': 16, 'omitted_bytes': 24}
+
+
+def test_read_byte_range_always_advances(tmp_path):
+    path = tmp_path / 'utf8.txt'
+    text = 'a中文字b\n' * 3
+    path.write_text(text, encoding='utf-8')
+    size = path.stat().st_size
+    
+    # 長度小於一個字元時也要前進到下一個字元邊界
+    content, end = backend.read_byte_range(str(path), 1, 1)
+    assert content == '中'
+    assert end == 4
+    
+    for length in (1, 2, 5):
+        pages = []
+        offset = 0
+        while offset < size:
+            content, end = backend.read_byte_range(str(path), offset, length)
+            assert end > offset
+            pages.append(content)
+            offset = end
+        assert ''.join(pages) == text
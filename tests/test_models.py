@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def catalog(vibe_backend, stub_server, monkeypatch):
+    monkeypatch.setitem(vibe_backend.app.config, 'LLM_API_URL', stub_server.url)
+    return vibe_backend.ModelCatalog()
+
+
+def slow_models(delay, models):
+    def handler(request):
+        time.sleep(delay)
+        request.respond(200, json.dumps({'models': models}), {'Content-Type': 'application/json'})
+    return handler
+
+
+def wait_for(catalog, timeout=5):
+    deadline = time.monotonic() + timeout
+    while catalog._refreshing:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_concurrent_requests_get_static_list_and_fetch_once(catalog, stub_server, vibe_backend):
+    stub_server.routes['GET', '/models'] = slow_models(0.3, [{'id': 'local-coder', 'name': 'Local Coder'}])
+    results = []
+    
+    def get():
+        started = time.monotonic()
+        results.append((catalog.get(), time.monotonic() - started))
+    
+    threads = [threading.Thread(target=get) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    # 沒有請求等待 LLM API，全部先拿到靜態清單
+    static_ids = [model['id'] for model in vibe_backend.app.config['LLM_MODELS']]
+    for (models, etag), elapsed in results:
+        assert [model['id'] for model in models] == static_ids
+        assert etag == catalog.static_etag
+        assert elapsed < 0.2
+    
+    wait_for(catalog)
+    assert stub_server.count('GET', '/models') == 1
+    models, etag = catalog.get()
+    assert [model['id'] for model in models] == static_ids + ['local-coder']
+    assert etag != catalog.static_etag
+
+
+def test_stale_list_is_served_while_refreshing(catalog, stub_server, vibe_backend, monkeypatch):
+    stub_server.routes['GET', '/models'] = slow_models(0, [{'id': 'v1'}])
+    catalog.get()
+    wait_for(catalog)
+    first = catalog.get()
+    
+    stub_server.routes['GET', '/models'] = slow_models(0.3, [{'id': 'v2'}])
+    catalog.fetched_at -= vibe_backend.app.config['MODELS_TTL']
+    assert catalog.get() == first
+    wait_for(catalog)
+    assert catalog.get()[0][-1]['id'] == 'v2'
+    
+    # 清單太舊時不再使用，改回傳靜態清單並在背景更新
+    catalog.fetched_at -= vibe_backend.app.config['MODELS_STALE_TTL']
+    assert catalog.get() == (catalog.static_models, catalog.static_etag)
+    wait_for(catalog)
+
+
+def test_failed_fetch_keeps_previous_list(catalog, stub_server, vibe_backend):
+    stub_server.routes['GET', '/models'] = slow_models(0, [{'id': 'v1'}])
+    catalog.get()
+    wait_for(catalog)
+    models = catalog.get()
+    
+    stub_server.routes['GET', '/models'] = lambda request: request.respond(404)
+    catalog.fetched_at -= vibe_backend.app.config['MODELS_TTL']
+    catalog.get()
+    wait_for(catalog)
+    assert catalog.get() == models
+    wait_for(catalog)
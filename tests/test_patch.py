@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+import backend
+from test_diff import large_cases, small_cases
+
+
+@pytest.mark.parametrize('cases', [small_cases, large_cases])
+def test_unified_diff_round_trip(cases):
+    for a_lines, b_lines in cases():
+        opcodes, _ = backend.compute_opcodes(a_lines, b_lines)
+        text = '\n'.join(backend.iter_unified_diff(a_lines, b_lines, 'a/f.py', 'b/f.py', opcodes))
+        if a_lines == b_lines:
+            assert text == ''
+            continue
+        
+        patches = backend.parse_unified_diff(text)
+        assert len(patches) == 1
+        new_lines, results = backend.apply_hunks(a_lines, patches[0]['hunks'])
+        assert new_lines == b_lines
+        assert all(result['status'] == 'applied' for result in results)
+
+
+def test_apply_hunks_tolerates_shifted_lines():
+    a_lines = ['def main():', '    run()', '    return 0']
+    b_lines = ['def main():', '    setup()', '    run()', '    return 0']
+    opcodes, _ = backend.compute_opcodes(a_lines, b_lines)
+    text = '\n'.join(backend.iter_unified_diff(a_lines, b_lines, 'a/f.py', 'b/f.py', opcodes))
+    hunks = backend.parse_unified_diff(text)[0]['hunks']
+    
+    # 檔案開頭多了幾行，hunk 仍應在偏移後的位置套用
+    shifted = ['import os', ''] + a_lines
+    new_lines, results = backend.apply_hunks(shifted, hunks)
+    assert new_lines == ['import os', ''] + b_lines
+    assert results[0]['status'] == 'applied'
+
+
+def test_parse_unified_diff_ignores_surrounding_text():
+    text = ('Here is the fix:\n'
+            '--- a/app.py\n'
+            '+++ b/app.py\n'
+            '@@ -1,2 +1,2 @@\n'
+            ' x = 1\n'
+            '-y = 2\n'
+            '+y = 3\n'
+            'Let me know if this helps.\n')
+    patches = backend.parse_unified_diff(text)
+    assert [patch['new_path'] for patch in patches] == ['app.py']
+    assert patches[0]['hunks'][0]['lines'] == [' x = 1', '-y = 2', '+y = 3']
+
+
+PATCH = ('--- a/app.py\n'
+         '+++ b/app.py\n'
+         '@@ -1,2 +1,2 @@\n'
+         ' x = 1\n'
+         '-y = 2\n'
+         '+y = 3\n')
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'current_workspace', str(tmp_path))
+    (tmp_path / 'app.py').write_text('x = 1\ny = 2\n', encoding='utf-8')
+    return tmp_path
+
+
+def test_patch_applies_to_buffer_and_invalidates_it(workspace):
+    full_path = str(workspace / 'app.py')
+    version = backend.buffer_store.update(full_path, 'x = 1\ny = 2\nz = 4\n')
+    
+    outcome = backend.apply_file_patch(backend.parse_unified_diff(PATCH)[0])
+    assert outcome['status'] == 'applied'
+    assert (workspace / 'app.py').read_text(encoding='utf-8') == 'x = 1\ny = 3\nz = 4\n'
+    assert backend.buffer_store.get(full_path) is None
+    # 編輯器手上的版本已過期，之後的儲存需先重新同步
+    with pytest.raises(backend.VersionConflictError):
+        backend.buffer_store.update(full_path, 'stale\n', base_version=version)
+
+
+def test_concurrent_edit_waits_for_patch_write(workspace, monkeypatch):
+    full_path = str(workspace / 'app.py')
+    writing = threading.Event()
+    release = threading.Event()
+    atomic_write = backend.atomic_write
+    
+    def slow_atomic_write(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        return atomic_write(*args, **kwargs)
+    
+    monkeypatch.setattr(backend, 'atomic_write', slow_atomic_write)
+    patcher = threading.Thread(target=backend.apply_file_patch, args=(backend.parse_unified_diff(PATCH)[0],))
+    patcher.start()
+    assert writing.wait(5)
+    
+    editor = threading.Thread(target=backend.buffer_store.update, args=(full_path, 'from the editor\n'))
+    editor.start()
+    editor.join(0.2)
+    assert editor.is_alive()
+    
+    release.set()
+    patcher.join(5)
+    editor.join(5)
+    # 編輯在 patch 寫入之後才套用，保留為較新的緩衝區，不會被 patch 的寫入標記為已保存
+    assert (workspace / 'app.py').read_text(encoding='utf-8') == 'x = 1\ny = 3\n'
+    assert backend.buffer_store.get(full_path)[0] == 'from the editor\n'
+    backend.buffer_store.discard(full_path)
+
+
+def test_dry_run_and_rejected_patches_leave_buffer_alone(workspace):
+    full_path = str(workspace / 'app.py')
+    version = backend.buffer_store.update(full_path, 'x = 1\ny = 2\n')
+    assert backend.apply_file_patch(backend.parse_unified_diff(PATCH)[0], dry_run=True)['status'] == 'applied'
+    
+    backend.buffer_store.update(full_path, 'unrelated\n')
+    assert backend.apply_file_patch(backend.parse_unified_diff(PATCH)[0])['status'] == 'rejected'
+    assert backend.buffer_store.get(full_path) == ('unrelated\n', version + 1)
+    backend.buffer_store.discard(full_path)
@@ -0,0 +1,43 @@
+import threading
+
+import backend
+
+
+def related_paths(index, prompt):
+    return [result['path'] for result in index.related(prompt)]
+
+
+def test_related_ranks_matching_file_first(tmp_path):
+    (tmp_path / 'billing.py').write_text('def charge_invoice(invoice):\n    return invoice.total\n', encoding='utf-8')
+    (tmp_path / 'users.py').write_text('def create_user(name):\n    return name\n', encoding='utf-8')
+    index = backend.RelatedFileIndex(backend.WorkspaceIndex(str(tmp_path)), embedding_model=None)
+    index.sync(force=True)
+    assert related_paths(index, 'fix the invoice charge')[0] == 'billing.py'
+
+
+def test_related_refreshes_in_background(tmp_path, monkeypatch):
+    (tmp_path / 'users.py').write_text('def create_user(name):\n    return name\n', encoding='utf-8')
+    index = backend.RelatedFileIndex(backend.WorkspaceIndex(str(tmp_path)), embedding_model=None)
+    # 第一次建立前查詢不觸發更新
+    assert related_paths(index, 'user') == []
+    assert not index._sync_lock.locked()
+    index.sync(force=True)
+    
+    (tmp_path / 'users.py').write_text('def create_user(name):\n    return shipment_label(name)\n', encoding='utf-8')
+    index._last_sync = 1
+    release = threading.Event()
+    read_file = index._read_file
+    
+    def slow_read_file(*args):
+        release.wait(5)
+        return read_file(*args)
+    
+    monkeypatch.setattr(index, '_read_file', slow_read_file)
+    # 查詢以目前的索引回答，不等待檔案重新讀取
+    assert related_paths(index, 'shipment label') == []
+    assert index._sync_lock.locked()
+    
+    release.set()
+    with index._sync_lock:
+        pass
+    assert related_paths(index, 'shipment label') == ['users.py']
@@ -0,0 +1,152 @@
+import json
+import time
+
+import pytest
+
+import backend
+
+
+def stream_tokens(tokens, first_delay=0):
+    """以 OpenAI 相容的 SSE 格式逐段回應，first_delay 秒後才送出第一段"""
+    def handler(request):
+        request.close_connection = True
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.send_header('Connection', 'close')
+        request.end_headers()
+        time.sleep(first_delay)
+        try:
+            for token in tokens:
+                chunk = {'choices': [{'delta': {'content': token}}]}
+                request.wfile.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                request.wfile.flush()
+                time.sleep(0.01)
+            request.wfile.write(b'data: [DONE]\n\n')
+        except OSError:
+            pass  # 路由器已取消請求並關閉連線
+    return handler
+
+
+def endpoint(server, handler):
+    server.routes['POST', '/v1/chat/completions'] = handler
+    return backend.LLMEndpoint(f'{server.url}/v1/chat/completions')
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def complete(router):
+    return ''.join(router.iter_completion({'model': 'm', 'messages': []}))
+
+
+def test_stream_is_decoded_as_utf8(stub_servers):
+    # text/event-stream 沒有標示 charset，requests 預設會以 ISO-8859-1 解碼
+    router = backend.LLMRouter({'m': [endpoint(stub_servers(), stream_tokens(['你好', '世界']))]}, hedge_delay=0)
+    assert complete(router) == '你好世界'
+
+
+def test_fails_over_before_first_token(stub_servers):
+    broken = endpoint(stub_servers(), lambda request: request.respond(500))
+    healthy = endpoint(stub_servers(), stream_tokens(['hel', 'lo']))
+    router = backend.LLMRouter({'m': [broken, healthy]}, hedge_delay=0)
+    
+    assert complete(router) == 'hello'
+    assert router.stats()['failovers'] == 1
+    assert broken.failures == 1 and healthy.failures == 0
+
+
+def test_does_not_fail_over_after_first_token(stub_servers):
+    def token_then_abort(request):
+        request.close_connection = True
+        request.send_response(200)
+        request.send_header('Connection', 'close')
+        request.end_headers()
+        request.wfile.write(b'data: {"choices": [{"delta": {"content": "par"}}]}\n\ndata: {broken')
+    
+    servers = [stub_servers(), stub_servers()]
+    partial = endpoint(servers[0], token_then_abort)
+    other = endpoint(servers[1], stream_tokens(['full']))
+    router = backend.LLMRouter({'m': [partial, other]}, hedge_delay=0)
+    
+    tokens = []
+    with pytest.raises(Exception):
+        for token in router.iter_completion({'model': 'm', 'messages': []}):
+            tokens.append(token)
+    # 已經輸出部分內容，不能再改用其他端點重新產生
+    assert tokens == ['par']
+    assert servers[1].count('POST', '/v1/chat/completions') == 0
+
+
+def test_hedges_slow_endpoint_and_cancels_loser(stub_servers):
+    slow = endpoint(stub_servers(), stream_tokens(['slow'] * 5, first_delay=1.0))
+    fast = endpoint(stub_servers(), stream_tokens(['fa', 'st']))
+    router = backend.LLMRouter({'m': [slow, fast]}, hedge_delay=0.2)
+    
+    assert complete(router) == 'fast'
+    stats = router.stats()
+    assert stats['hedges'] == 1 and stats['hedge_wins'] == 1
+    # 落敗的請求被取消，不計為失敗，等待過的時間作為延遲的下限
+    wait_until(lambda: slow.in_flight == 0)
+    assert slow.failures == 0
+    assert slow.latency >= 0.2
+    assert fast.latency < slow.latency
+
+
+def test_selects_lowest_ewma_latency_weighted_by_load():
+    first = backend.LLMEndpoint('http://127.0.0.1:9/a')
+    second = backend.LLMEndpoint('http://127.0.0.1:9/b')
+    router = backend.LLMRouter({'*': [first, second]}, hedge_delay=0)
+    
+    first.record_latency(1.0)
+    second.record_latency(0.1)
+    second.record_latency(1.1)
+    assert second.latency == pytest.approx(backend.ROUTER_EWMA_ALPHA * 1.1 + (1 - backend.ROUTER_EWMA_ALPHA) * 0.1)
+    assert router.select('any-model') is second
+    
+    # 進行中的請求越多，預期等待越久
+    for _ in range(2):
+        second.begin()
+    assert router.select('any-model') is first
+    assert router.select('any-model', exclude={first}) is second
+
+
+def test_unhealthy_endpoint_cools_down(monkeypatch):
+    flaky = backend.LLMEndpoint('http://127.0.0.1:9/flaky')
+    steady = backend.LLMEndpoint('http://127.0.0.1:9/steady')
+    steady.record_latency(5.0)
+    router = backend.LLMRouter({'m': [flaky, steady]}, hedge_delay=0)
+    
+    for _ in range(backend.ROUTER_UNHEALTHY_THRESHOLD):
+        flaky.record_failure(RuntimeError('boom'))
+    assert not flaky.healthy
+    assert router.select('m') is steady
+    
+    # 冷卻時間過後再次放行，讓端點有機會恢復
+    monkeypatch.setattr(backend, 'ROUTER_UNHEALTHY_COOLDOWN', 0)
+    assert router.select('m') is flaky
+    flaky.record_success()
+    assert flaky.healthy
+
+
+def test_admin_router_endpoint(stub_servers, monkeypatch):
+    client = backend.app.test_client()
+    monkeypatch.setattr(backend, 'llm_router', None)
+    assert client.get('/api/admin/llm/router').get_json() == {'success': True, 'enabled': False}
+    
+    server = stub_servers()
+    pool_endpoint = endpoint(server, stream_tokens(['ok']))
+    router = backend.LLMRouter({'m': [pool_endpoint]}, hedge_delay=0)
+    monkeypatch.setattr(backend, 'llm_router', router)
+    assert complete(router) == 'ok'
+    
+    data = client.get('/api/admin/llm/router').get_json()
+    assert data['enabled']
+    assert data['stats']['requests'] == 1
+    [snapshot] = data['stats']['pools']['m']
+    assert snapshot['url'] == pool_endpoint.url
+    assert snapshot['requests'] == 1 and snapshot['healthy']
+    assert data['circuits'][server.url.split('/')[2]]['state'] == 'closed'
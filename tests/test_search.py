@@ -0,0 +1,112 @@
+import re
+import threading
+
+import pytest
+
+import backend
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('def foo_bar', ['def foo_bar']),
+    (r'def\s+handle_request', ['def', 'handle_request']),
+    ('colou?r_name', ['colo', 'r_name']),
+    (r'class (\w+)?Handler', ['class ', 'Handler']),
+    ('foo[ab]{2}barx', ['foo', 'barx']),
+    ('foo|bar', []),
+])
+def test_regex_required_literals(pattern, expected):
+    assert backend.regex_required_literals(pattern) == expected
+
+
+@pytest.mark.parametrize('pattern', [
+    r'(?:return\s+){1,3}',
+    '(pass){1,2}',
+    '(abc){0,}def',
+    '(abc)*def',
+    '(abc)?def',
+    '(abc)+def',
+])
+def test_quantified_group_literals_are_present_in_match(pattern):
+    # 量詞的內容不能被當成必要字串，而且每個必要字串都要出現在實際符合的文字中
+    text = 'x = 1\nreturn return pass pass abcdef def\n'
+    match = re.search(pattern, text)
+    assert match
+    for literal in backend.regex_required_literals(pattern):
+        assert literal in match.group(0)
+
+
+def test_extract_trigrams():
+    assert backend.extract_trigrams('abcd') == {'abc', 'bcd'}
+
+
+@pytest.fixture
+def search_index(tmp_path):
+    (tmp_path / 'a.py').write_text('def handler():\n    return return_value\n', encoding='utf-8')
+    (tmp_path / 'b.py').write_text('class Other:\n    pass\n', encoding='utf-8')
+    index = backend.SearchIndex(backend.WorkspaceIndex(str(tmp_path)), index_dir=None)
+    index.sync(force=True)
+    return index
+
+
+@pytest.mark.parametrize('query, expected', [
+    (r'(?:return\s+){1,3}', ['a.py']),
+    ('(pass){1,2}', ['b.py']),
+    (r'def\s+handler', ['a.py']),
+])
+def test_regex_search_with_quantified_groups(search_index, query, expected):
+    results, complete = search_index.search_text(query, regex=True)
+    assert complete
+    assert [result['path'] for result in results] == expected
+
+
+def test_large_files_are_scanned_without_prefilter(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'SEARCH_MAX_FILE_SIZE', 64)
+    (tmp_path / 'small.py').write_text('needle_value = 1\n', encoding='utf-8')
+    (tmp_path / 'large.py').write_text('x = 0\n' * 20 + 'needle_value = 2\n', encoding='utf-8')
+    (tmp_path / 'blob.txt').write_bytes(b'\0needle_value')
+    index = backend.SearchIndex(backend.WorkspaceIndex(str(tmp_path)), index_dir=None)
+    index.sync(force=True)
+    
+    for query in ('needle_value', 'ne'):
+        results, complete = index.search_text(query)
+        assert complete
+        assert sorted(result['path'] for result in results) == ['large.py', 'small.py']
+
+
+def test_search_does_not_wait_for_running_sync(search_index):
+    # 另一個執行緒正在更新索引時，非阻塞的 sync 立即返回
+    with search_index._sync_lock:
+        assert search_index.sync(force=True, blocking=False) == 0
+    assert search_index.search_text('handler')[0]
+
+
+def test_refresh_reindexes_in_background(search_index, tmp_path, monkeypatch):
+    (tmp_path / 'b.py').write_text('class Other:\n    fresh_token = 1\n', encoding='utf-8')
+    search_index._last_sync = 1
+    release = threading.Event()
+    read_entry = search_index._read_entry
+    
+    def slow_read_entry(*args):
+        release.wait(5)
+        return read_entry(*args)
+    
+    monkeypatch.setattr(search_index, '_read_entry', slow_read_entry)
+    # 查詢只觸發背景更新，不等待檔案重新讀取
+    search_index.refresh()
+    assert search_index._sync_lock.locked()
+    assert search_index.search_text('fresh_token')[0] == []
+    # 更新進行中再次查詢不會另外啟動更新
+    search_index.refresh()
+    
+    release.set()
+    with search_index._sync_lock:
+        pass
+    assert [result['path'] for result in search_index.search_text('fresh_token')[0]] == ['b.py']
+
+
+def test_refresh_leaves_first_build_to_build_indexes(tmp_path):
+    (tmp_path / 'a.py').write_text('x = 1\n', encoding='utf-8')
+    index = backend.SearchIndex(backend.WorkspaceIndex(str(tmp_path)), index_dir=None)
+    index.refresh()
+    assert not index._sync_lock.locked()
+    assert index.indexing
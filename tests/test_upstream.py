@@ -0,0 +1,98 @@
+import socket
+
+import pytest
+import requests
+
+import backend
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(backend.UpstreamClient, '_backoff', staticmethod(lambda attempt, response=None: 0))
+    return backend.UpstreamClient(connect_timeout=1, read_timeout=5, max_retries=2)
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}/generate'
+
+
+def test_post_is_not_retried_on_plain_5xx(client, stub_server):
+    stub_server.routes['POST', '/generate'] = lambda handler: handler.respond(503)
+    response = client.post(f'{stub_server.url}/generate', json={})
+    assert response.status_code == 503
+    assert stub_server.count('POST', '/generate') == 1
+
+
+def test_post_is_retried_when_upstream_asks_with_retry_after(client, stub_server):
+    statuses = iter([429, 503, 200])
+    stub_server.routes['POST', '/generate'] = lambda handler: handler.respond(next(statuses), headers={'Retry-After': '0'})
+    assert client.post(f'{stub_server.url}/generate', json={}).status_code == 200
+    assert stub_server.count('POST', '/generate') == 3
+
+
+def test_get_is_retried_on_retryable_status(client, stub_server):
+    statuses = iter([502, 504, 200])
+    stub_server.routes['GET', '/models'] = lambda handler: handler.respond(next(statuses))
+    assert client.get(f'{stub_server.url}/models').status_code == 200
+    assert stub_server.count('GET', '/models') == 3
+
+
+def test_aborted_post_is_not_resent(client, stub_server):
+    stub_server.routes['POST', '/generate'] = lambda handler: handler.abort()
+    stub_server.routes['GET', '/models'] = lambda handler: handler.abort()
+    # 上游已收到 POST，連線中斷時重送可能造成重複處理
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(f'{stub_server.url}/generate', json={})
+    assert stub_server.count('POST', '/generate') == 1
+    
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get(f'{stub_server.url}/models')
+    assert stub_server.count('GET', '/models') == 3
+
+
+def test_post_is_retried_when_connection_is_refused(client, monkeypatch):
+    attempts = []
+    monkeypatch.setattr(backend.UpstreamClient, '_backoff',
+                        staticmethod(lambda attempt, response=None: attempts.append(attempt) or 0))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(closed_port_url(), json={})
+    assert attempts == [0, 1]
+
+
+def test_circuit_opens_after_consecutive_failures(client, stub_server, monkeypatch):
+    monkeypatch.setattr(backend, 'CIRCUIT_FAILURE_THRESHOLD', 2)
+    stub_server.routes['POST', '/generate'] = lambda handler: handler.respond(500)
+    url = f'{stub_server.url}/generate'
+    for _ in range(2):
+        assert client.post(url, json={}).status_code == 500
+    
+    with pytest.raises(backend.CircuitOpenError):
+        client.post(url, json={})
+    assert stub_server.count('POST', '/generate') == 2
+    assert client.stats()[url.split('/')[2]] == {'state': 'open', 'failures': 2}
+
+
+def test_circuit_breaker_half_open_lets_one_probe_through():
+    breaker = backend.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.snapshot()['state'] == 'half_open'
+    assert not breaker.allow()
+    
+    breaker.record_failure()
+    assert breaker.snapshot()['state'] == 'open'
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.snapshot() == {'state': 'closed', 'failures': 0}
+
+
+def test_vibe_backend_uses_shared_breaker_and_jittered_retry(vibe_backend):
+    assert vibe_backend.CircuitBreaker is backend.CircuitBreaker
+    retry = vibe_backend.llm_adapter.max_retries
+    assert isinstance(retry, vibe_backend.JitteredRetry)
+    retry = retry.increment('GET', '/models', error=ConnectionError()).increment('GET', '/models', error=ConnectionError())
+    delays = {retry.get_backoff_time() for _ in range(20)}
+    assert len(delays) > 1
+    assert all(0 <= delay <= 1.0 for delay in delays)
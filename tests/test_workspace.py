@@ -0,0 +1,37 @@
+import os
+
+import backend
+
+
+def write_tree(root, paths):
+    for path in paths:
+        full_path = root / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_text('x = 1\n', encoding='utf-8')
+
+
+def test_gitignore_anchoring(tmp_path):
+    (tmp_path / '.gitignore').write_text('/build\ndocs/tmp/\n*.log\ncache/\n# comment\n!keep.py\n', encoding='utf-8')
+    write_tree(tmp_path, ['build/a.py', 'src/build/b.py', 'docs/tmp/c.py', 'x/docs/tmp/d.py',
+                          'e.log', 'src/e.log', 'cache/f.py', 'src/cache/g.py', 'cache.py', 'node_modules/h.py'])
+    index = backend.WorkspaceIndex(str(tmp_path))
+    # 開頭為 / 或含有 / 的樣式只相對於根目錄比對，其他樣式比對任何層級
+    assert index.files() == ['.gitignore', 'cache.py', 'src/build/b.py', 'x/docs/tmp/d.py']
+
+
+def test_workspace_index_tracks_changes(tmp_path):
+    write_tree(tmp_path, ['a.py', 'pkg/b.py', 'pkg/notes.bin'])
+    index = backend.WorkspaceIndex(str(tmp_path), backend.SUPPORTED_EXTENSIONS, refresh_interval=0)
+    assert index.files() == ['a.py', 'pkg/b.py']
+    
+    write_tree(tmp_path, ['pkg/sub/c.py'])
+    os.remove(tmp_path / 'a.py')
+    assert index.files() == ['pkg/b.py', 'pkg/sub/c.py']
+    assert [entry['path'] for entry in index.children('pkg')] == ['pkg/sub', 'pkg/b.py']
+
+
+def test_vibe_backend_shares_workspace_index(tmp_path, vibe_backend):
+    (tmp_path / '.gitignore').write_text('/build\n', encoding='utf-8')
+    write_tree(tmp_path, ['build/a.py', 'src/build/b.py', 'README.MD', 'image.png'])
+    assert isinstance(vibe_backend.WorkspaceIndex(str(tmp_path)), backend.shared_workspace.WorkspaceIndex)
+    assert vibe_backend.WorkspaceIndex(str(tmp_path)).files() == ['README.MD', 'src/build/b.py']
@@ -1,28 +1,199 @@
 import os
+import sys
 import json
-from flask import Flask, request, jsonify, send_from_directory
+import importlib.util
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
+from werkzeug.serving import make_server
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time
+import random
+import hashlib
+import threading
+import signal
 from pathlib import Path
 
 app = Flask(__name__, static_folder='static')
 
+# 與 UI/backend.py 共用的模組所在目錄
+SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared')
+
+def load_shared_module(name):
+    """載入與 UI/backend.py 共用的 shared/<name>.py；shared 不是套件，因此以檔案路徑載入"""
+    module_name = f'vibe_shared_{name}'
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(SHARED_DIR, f'{name}.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+shared_workspace = load_shared_module('workspace')
+shared_circuit_breaker = load_shared_module('circuit_breaker')
+
 # 配置
 class Config:
     LLM_API_URL = os.environ.get('LLM_API_URL', 'http://internal-api.company.com/llm')
     LLM_API_KEY = os.environ.get('LLM_API_KEY', 'your-api-key')
     MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
     ALLOWED_EXTENSIONS = {'txt', 'py', 'js', 'html', 'css', 'json', 'md', 'java', 'c', 'cpp', 'cs', 'go', 'rb', 'rs', 'php', 'ts', 'jsx', 'tsx'}
+    # 掃描時直接略過的目錄（與 UI/backend.py 相同），另外也略過工作空間 .gitignore 中的項目
+    IGNORED_DIRS = shared_workspace.IGNORED_DIRS
+    INDEX_REFRESH_INTERVAL = 2  # 檔案索引檢查目錄變更的最短間隔（秒）
+    LLM_POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', '20'))  # 每個主機的連線數上限
+    LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', '5'))
+    LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', '120'))
+    LLM_MAX_RETRIES = 2
+    CIRCUIT_FAILURE_THRESHOLD = 5  # 連續失敗幾次後開啟斷路器
+    CIRCUIT_RESET_TIMEOUT = 30  # 斷路器開啟後等待幾秒才放行試探請求
+    # 靜態模型清單，與 LLM API 回傳的模型合併；API 無法使用時仍可選擇這些模型
+    LLM_MODELS = [
+        {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo'},
+        {'id': 'gpt-4', 'name': 'GPT-4'},
+        {'id': 'llama-2', 'name': 'Llama 2'},
+    ]
+    MODELS_TTL = 300  # 模型清單在此秒數內視為最新
+    MODELS_STALE_TTL = 3600  # 超過 MODELS_TTL 但未超過此秒數時先回傳舊清單，並在背景更新
+    MODELS_FETCH_TIMEOUT = 5
+    # 伺服器設定：ENVIRONMENT=development 時使用含重載與除錯器的開發伺服器，否則使用多執行緒伺服器
+    ENVIRONMENT = os.environ.get('ENVIRONMENT', 'production')
+    HOST = os.environ.get('HOST', '0.0.0.0')
+    PORT = int(os.environ.get('PORT', '5000'))
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '16'))
+    SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '10'))  # 關閉時等待進行中請求的秒數
 
 app.config.from_object(Config)
 
+class JitteredRetry(Retry):
+    """指數退避加上 full jitter，避免多個請求在同一時間一起重試（urllib3 1.26 沒有 backoff_jitter 參數）"""
+    
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+# 對 LLM API 共用的連線池：keep-alive、逾時，並以含抖動的指數退避重試
+# 連線失敗（請求尚未送出）對所有方法重試；429/502/503/504 只對冪等方法重試，
+# 避免 POST /generate 在上游已開始處理後被重複送出
+llm_session = requests.Session()
+llm_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=app.config['LLM_POOL_SIZE'],
+    pool_block=True,
+    max_retries=JitteredRetry(
+        total=app.config['LLM_MAX_RETRIES'],
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS'}),
+        raise_on_status=False
+    )
+)
+llm_session.mount('http://', llm_adapter)
+llm_session.mount('https://', llm_adapter)
+LLM_TIMEOUT = (app.config['LLM_CONNECT_TIMEOUT'], app.config['LLM_READ_TIMEOUT'])
+
+# LLM API 的斷路器（與 UI/backend.py 共用 shared/circuit_breaker.py）
+CircuitOpenError = shared_circuit_breaker.CircuitOpenError
+CircuitBreaker = shared_circuit_breaker.CircuitBreaker
+
+llm_breaker = CircuitBreaker(app.config['CIRCUIT_FAILURE_THRESHOLD'], app.config['CIRCUIT_RESET_TIMEOUT'])
+
+def llm_request(method, path, **kwargs):
+    """經由斷路器向 LLM API 發送請求；連線失敗或 5xx 計為失敗，斷路器開啟時拋出 CircuitOpenError"""
+    if not llm_breaker.allow():
+        raise CircuitOpenError('LLM API temporarily unavailable')
+    
+    headers = dict(kwargs.pop('headers', {}), Authorization=f"Bearer {app.config['LLM_API_KEY']}")
+    try:
+        response = llm_session.request(method, f"{app.config['LLM_API_URL']}{path}", headers=headers, **kwargs)
+    except Exception:
+        llm_breaker.record_failure()
+        raise
+    
+    if response.status_code >= 500:
+        llm_breaker.record_failure()
+    else:
+        llm_breaker.record_success()
+    return response
+
+class ModelCatalog:
+    """可用模型清單：合併靜態清單與 LLM API 的模型，依 stale-while-revalidate 方式快取
+    
+    請求從不等待 LLM API：尚未取得或清單太舊時先回傳靜態清單，由背景執行緒更新，
+    同時只有一個執行緒向 LLM API 取得清單。
+    """
+    
+    def __init__(self):
+        self.static_models = [dict(model) for model in app.config['LLM_MODELS']]
+        self.static_etag = self._etag(self.static_models)
+        self.models = None
+        self.etag = None
+        self.fetched_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _etag(models):
+        return hashlib.sha1(json.dumps(models, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def _fetch(self):
+        """向 LLM API 取得模型清單並與靜態清單合併；失敗時保留原本的清單，之後的請求再於背景重試"""
+        try:
+            models = {model['id']: dict(model) for model in self.static_models}
+            response = llm_request(
+                'GET', '/models',
+                timeout=(app.config['LLM_CONNECT_TIMEOUT'], app.config['MODELS_FETCH_TIMEOUT'])
+            )
+            response.raise_for_status()
+            for model in response.json()['models']:
+                models[model['id']] = dict(models.get(model['id'], {}), **model)
+            
+            merged = list(models.values())
+            etag = self._etag(merged)
+            with self._lock:
+                self.models = merged
+                self.etag = etag
+                self.fetched_at = time.time()
+        except Exception as e:
+            app.logger.warning(f'Error fetching models: {str(e)}')
+        finally:
+            with self._lock:
+                self._refreshing = False
+    
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._fetch, daemon=True).start()
+    
+    def get(self):
+        """回傳 (模型清單, ETag)；過期時在背景更新，超過 MODELS_STALE_TTL 或尚未取得時回傳靜態清單"""
+        with self._lock:
+            models, etag, age = self.models, self.etag, time.time() - self.fetched_at
+        if models is None or age >= app.config['MODELS_TTL']:
+            self.refresh_in_background()
+        if models is None or age >= app.config['MODELS_STALE_TTL']:
+            return self.static_models, self.static_etag
+        return models, etag
+
+model_catalog = ModelCatalog()
+
 # 全局變數
 WORKSPACE_PATH = None
+WORKSPACE_INDEX = None
 
 # 工具函數
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+class WorkspaceIndex(shared_workspace.WorkspaceIndex):
+    """工作空間的檔案索引（見 shared/workspace.py），只收錄允許的副檔名"""
+    
+    def __init__(self, directory):
+        super().__init__(directory, allowed_file, app.config['INDEX_REFRESH_INTERVAL'], app.config['IGNORED_DIRS'])
+
 def is_path_in_workspace(path):
     if not WORKSPACE_PATH:
         return False
@@ -46,6 +217,37 @@ def validate_path(path):
     
     return True
 
+# 進行中的請求數與關閉狀態，供健康檢查與優雅關閉使用
+STARTED_AT = time.time()
+SHUTTING_DOWN = threading.Event()
+IN_FLIGHT = 0
+IN_FLIGHT_COND = threading.Condition()
+
+@app.before_request
+def track_request_start():
+    global IN_FLIGHT
+    with IN_FLIGHT_COND:
+        IN_FLIGHT += 1
+
+@app.teardown_request
+def track_request_end(exc=None):
+    global IN_FLIGHT
+    with IN_FLIGHT_COND:
+        IN_FLIGHT -= 1
+        IN_FLIGHT_COND.notify_all()
+
+# 路由：存活檢查
+@app.route('/healthz')
+def liveness():
+    return jsonify({'status': 'ok', 'uptime': round(time.time() - STARTED_AT, 1)})
+
+# 路由：就緒檢查，關閉中回傳 503
+@app.route('/readyz')
+def readiness():
+    if SHUTTING_DOWN.is_set():
+        return jsonify({'status': 'shutting_down'}), 503
+    return jsonify({'status': 'ready', 'models_loaded': model_catalog.models is not None})
+
 # 路由：主頁
 @app.route('/')
 def index():
@@ -54,7 +256,7 @@ def index():
 # 路由：設置工作空間
 @app.route('/api/workspace', methods=['POST'])
 def set_workspace():
-    global WORKSPACE_PATH
+    global WORKSPACE_PATH, WORKSPACE_INDEX
     
     data = request.json
     if not data or 'path' not in data:
@@ -64,16 +266,11 @@ def set_workspace():
     if not os.path.isdir(path):
         return jsonify({'error': 'Invalid directory path'}), 400
     
-    WORKSPACE_PATH = path
-    
-    # 獲取所有檔案
-    files = []
+    # 建立檔案索引，之後的檔案列表只重新掃描有變化的目錄
     try:
-        for root, _, filenames in os.walk(path):
-            for filename in filenames:
-                if allowed_file(filename):
-                    rel_path = os.path.relpath(os.path.join(root, filename), path)
-                    files.append(rel_path)
+        WORKSPACE_INDEX = WorkspaceIndex(path)
+        WORKSPACE_PATH = path
+        files = WORKSPACE_INDEX.files()
     except Exception as e:
         return jsonify({'error': f'Failed to scan directory: {str(e)}'}), 500
     
@@ -85,13 +282,8 @@ def get_files():
     if not WORKSPACE_PATH:
         return jsonify({'error': 'Workspace not set'}), 400
     
-    files = []
     try:
-        for root, _, filenames in os.walk(WORKSPACE_PATH):
-            for filename in filenames:
-                if allowed_file(filename):
-                    rel_path = os.path.relpath(os.path.join(root, filename), WORKSPACE_PATH)
-                    files.append(rel_path)
+        files = WORKSPACE_INDEX.files()
     except Exception as e:
         return jsonify({'error': f'Failed to scan directory: {str(e)}'}), 500
     
@@ -149,18 +341,13 @@ def update_file():
 # 路由：獲取可用模型
 @app.route('/api/llm/models', methods=['GET'])
 def get_models():
-    try:
-        response = requests.get(
-            f"{app.config['LLM_API_URL']}/models",
-            headers={'Authorization': f"Bearer {app.config['LLM_API_KEY']}"}
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to fetch models from LLM API'}), 500
-        
-        return jsonify({'models': response.json()['models']})
-    except Exception as e:
-        return jsonify({'error': f'Error fetching models: {str(e)}'}), 500
+    models, etag = model_catalog.get()
+    
+    # 瀏覽器帶 If-None-Match 且清單未變更時回傳 304
+    response = jsonify({'models': models})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 # 路由：發送查詢到 LLM
 @app.route('/api/llm/query', methods=['POST'])
@@ -184,15 +371,13 @@ def query_llm():
         'max_tokens': 4000
     }
     
+    # 串流模式：以 JSON lines 逐段轉送上游產生的文字
+    if request.json.get('stream'):
+        payload['stream'] = True
+        return Response(stream_with_context(stream_llm_lines(payload)), mimetype='application/x-ndjson')
+    
     try:
-        response = requests.post(
-            f"{app.config['LLM_API_URL']}/generate",
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f"Bearer {app.config['LLM_API_KEY']}"
-            },
-            json=payload
-        )
+        response = llm_request('POST', '/generate', json=payload, timeout=LLM_TIMEOUT)
         
         if response.status_code != 200:
             return jsonify({'error': f'LLM API error: {response.text}'}), 500
@@ -200,13 +385,70 @@ def query_llm():
         llm_response = response.json()
         
         return jsonify({'response': llm_response.get('text', '')})
+    except CircuitOpenError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': f'Error communicating with LLM API: {str(e)}'}), 500
 
+def stream_llm_lines(payload):
+    """轉送 LLM API 的串流回應，每行一個 JSON 物件；客戶端中斷時關閉上游連線"""
+    try:
+        response = llm_request('POST', '/generate', json=payload, stream=True, timeout=LLM_TIMEOUT)
+    except Exception as e:
+        yield json.dumps({'error': f'Error communicating with LLM API: {str(e)}'}) + '\n'
+        return
+    
+    try:
+        if response.status_code != 200:
+            yield json.dumps({'error': f'LLM API error: {response.text}'}) + '\n'
+            return
+        
+        for line in response.iter_lines(decode_unicode=True):
+            if line:
+                yield json.dumps({'text': json.loads(line).get('text', '')}) + '\n'
+        yield json.dumps({'done': True}) + '\n'
+    except Exception as e:
+        yield json.dumps({'error': f'Error communicating with LLM API: {str(e)}'}) + '\n'
+    finally:
+        response.close()
+
 # 啟動應用
+def shutdown_gracefully(stop_server):
+    """停止接收新請求，等待進行中的請求完成後關閉伺服器"""
+    SHUTTING_DOWN.set()
+    deadline = time.monotonic() + app.config['SHUTDOWN_TIMEOUT']
+    with IN_FLIGHT_COND:
+        while IN_FLIGHT > 0 and time.monotonic() < deadline:
+            IN_FLIGHT_COND.wait(deadline - time.monotonic())
+    stop_server()
+
+def serve_production(host, port):
+    """以多執行緒伺服器提供服務（已安裝 waitress 時優先使用），收到 SIGTERM/SIGINT 時優雅關閉"""
+    try:
+        from waitress.server import create_server
+        server = create_server(app, host=host, port=port, threads=app.config['SERVER_THREADS'])
+        run_server, stop_server = server.run, server.close
+    except ImportError:
+        server = make_server(host, port, app, threaded=True)
+        run_server, stop_server = server.serve_forever, server.shutdown
+    
+    def handle_signal(signum, frame):
+        if not SHUTTING_DOWN.is_set():
+            threading.Thread(target=shutdown_gracefully, args=(stop_server,), daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    run_server()
+
 if __name__ == '__main__':
     # 確保靜態文件夾存在
     os.makedirs(app.static_folder, exist_ok=True)
     
-    # 開發模式下啟用熱重載和調試
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # 啟動時先在背景取得模型清單，第一次載入頁面不需等待 LLM API
+    model_catalog.refresh_in_background()
+    
+    if app.config['ENVIRONMENT'] == 'development':
+        # 開發模式下啟用熱重載和調試
+        app.run(debug=True, host=app.config['HOST'], port=app.config['PORT'])
+    else:
+        serve_production(app.config['HOST'], app.config['PORT'])
@@ -1,8 +1,11 @@
 import os
-import shutil
+import sys
+import json
+import time
+import hashlib
+import tempfile
 from pathlib import Path
 import logging
-from flask import Flask
 
 # 配置日誌
 logging.basicConfig(
@@ -15,74 +18,177 @@ logging.basicConfig(
 )
 logger = logging.getLogger('vibe-coding-tool')
 
-def setup_app():
-    """設置應用環境"""
-    logger.info("開始設置應用環境...")
-    
-    # 創建必要的目錄
-    static_dir = Path('./static')
-    static_dir.mkdir(exist_ok=True)
+# 所有路徑都相對於本檔案所在目錄，而不是啟動時的工作目錄
+BASE_DIR = Path(__file__).resolve().parent
+STATIC_DIR = BASE_DIR / 'static'
+BACKEND_MODULE = BASE_DIR / 'vibe-coding-backend.py'
+MANIFEST_NAME = 'asset-manifest.json'
+
+# 前端資源：靜態目錄中的名稱 -> 來源檔名；來源依序在 templates/ 與本目錄中尋找
+ASSET_SOURCES = {
+    'index.html': 'vibe-coding-frontend.html',
+    'styles.css': 'styles.css',
+    'scripts.js': 'scripts.js',
+}
+ASSET_SOURCE_DIRS = [BASE_DIR / 'templates', BASE_DIR]
+
+# 啟動時間預算（秒），超過時記錄警告
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', '2.0'))
+
+def find_source(name):
+    """在來源目錄中尋找前端檔案"""
+    for directory in ASSET_SOURCE_DIRS:
+        for candidate in (directory / name, directory / ASSET_SOURCES[name]):
+            if candidate.is_file():
+                return candidate
+    raise FileNotFoundError(f'找不到前端檔案: {ASSET_SOURCES[name]}')
+
+def fingerprint_name(name, digest):
+    """styles.css -> styles.<雜湊前 10 碼>.css"""
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{digest[:10]}{ext}'
+
+def write_if_changed(path, data):
+    """內容不同時才以原子方式寫入，多個 worker 同時啟動也不會讀到寫到一半的檔案；回傳是否有寫入"""
+    try:
+        if path.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
     
-    # 複製前端文件到靜態目錄
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
     try:
-        # 複製 HTML
-        with open('./templates/index.html', 'r', encoding='utf-8') as src_file:
-            html_content = src_file.read()
-        
-        with open(static_dir / 'index.html', 'w', encoding='utf-8') as dst_file:
-            dst_file.write(html_content)
-        
-        # 複製 CSS
-        with open('./templates/styles.css', 'r', encoding='utf-8') as src_file:
-            css_content = src_file.read()
-        
-        with open(static_dir / 'styles.css', 'w', encoding='utf-8') as dst_file:
-            dst_file.write(css_content)
-        
-        # 複製 JS
-        with open('./templates/scripts.js', 'r', encoding='utf-8') as src_file:
-            js_content = src_file.read()
-        
-        with open(static_dir / 'scripts.js', 'w', encoding='utf-8') as dst_file:
-            dst_file.write(js_content)
-        
-        logger.info("靜態文件準備完成")
-    except Exception as e:
-        logger.error(f"靜態文件準備失敗: {str(e)}")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
         raise
+    return True
+
+def build_assets():
+    """把前端檔案以內容雜湊命名放入靜態目錄，並改寫 index.html 的引用；內容未變時不做任何寫入"""
+    STATIC_DIR.mkdir(exist_ok=True)
+    
+    manifest = {}
+    written = 0
+    for name in ('styles.css', 'scripts.js'):
+        data = find_source(name).read_bytes()
+        fingerprinted = fingerprint_name(name, hashlib.sha256(data).hexdigest())
+        manifest[name] = fingerprinted
+        # 檔名已包含雜湊，檔案存在即表示內容相同
+        if not (STATIC_DIR / fingerprinted).exists():
+            write_if_changed(STATIC_DIR / fingerprinted, data)
+            written += 1
+    
+    # index.html 不加雜湊（入口頁必須固定網址），改為引用加上雜湊的資源
+    html = find_source('index.html').read_text(encoding='utf-8')
+    for name, fingerprinted in manifest.items():
+        attribute = 'href' if name.endswith('.css') else 'src'
+        html = html.replace(f'{attribute}="{name}"', f'{attribute}="static/{fingerprinted}"')
+    written += write_if_changed(STATIC_DIR / 'index.html', html.encode('utf-8'))
+    written += write_if_changed(STATIC_DIR / MANIFEST_NAME,
+                                json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    
+    # 移除舊版本的資源檔
+    current = set(manifest.values())
+    for name in ASSET_SOURCES:
+        stem, ext = os.path.splitext(name)
+        for stale in STATIC_DIR.glob(f'{stem}.*{ext}'):
+            if stale.name not in current and stale.name != name:
+                try:
+                    stale.unlink()
+                except FileNotFoundError:
+                    pass
     
-    # 檢查環境變數
+    return manifest, written
+
+def check_environment():
+    """檢查環境變數"""
     required_env_vars = ['LLM_API_URL', 'LLM_API_KEY']
     missing_vars = [var for var in required_env_vars if not os.environ.get(var)]
     
     if missing_vars:
         logger.warning(f"缺少環境變數: {', '.join(missing_vars)}")
         logger.warning("將使用默認值，這可能不適用於生產環境")
+
+def setup_app():
+    """設置應用環境，回傳資源對照表"""
+    logger.info("開始設置應用環境...")
     
+    try:
+        manifest, written = build_assets()
+        if written:
+            logger.info(f"靜態文件準備完成，更新了 {written} 個檔案")
+        else:
+            logger.info("靜態文件未變更，略過複製")
+    except Exception as e:
+        logger.error(f"靜態文件準備失敗: {str(e)}")
+        raise
+    
+    check_environment()
     logger.info("應用環境設置完成")
+    return manifest
+
+def load_backend():
+    """載入後端模組；檔名含連字號，無法直接 import，因此以檔案路徑載入"""
+    import importlib.util
+    
+    spec = importlib.util.spec_from_file_location('vibe_coding_backend', BACKEND_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    # 先登記模組，Flask 才能由模組名稱找到後端所在目錄作為 static 目錄的基準
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
 
 def create_app():
-    """創建並配置 Flask 應用"""
+    """創建並配置 Flask 應用，記錄各階段耗時"""
+    timings = {}
+    started = time.perf_counter()
+    
     # 先設置環境
-    setup_app()
+    manifest = setup_app()
+    timings['assets'] = time.perf_counter() - started
     
-    # 導入主應用模組
-    from server import app as application
+    # 導入主應用模組（Flask、requests 等較重的模組在這裡才載入）
+    phase_started = time.perf_counter()
+    backend = load_backend()
+    application = backend.app
+    timings['import'] = time.perf_counter() - phase_started
     
     # 額外的生產環境配置
-    if os.environ.get('ENVIRONMENT') == 'production':
+    if os.environ.get('ENVIRONMENT', 'production') == 'production':
         application.config['DEBUG'] = False
         application.config['TESTING'] = False
-        # 其他生產環境配置...
     
-    return application
+    # 檔名含內容雜湊的資源永遠不會改變，允許瀏覽器長期快取
+    fingerprinted = set(manifest.values())
+    
+    @application.after_request
+    def cache_fingerprinted_assets(response):
+        from flask import request
+        if request.path.startswith('/static/') and os.path.basename(request.path) in fingerprinted:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+    
+    total = time.perf_counter() - started
+    details = ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in timings.items())
+    if total > STARTUP_BUDGET:
+        logger.warning(f"啟動耗時 {total:.2f} 秒，超過預算 {STARTUP_BUDGET:.2f} 秒（{details}）")
+    else:
+        logger.info(f"啟動耗時 {total:.2f} 秒（{details}）")
+    
+    return application, backend
 
 # 創建應用
-app = create_app()
+app, backend = create_app()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     host = os.environ.get('HOST', '0.0.0.0')
     
     logger.info(f"啟動應用，監聽於 {host}:{port}")
-    app.run(host=host, port=port)
+    if os.environ.get('ENVIRONMENT', 'production') == 'development':
+        app.run(host=host, port=port, debug=True)
+    else:
+        backend.serve_production(host, port)